@@ -0,0 +1,251 @@
+"""
+Encodes and decodes the per-beam array columns (vel, slist, gflg, geo_latc,
+mag_latc, mag_glatc, ...) stored in the sqlite dbs.
+
+Arrays are written either as JSON TEXT (the original format) or as typed
+little-endian BLOBs, optionally zlib compressed. A BLOB starts with a
+two-byte header (codec id, dtype code) followed by the raw array bytes,
+so decode_array works on any mix of JSON TEXT and BLOB rows.
+"""
+
+import json
+import sqlite3
+import zlib
+import numpy as np
+
+# dtype of each array column. Columns not listed here are stored as float32.
+# NOTE: gridded local times (xxx_gltc) are kept in float64 because they are
+# used as keys (e.g., mag_gltc=1.05) in the median, master and cosfit tables.
+COLUMN_DTYPES = {"vel":"<f4", "slist":"<i2", "gflg":"u1",
+                 "geo_latc":"<f4", "geo_lonc":"<f4",
+                 "geo_ltc":"<f4", "geo_azmc":"<f4",
+                 "mag_latc":"<f4", "mag_lonc":"<f4",
+                 "mag_ltc":"<f4", "mag_azmc":"<f4",
+                 "geo_glatc":"<f4", "geo_gltc":"<f8", "geo_gazmc":"<f4",
+                 "mag_glatc":"<f4", "mag_gltc":"<f8", "mag_gazmc":"<f4",
+                 "tec":"<f4",
+                 "fov_geometry":"<f8"}
+
+# codec ids stored in the first byte of a BLOB
+_CODEC_IDS = {"blob":1, "blob_zlib":2}
+
+# dtype codes stored in the second byte of a BLOB
+_DTYPE_CODES = {"<f4":"f", "<f8":"d", "<i2":"h", "<i4":"i", "u1":"B"}
+_CODE_DTYPES = dict([(v, k) for k, v in _DTYPE_CODES.items()])
+
+# The codec used by encode_array if codec argument is None.
+# Can be one of "json", "blob", "blob_zlib".
+DEFAULT_CODEC = "blob"
+
+def set_default_codec(codec):
+    """ Sets the codec used by encode_array when no codec is given.
+
+    Parameters
+    ----------
+    codec : str
+        One of "json", "blob", "blob_zlib"
+    """
+
+    global DEFAULT_CODEC
+    if codec not in ["json"] + _CODEC_IDS.keys():
+        raise ValueError("unknown array codec " + str(codec))
+    DEFAULT_CODEC = codec
+
+    return
+
+def column_dtype(column):
+    """ Returns the dtype in which a given array column is stored """
+    return COLUMN_DTYPES.get(column, "<f4")
+
+def encode_array(values, column, codec=None):
+    """ Encodes a list or a np.array into a value that can be written
+    into a sqlite db.
+
+    Parameters
+    ----------
+    values : list or np.array
+    column : str
+        Name of the db column, e.g., "vel", "slist", "mag_glatc".
+        Sets the dtype of the BLOB. See COLUMN_DTYPES.
+    codec : str, default to None
+        One of "json", "blob", "blob_zlib". Default to DEFAULT_CODEC.
+
+    Returns
+    -------
+    A JSON string or a sqlite3.Binary object
+    """
+
+    if codec is None:
+        codec = DEFAULT_CODEC
+
+    if codec == "json":
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+        return json.dumps(values)
+
+    dtype = column_dtype(column)
+    payload = np.asarray(values, dtype=dtype).tobytes()
+    if codec == "blob_zlib":
+        payload = zlib.compress(payload)
+    header = chr(_CODEC_IDS[codec]) + _DTYPE_CODES[dtype]
+
+    return sqlite3.Binary(header + payload)
+
+def decode_array(value, column=None):
+    """ Decodes a value read from a sqlite db into a np.array.
+    Both JSON TEXT and BLOB values are accepted.
+
+    Parameters
+    ----------
+    value : str, unicode, buffer or None
+    column : str, default to None
+        Name of the db column. Only used for JSON TEXT values to set
+        the dtype of the output array.
+
+    Returns
+    -------
+    np.array or None if value is None
+
+    Note
+    ----
+    Uncompressed BLOBs are decoded with np.frombuffer without copying,
+    so the returned array is read-only.
+    """
+
+    if value is None:
+        return None
+
+    # JSON TEXT
+    if isinstance(value, basestring):
+        if column is None:
+            dtype = float
+        else:
+            dtype = column_dtype(column)
+        return np.array(json.loads(value), dtype=dtype)
+
+    # BLOB
+    codec_id = ord(value[0])
+    dtype = _CODE_DTYPES[value[1]]
+    if len(value) == 2:
+        return np.empty(0, dtype=dtype)
+    if codec_id == _CODEC_IDS["blob_zlib"]:
+        return np.frombuffer(zlib.decompress(value[2:]), dtype=dtype)
+
+    return np.frombuffer(value, dtype=dtype, offset=2)
+
+def decode_list(value, column=None):
+    """ Same as decode_array but returns a list of python numbers """
+
+    arr = decode_array(value, column=column)
+    if arr is None:
+        return None
+
+    return arr.tolist()
+
+def _is_array_value(value):
+    # JSON arrays and BLOBs hold arrays, anything else (e.g., the scalar
+    # vel of the median tables) is left as it is
+    if isinstance(value, basestring):
+        return value.lstrip().startswith("[")
+    return isinstance(value, buffer)
+
+def migrate_table(conn, table_name, codec=None, batch_size=5000):
+    """ Re-encodes all the array columns of a table with a given codec.
+    Only the TEXT or BLOB columns named in COLUMN_DTYPES are migrated, and
+    within them only the values that hold JSON arrays or BLOBs.
+
+    Parameters
+    ----------
+    conn : sqlite3.connect
+    table_name : str
+    codec : str, default to None
+        One of "json", "blob", "blob_zlib". Default to DEFAULT_CODEC.
+    batch_size : int, default to 5000
+        Number of rows read and updated at a time
+
+    Returns
+    -------
+    Number of rows migrated
+    """
+
+    cur = conn.cursor()
+
+    # find the array columns of the table. Columns declared with a
+    # numeric type (e.g., "vel float(9,2)") hold scalars.
+    cur.execute("PRAGMA table_info({tb})".format(tb=table_name))
+    columns = [x[1] for x in cur.fetchall() if x[1] in COLUMN_DTYPES and
+               (x[2].upper() in ["", "TEXT", "BLOB"])]
+    if not columns:
+        return 0
+
+    command = "SELECT rowid, {cols} FROM {tb}"
+    command = command.format(cols=", ".join(columns), tb=table_name)
+    command_update = "UPDATE {tb} SET {sets} WHERE rowid=?"
+    command_update = command_update.format(tb=table_name,
+                                           sets=", ".join([x + "=?" for x in columns]))
+
+    # read through a separate cursor so that updates can be committed in batches
+    cur_in = conn.cursor()
+    cur_in.execute(command)
+    nrows = 0
+    while True:
+        rows = cur_in.fetchmany(batch_size)
+        if not rows:
+            break
+        params = []
+        for row in rows:
+            values = [encode_array(decode_array(row[i+1], column=col), col, codec=codec)
+                      if _is_array_value(row[i+1]) else row[i+1]
+                      for i, col in enumerate(columns)]
+            params.append(tuple(values) + (row[0],))
+        cur.executemany(command_update, params)
+        nrows += len(rows)
+    conn.commit()
+
+    return nrows
+
+def migrate_db(db_name, tables, dbdir="../data/sqlite3/",
+               codec=None, vacuum=True):
+    """ One-shot migration of the array columns of a db
+    (e.g., sd_gridded_los_data_fitacf.sqlite) from JSON TEXT to BLOBs.
+
+    Parameters
+    ----------
+    db_name : str
+    tables : list
+        Tables to migrate, e.g., the radar tables of the LOS data db.
+        It has to be given explicitly, since other tables may have scalar
+        columns named like the array columns.
+    codec : str, default to None
+        One of "json", "blob", "blob_zlib". Default to DEFAULT_CODEC.
+    vacuum : bool, default to True
+        Runs VACUUM at the end to give the freed space back to the disk.
+    """
+
+    import datetime as dt
+
+    if not tables:
+        raise ValueError("the tables to be migrated have to be given")
+
+    conn = sqlite3.connect(dbdir + db_name)
+
+    for table_name in tables:
+        t1 = dt.datetime.now()
+        nrows = migrate_table(conn, table_name, codec=codec)
+        t2 = dt.datetime.now()
+        print("migrated " + str(nrows) + " rows of " + table_name + " in " +\
+              str((t2-t1).total_seconds()) + " secs")
+
+    if vacuum:
+        conn.execute("VACUUM")
+    conn.close()
+
+    return
+
+if __name__ == "__main__":
+
+    ftype = "fitacf"
+    db_name = "sd_gridded_los_data_" + ftype + ".sqlite"
+    dbdir = "../data/sqlite3/"
+    rads = ["wal", "bks", "fhe", "fhw", "cve", "cvw", "ade", "adw"]
+    migrate_db(db_name, rads, dbdir=dbdir, codec="blob")
@@ -0,0 +1,129 @@
+"""
+A columnar container for a batch of radar beam soundings.
+"""
+
+import numpy as np
+
+class BeamBatch(object):
+    """ Holds a batch of beams in flat np.arrays.
+
+    The gate-level fields (vel, slist, gflg) of all the beams are
+    concatenated into single arrays, and offsets gives where each beam
+    starts and ends, i.e., the gates of beam i are
+    vel[offsets[i]:offsets[i+1]].
+
+    Attributes
+    -----------
+    vel : np.array (float32)
+    slist : np.array (int16)
+    gflg : np.array (uint8)
+    offsets : np.array (int64)
+        Length is nbeams + 1
+    time : np.array (datetime64[us])
+        timestamp of each beam sounding
+    bmnum, bmazm, nrang, rsep, frang, stid : np.array
+        Per-beam parameters
+
+    """
+
+    # per-beam fields and their dtypes
+    beam_fields = [("bmnum", "i2"), ("bmazm", "f4"), ("nrang", "i2"),
+                   ("rsep", "f4"), ("frang", "f4"), ("stid", "i2")]
+
+    # gate-level fields and their dtypes
+    gate_fields = [("vel", "f4"), ("slist", "i2"), ("gflg", "u1")]
+
+    def __init__(self, vel, slist, gflg, offsets, time, bmnum, bmazm,
+                 nrang, rsep, frang, stid):
+
+        self.vel = np.asarray(vel, dtype="f4")
+        self.slist = np.asarray(slist, dtype="i2")
+        self.gflg = np.asarray(gflg, dtype="u1")
+        self.offsets = np.asarray(offsets, dtype="i8")
+        self.time = np.asarray(time, dtype="datetime64[us]")
+        self.bmnum = np.asarray(bmnum, dtype="i2")
+        self.bmazm = np.asarray(bmazm, dtype="f4")
+        self.nrang = np.asarray(nrang, dtype="i2")
+        self.rsep = np.asarray(rsep, dtype="f4")
+        self.frang = np.asarray(frang, dtype="f4")
+        self.stid = np.asarray(stid, dtype="i2")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def ngates(self):
+        """ number of gates of each beam """
+        return np.diff(self.offsets)
+
+    def beam_index(self):
+        """ returns the beam index of each gate-level value """
+        return np.repeat(np.arange(len(self)), self.ngates)
+
+    def beam(self, i):
+        """ returns the gate-level fields of beam i as views """
+        s = slice(self.offsets[i], self.offsets[i+1])
+        return self.vel[s], self.slist[s], self.gflg[s]
+
+    def datetimes(self):
+        """ returns the beam times as a list of datetime.datetime """
+        return self.time.astype(object).tolist()
+
+    def to_dict(self):
+        """ converts the batch to a dict of lists, in the same
+        format as the one returned by read_data_from_file """
+
+        data = {"datetime":self.datetimes()}
+        for key, dtype in self.beam_fields:
+            data[key] = getattr(self, key).tolist()
+        for key, dtype in self.gate_fields:
+            flat = getattr(self, key)
+            data[key] = [flat[self.offsets[i]:self.offsets[i+1]].tolist()
+                         for i in range(len(self))]
+
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """ builds a BeamBatch from a dict of lists, e.g., the one
+        returned by read_data_from_file """
+
+        return cls.from_arrays(data["vel"], data["slist"], data["gflg"],
+                               data["datetime"], data["bmnum"], data["bmazm"],
+                               data["nrang"], data["rsep"], data["frang"],
+                               data["stid"])
+
+    @classmethod
+    def from_arrays(cls, vels, slists, gflgs, time, bmnum, bmazm,
+                    nrang, rsep, frang, stid):
+        """ builds a BeamBatch from per-beam lists (or arrays) of
+        gate-level values """
+
+        ngates = np.array([len(x) for x in slists], dtype="i8")
+        offsets = np.zeros(len(ngates) + 1, dtype="i8")
+        np.cumsum(ngates, out=offsets[1:])
+
+        return cls(_concat(vels, "f4"), _concat(slists, "i2"),
+                   _concat(gflgs, "u1"), offsets, time, bmnum, bmazm,
+                   nrang, rsep, frang, stid)
+
+    @classmethod
+    def concatenate(cls, batches):
+        """ concatenates a list of BeamBatch objects into one """
+
+        offsets = [np.zeros(1, dtype="i8")]
+        start = 0
+        for b in batches:
+            offsets.append(b.offsets[1:] + start)
+            start += b.offsets[-1]
+        kwargs = {}
+        for key, dtype in cls.gate_fields + cls.beam_fields:
+            kwargs[key] = np.concatenate([getattr(b, key) for b in batches])
+        kwargs["time"] = np.concatenate([b.time for b in batches])
+
+        return cls(offsets=np.concatenate(offsets), **kwargs)
+
+def _concat(arrays, dtype):
+    if len(arrays) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate([np.asarray(x, dtype=dtype) for x in arrays])
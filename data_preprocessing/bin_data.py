@@ -53,8 +53,199 @@ class grids(object):
         self.azm_bins = [x for x in range(0, 362, 2)]
         self.center_azms = [x for x in range(1, 361, 2)]
 
+        # flattened arrays used by locate
+        self._create_flat_arrays()
+
+        return
+
+    def _create_flat_arrays(self):
+        """ creates flattened np.arrays of the grid-cells.
+        Grid-cells are numbered band by band (from lat_min to lat_max),
+        and from 0 degree lon (or lt) within each band. """
+
+        import numpy as np
+
+        nbands = len(self.center_lats)
+
+        # number of grid-cells in each latitude band
+        self.band_nlons = np.array(self.nlons, dtype=int)
+
+        # cell id of the first grid-cell of each band. The last entry is
+        # the total number of grid-cells.
+        self.band_offsets = np.zeros(nbands + 1, dtype=int)
+        np.cumsum(self.band_nlons, out=self.band_offsets[1:])
+
+        # band index, center lat and center lon of each grid-cell
+        self.cell_bands = np.repeat(np.arange(nbands), self.band_nlons)
+        self.cell_center_lats = np.array(self.center_lats)[self.cell_bands]
+        self.cell_center_lons = np.concatenate([np.array(x, dtype=float)
+                                                for x in self.center_lons])
+
+        # left lon edge of each grid-cell, shifted by band index * _band_key
+        # so that the cells of all the bands are sorted in one array
+        self._cell_keys = np.concatenate([b * self._band_key + np.array(self.lon_bins[b][:-1])
+                                          for b in range(nbands)])
+
+        self._lat_bins = np.array(self.lat_bins, dtype=float)
+        self._azm_bins = np.array(self.azm_bins, dtype=float)
+        self._center_azms = np.array(self.center_azms, dtype=float)
+
         return
 
+    # larger than the lon (or lt) range of a band
+    _band_key = 512.
+
+    def locate(self, lat, lt, azm):
+        """ finds the grid-cells and azimuthal bins of arrays of points.
+
+        Parameters
+        ----------
+        lat : np.array
+            Latitudes
+        lt : np.array
+            Longitudes or local times in degrees, in [0, 360)
+        azm : np.array
+            Azimuths in degrees, in [0, 360)
+
+        Returns
+        -------
+        band_ids, cell_ids, azm_ids : np.arrays of int
+            Latitude band index, grid-cell id and azimuthal bin index of
+            each point. -1 where the point is NaN or out of the grids.
+        """
+
+        import numpy as np
+
+        lat = np.asarray(lat, dtype=float)
+        lt = np.asarray(lt, dtype=float)
+        azm = np.asarray(azm, dtype=float)
+        nbands = len(self.center_lats)
+
+        # latitude bands, bins[i-1] <= x < bins[i] as in np.digitize
+        band_ids = np.searchsorted(self._lat_bins, lat, side="right") - 1
+        band_ids[np.isnan(lat) | (band_ids < 0) | (band_ids >= nbands)] = -1
+
+        # grid-cells, in one searchsorted over the cells of all the bands
+        valid = (band_ids >= 0) & (lt >= 0.) & (lt < 360.)
+        cell_ids = np.zeros(len(lat), dtype=int) - 1
+        keys = band_ids[valid] * self._band_key + lt[valid]
+        cell_ids[valid] = np.searchsorted(self._cell_keys, keys, side="right") - 1
+
+        # azimuthal bins
+        azm_ids = np.searchsorted(self._azm_bins, azm, side="right") - 1
+        azm_ids[np.isnan(azm) | (azm_ids < 0) | (azm_ids >= len(self.center_azms))] = -1
+
+        return band_ids, cell_ids, azm_ids
+
+    def encode_ids(self, lat, lt, azm):
+        """ encodes arrays of points (or of grid-cell centers) into compact
+        integer ids. The ids are stable for a given set of grid parameters,
+        so they can be used as keys in db tables instead of float centers.
+
+        Parameters
+        ----------
+        lat, lt, azm : np.array
+            Latitudes, longitudes (or local times) in degrees and azimuths
+
+        Returns
+        -------
+        cell_ids : np.array of int32
+            Grid-cell ids. -1 where the point is out of the grids.
+        azm_ids : np.array of int16
+            Azimuthal bin ids. -1 where the point is out of the azm bins.
+        """
+
+        import numpy as np
+
+        band_ids, cell_ids, azm_ids = self.locate(lat, lt, azm)
+
+        return cell_ids.astype(np.int32), azm_ids.astype(np.int16)
+
+    def decode_cell_ids(self, cell_ids):
+        """ returns the center lats and center lons (or lts) of grid-cell ids,
+        NaN where the id is -1 """
+
+        import numpy as np
+
+        cell_ids = np.asarray(cell_ids, dtype=int)
+        valid = cell_ids >= 0
+        glatc = np.where(valid, self.cell_center_lats[np.where(valid, cell_ids, 0)], np.nan)
+        gltc = np.where(valid, self.cell_center_lons[np.where(valid, cell_ids, 0)], np.nan)
+
+        return glatc, gltc
+
+    def decode_azm_ids(self, azm_ids):
+        """ returns the center azms of azimuthal bin ids, NaN where the id is -1 """
+
+        import numpy as np
+
+        azm_ids = np.asarray(azm_ids, dtype=int)
+        valid = azm_ids >= 0
+
+        return np.where(valid, self._center_azms[np.where(valid, azm_ids, 0)], np.nan)
+
+    def window_cell_ids(self, cell_id, lt_width):
+        """ returns the ids of the grid-cells in the latitude band of cell_id
+        whose center lons (or lts) are within lt_width/2 degrees of the center
+        of cell_id. The window wraps around 0/360.
+
+        Parameters
+        ----------
+        cell_id : int
+        lt_width : float
+            Width of the window in degrees, e.g., 15 * (MLT width in hours)
+
+        Returns
+        -------
+        np.array of int32
+        """
+
+        import numpy as np
+
+        band = self.cell_bands[cell_id]
+        ids = np.arange(self.band_offsets[band], self.band_offsets[band+1])
+        dlt = (self.cell_center_lons[ids] - self.cell_center_lons[cell_id] + 180.) % 360. - 180.
+
+        # a small tolerance for the lons that are rounded to 2 decimals
+        return ids[np.abs(dlt) <= lt_width/2. + 1.e-6].astype(np.int32)
+
+    def window_extents(self, lt_width):
+        """ returns the windows of window_cell_ids for all the grid-cells at
+        once, as numbers of grid-cells before and after each grid-cell
+        within its latitude band. The window of a cell_id is the cell_ids
+        from cell_id - before to cell_id + after, wrapped around within the
+        band.
+
+        Parameters
+        ----------
+        lt_width : float
+            Width of the window in degrees, e.g., 15 * (MLT width in hours)
+
+        Returns
+        -------
+        before, after : np.array of int, indexed by cell_id
+        """
+
+        import numpy as np
+
+        if not hasattr(self, "_window_extents"):
+            self._window_extents = {}
+        if lt_width in self._window_extents:
+            return self._window_extents[lt_width]
+
+        before = np.zeros(self.band_offsets[-1], dtype=int)
+        after = np.zeros(self.band_offsets[-1], dtype=int)
+        for band in range(len(self.center_lats)):
+            ids = np.arange(self.band_offsets[band], self.band_offsets[band+1])
+            lons = self.cell_center_lons[ids]
+            dlt = (lons[np.newaxis, :] - lons[:, np.newaxis] + 180.) % 360. - 180.
+            inside = np.abs(dlt) <= lt_width/2. + 1.e-6
+            before[ids] = np.sum(inside & (dlt < 0), axis=1)
+            after[ids] = np.sum(inside & (dlt > 0), axis=1)
+        self._window_extents[lt_width] = (before, after)
+
+        return before, after
+
     def _create_lonbins(self):
         """ creates longitudinal bins """
 
@@ -69,8 +260,16 @@ class grids(object):
             lon_tmp.append(360.) 
             lon_bins.append(lon_tmp)
 
-        return lon_bins, center_lons 
-        
+        return lon_bins, center_lons
+
+def hemi_grids(hemi="north"):
+    """ returns the grids in which the data of a hemisphere are binned.
+    The cell ids and azm ids stored in the db tables refer to these grids.
+    NOTE: only "north" has been implemented. """
+
+    if hemi=="north":
+        return grids(lat_min=20, lat_max=90, dlat=1, half_dlat_offset=False)
+
 
 def return_nan_if_IndexError(data, index):
     """ returns np.nan if index is out of range of data,
@@ -93,6 +292,31 @@ def return_nan_if_IndexError(data, index):
 
     return out
 
+def grid_cells(grds, latc, lonc, azm):
+    """ finds the grid-cell centers of arrays of cells, e.g., the cells of
+    a batch of beams.
+
+    Parameters
+    ----------
+    grds : grids object
+    latc, lonc, azm : np.array
+        lats, local times (or MLTs) in degrees and azms of the cells
+
+    Returns
+    -------
+    glatc, glonc, gazmc : np.arrays
+        NaN for the cells that fall outside the grids.
+    """
+
+    import numpy as np
+
+    band_ids, cell_ids, azm_ids = grds.locate(latc, lonc, azm)
+    glatc = np.where(band_ids >= 0, np.array(grds.center_lats)[band_ids], np.nan)
+    glonc = np.where(cell_ids >= 0, grds.cell_center_lons[cell_ids], np.nan)
+    gazmc = np.where(azm_ids >= 0, grds._center_azms[azm_ids], np.nan)
+
+    return glatc, glonc, gazmc
+
 def bin_to_grid(rad, stm=None, etm=None, ftype="fitacf",
 		coords = "mlt", hemi="north",
                 dbdir="../data/sqlite3/", db_name=None):
@@ -134,18 +358,18 @@ def bin_to_grid(rad, stm=None, etm=None, ftype="fitacf",
     sys.path.append("../")
     import logging
     import sqlite3
-    import json
+    from array_codec import encode_array, decode_array
+    from bulk_update import bulk_updater
 
 
     # create grid points
-    if hemi=="north":
-        grds = grids(lat_min=20, lat_max=90, dlat=1, half_dlat_offset=False)
+    grds = hemi_grids(hemi)
 
     # make db connection
     if db_name is None:
         db_name = "sd_gridded_los_data_" + ftype + ".sqlite"
     try:
-        conn = sqlite3.connect(dbdir + db_name,
+        conn = sqlite3.connect(dbdir + db_name, timeout=600.,
                                detect_types = sqlite3.PARSE_DECLTYPES)
         cur = conn.cursor()
     except Exception, e:
@@ -201,14 +425,14 @@ def bin_to_grid(rad, stm=None, etm=None, ftype="fitacf",
 	col_azmc = "geo_azmc"
 
     if (stm is not None) and (etm is not None):
-        command = "SELECT {latc}, {lonc}, {azm}, datetime FROM {tb} " +\
+        command = "SELECT {latc}, {lonc}, {azm}, datetime, bmnum FROM {tb} " +\
                   "WHERE datetime BETWEEN '{sdtm}' AND '{edtm}' ORDER BY datetime ASC"
         command = command.format(tb=table_name, sdtm=stm, edtm=etm,
                                  latc=col_latc, lonc=col_ltc, azm=col_azmc)
 
     # do the convertion to the data between stm and etm if any of them is None
     else:
-        command = "SELECT {latc}, {lonc}, {azm}, datetime FROM {tb} ORDER BY datetime ASC".\
+        command = "SELECT {latc}, {lonc}, {azm}, datetime, bmnum FROM {tb} ORDER BY datetime ASC".\
 		  format(tb=table_name, latc=col_latc, lonc=col_ltc, azm=col_azmc)
     try:
         cur.execute(command)
@@ -218,72 +442,53 @@ def bin_to_grid(rad, stm=None, etm=None, ftype="fitacf",
 
     # do the conversion row by row
     if rows != []:
+        # the results are written in bulk through a staging table
+        if coords == "mlt":
+            updater = bulk_updater(conn, table_name,
+                                   ["mag_glatc", "mag_gltc", "mag_gazmc"])
+        if coords == "geo":
+            updater = bulk_updater(conn, table_name,
+                                   ["geo_glatc", "geo_gltc", "geo_gazmc"])
+        # decode the arrays of the rows that have latc, and flatten them
+        rows = [x for x in rows if x[0]]
+        ncells = [0]
+        latcs = []
+        loncs = []
+        azms = []
         for row in rows:
-            latc, lonc, azm, date_time= row
-            if latc:
-                # Load json string
-                latc = json.loads(latc)
-                lonc = json.loads(lonc)
-                azm = json.loads(azm)
-
-                # grid the data
-                # grid latc
-                indx_latc = np.digitize(latc, grds.lat_bins)
-                indx_latc = [x-1 for x in indx_latc]
-                #glatc = [grds.center_lats[x] for x in indx_latc]
-
-                # NOTE: the following way of using return_nan_if_IndexError
-                # avoids nan in latc
-                glatc = [return_nan_if_IndexError(grds.center_lats, x) for x in indx_latc]
-
-                # grid lonc
-                # NOTE: the following way avoids nan in lonc
-                glonc = []
-                for i in range(len(lonc)):
-                    try:
-                        indx_lonc = np.digitize(lonc[i], grds.lon_bins[indx_latc[i]]) 
-                        indx_lonc = indx_lonc - 1
-                        glonc.append(grds.center_lons[indx_latc[i]][indx_lonc])
-                    except IndexError:
-                        glonc.append(np.nan)
-
-                # grid azm
-                indx_azmc = np.digitize(azm, grds.azm_bins)
-                indx_azmc = [x-1 for x in indx_azmc]
-                #gazmc = [grds.center_azms[x] for x in indx_azmc]
-
-                # NOTE: the following way of using return_nan_if_IndexError
-                # avoids nan in azm
-                gazmc = [return_nan_if_IndexError(grds.center_azms,x) for x in indx_azmc]
-
-                # convert to str
-                glatc = json.dumps(glatc)
-                glonc = json.dumps(glonc)
-                gazmc = json.dumps(gazmc)
-
-                # update the table
-		if coords == "mlt":
-		    command = "UPDATE {tb} SET mag_glatc='{glatc}', " +\
-			      "mag_gltc='{glonc}', mag_gazmc='{gazmc}' " +\
-			      "WHERE datetime = '{dtm}'"
-		if coords == "geo":
-		    command = "UPDATE {tb} SET geo_glatc='{glatc}', " +\
-			      "geo_gltc='{glonc}', geo_gazmc='{gazmc}' " +\
-			      "WHERE datetime = '{dtm}'"
-		command = command.format(tb=table_name, glatc=glatc,
-                                         glonc=glonc, gazmc=gazmc, dtm=date_time)
-
-		# update
-                try:
-                    cur.execute(command)
-                except Exception, e:
-                    logging.error(e, exc_info=True)
-
-        # commit the results
-        try:
-            conn.commit()
-        except Exception, e:
-            logging.error(e, exc_info=True)
+            latcs.append(decode_array(row[0], col_latc))
+            loncs.append(decode_array(row[1], col_ltc))
+            azms.append(decode_array(row[2], col_azmc))
+            ncells.append(len(latcs[-1]))
+        cell_offsets = np.cumsum(ncells)
+
+        # grid the cells of all the rows at once
+        if rows:
+            glatc_all, glonc_all, gazmc_all = grid_cells(grds, np.concatenate(latcs),
+                                                         np.concatenate(loncs),
+                                                         np.concatenate(azms))
+
+        for ii, row in enumerate(rows):
+            latc, lonc, azm, date_time, bmnum = row
+            cells = slice(cell_offsets[ii], cell_offsets[ii+1])
+
+            # encode the arrays
+            if coords == "mlt":
+                glatc = encode_array(glatc_all[cells], "mag_glatc")
+                glonc = encode_array(glonc_all[cells], "mag_gltc")
+                gazmc = encode_array(gazmc_all[cells], "mag_gazmc")
+            if coords == "geo":
+                glatc = encode_array(glatc_all[cells], "geo_glatc")
+                glonc = encode_array(glonc_all[cells], "geo_gltc")
+                gazmc = encode_array(gazmc_all[cells], "geo_gazmc")
+
+            # stage the new values
+            updater.add((glatc, glonc, gazmc), (date_time, bmnum))
+
+        # apply the remaining rows, each chunk is committed by updater.
+        # Write errors (e.g., "database is locked" after the timeout) are
+        # raised, so that a unit fails instead of silently losing its rows.
+        updater.close()
 
     # close the db connection
     conn.close()
@@ -322,13 +527,14 @@ def worker(rad, stm=None, etm=None, ftype="fitacf",
 
     return
 
-def main(run_in_parallel=True):
+def main(run_in_parallel=True, chunk_minutes=None):
     """ Call the functions above. Acts as an example code.
     Multiprocessing has been implemented to do parallel computing.
-    A unit process is for a radar beam (i.e. a db table)"""
+    A unit process is for a radar (i.e. a db table), or for a time shard
+    of a radar if chunk_minutes is set."""
 
     import datetime as dt
-    import multiprocessing as mp
+    from unit_scheduler import run_sharded
     import logging
     
     # create a log file to which any error occured will be written.
@@ -347,31 +553,13 @@ def main(run_in_parallel=True):
     # run the code for the following radars in parallel
     rad_list = ["wal", "bks", "fhe", "fhw", "cve", "cvw", "ade", "adw"] 
 
-    # loop through the dates
-    # store the multiprocess
-    procs = []
-    for rad in rad_list:
-        
-        if run_in_parallel:
-            # cteate a process
-            worker_kwargs = {"stm":stm, "etm":etm, "ftype":ftype,
-                             "coords":coords, "hemi":hemi,
-                             "dbdir":dbdir, "db_name":db_name}
-            p = mp.Process(target=worker, args=(rad),
-                           kwargs=worker_kwargs)
-            procs.append(p)
-            
-            # run the process
-            p.start()
-        else:
-            worker(rad, stm=stm, etm=etm, ftype=ftype,
-                   coords=coords, hemi=hemi,
-                   dbdir=dbdir, db_name=db_name)
-
-    if run_in_parallel:
-        # make sure the processes terminate
-        for p in procs:
-            p.join()
+    # run a unit per (radar, time shard). The period can only be split
+    # if stm and etm are set.
+    worker_kwargs = {"ftype":ftype, "coords":coords, "hemi":hemi,
+                     "dbdir":dbdir, "db_name":db_name}
+    run_sharded(worker, rad_list, stm, etm, chunk_minutes=chunk_minutes,
+                worker_kwargs=worker_kwargs,
+                nprocs=None if run_in_parallel else 1)
 
     return
 
@@ -2,19 +2,25 @@ import numpy as np
 import datetime as dt
 import logging
 import sqlite3
-import json
+import itertools
+import multiprocessing as mp
 import sys
 sys.path.append("../data/")
 from build_event_database import build_event_database
+from array_codec import decode_array
+from bin_data import hemi_grids
 
 def build_master_table(input_table, output_table, ftype="fitacf",
                        filtered_interval = 2.,
                        coords="mlt", dbdir="../data/sqlite3/",
-                       input_dbname=None, output_dbname=None):
+                       input_dbname=None, output_dbname=None,
+                       defer_index=False):
    
     """ combines all the median filtered gridded data into
     one master table. 
-    The results are stored in a different db file.
+    The results are stored in a different db file. The input db is
+    attached to the master db and the rows are moved with a single
+    INSERT OR IGNORE ... SELECT.
 
     Parameters
     ----------
@@ -31,6 +37,10 @@ def build_master_table(input_table, output_table, ftype="fitacf",
         Name of the sqlite db where xxx-min median data are stored.
     output_dbname : str, default to None
         Name of the master db
+    defer_index : bool, default to False
+        If True and the table does not exist yet, it is created without
+        its primary key, and a unique index on the key columns is built
+        after all the rows have been moved.
 
     Returns
     -------
@@ -38,6 +48,8 @@ def build_master_table(input_table, output_table, ftype="fitacf",
 
     """
 
+    from combine_xxx_min_median import build_key_index
+
     # create db name
     if input_dbname is None:
         input_dbname = "sd_" + str(int(filtered_interval)) + "_min_median_" +\
@@ -45,14 +57,6 @@ def build_master_table(input_table, output_table, ftype="fitacf",
     if output_dbname is None:
         output_dbname = "sd_master_" + coords + "_" + ftype + ".sqlite"
 
-    # make a connection to xxx-min median filtered data 
-    try:
-        conn_in = sqlite3.connect(dbdir + input_dbname,
-                                  detect_types = sqlite3.PARSE_DECLTYPES)
-        cur_in = conn_in.cursor()
-    except Exception, e:
-        logging.error(e, exc_info=True)
-
     # make a connection to master db
     try:
         conn_out = sqlite3.connect(dbdir + output_dbname,
@@ -61,82 +65,62 @@ def build_master_table(input_table, output_table, ftype="fitacf",
     except Exception, e:
         logging.error(e, exc_info=True)
 
-    # create a table
     if coords == "mlt":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " mag_glatc float(7,2)," +\
-                  " mag_gltc float(8,2)," +\
-                  " mag_gazmc SMALLINT," +\
-                  " datetime DATETIME, " +\
-                  " rad VARCHAR(3), " +\
-                  " CONSTRAINT all_rads PRIMARY KEY (" +\
-                  "mag_glatc, mag_gltc, mag_gazmc, datetime, rad))"
+        coords_prefix = "mag"
     elif coords == "geo":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " geo_glatc float(7,2)," +\
-                  " geo_gltc float(8,2)," +\
-                  " geo_gazmc SMALLINT," +\
-                  " datetime DATETIME, " +\
-                  " rad VARCHAR(3), " +\
-                  " CONSTRAINT all_rads PRIMARY KEY (" +\
-                  "geo_glatc, geo_gltc, geo_gazmc, datetime, rad))"
-    command = command.format(tb=output_table)
+        coords_prefix = "geo"
+
+    # create a table
+    key_columns = ["cell_id", "azm_id", "datetime", "rad"]
+    command = "CREATE TABLE IF NOT EXISTS {tb}" +\
+              "(vel float(9,2)," +\
+              " {prefix}_glatc float(7,2)," +\
+              " {prefix}_gltc float(8,2)," +\
+              " {prefix}_gazmc SMALLINT," +\
+              " cell_id INTEGER," +\
+              " azm_id SMALLINT," +\
+              " datetime DATETIME, " +\
+              " rad VARCHAR(3)"
+    if defer_index:
+        command = command + ")"
+    else:
+        command = command + ", CONSTRAINT all_rads PRIMARY KEY (" +\
+                  ", ".join(key_columns) + "))"
+    command = command.format(tb=output_table, prefix=coords_prefix)
     try:
         cur_out.execute(command)
     except Exception, e:
         logging.error(e, exc_info=True)
 
-    if coords == "mlt":
-	command = "SELECT vel, mag_glatc, mag_gltc, mag_gazmc, " +\
-		  "datetime, rad FROM {tb1} ORDER By datetime ASC"
-    elif coords == "geo":
-	command = "SELECT vel, geo_glatc, geo_gltc, geo_gazmc, " +\
-		  "datetime, rad FROM {tb1} ORDER By datetime ASC"
-    command = command.format(tb1=input_table)
-
-    # fetch the data
+    # move the data from the attached xxx-min median db
+    columns = "vel, {prefix}_glatc, {prefix}_gltc, {prefix}_gazmc, " +\
+              "cell_id, azm_id, datetime, rad"
+    columns = columns.format(prefix=coords_prefix)
+    command = "INSERT OR IGNORE INTO {tb2} ({cols}) " +\
+              "SELECT {cols} FROM median_db.{tb1} ORDER BY datetime ASC"
+    command = command.format(tb1=input_table, tb2=output_table, cols=columns)
     try:
-	cur_in.execute(command)
+        cur_out.execute("ATTACH DATABASE ? AS median_db", (dbdir + input_dbname,))
+        cur_out.execute(command)
+        conn_out.commit()
+        cur_out.execute("DETACH DATABASE median_db")
     except Exception, e:
-	logging.error(e, exc_info=True)
-    rows = cur_in.fetchall()
+        logging.error(e, exc_info=True)
 
-    # insert the data into a table
-    if rows:
-	if coords == "mlt":
-	    command = "INSERT OR IGNORE INTO {tb2} (vel, mag_glatc, mag_gltc, " +\
-		      "mag_gazmc, datetime, rad) VALUES (?, ?, ?, ?, ?, ?)"
-	elif coords == "geo":
-	    command = "INSERT OR IGNORE INTO {tb2} (vel, geo_glatc, geo_gltc, " +\
-		      "geo_gazmc, datetime, rad) VALUES (?, ?, ?, ?, ?, ?)"
-	command = command.format(tb2=output_table)
-	for rw in rows:
-	    vel, lat, lt, azm, dtm, rad = rw
-
-	    # insert the data
-	    try:
-		cur_out.execute(command, (vel, lat, lt, azm, dtm, rad))
-	    except Exception, e:
-		logging.error(e, exc_info=True)
-
-    # commit the change
-    try:
-	conn_out.commit()
-    except Exception, e:
-	logging.error(e, exc_info=True)
+    # build the index on the key columns
+    if defer_index:
+        build_key_index(conn_out, output_table, key_columns)
 
     # close db connections
-    conn_in.close()
     conn_out.close()
 
     return
 
 def build_superposed_master_table(output_table, df_events=None, half_interval_length=75,
-                                  imf_lagtime=15, ftype="fitacf", coords="mlt",
+                                  imf_lagtime=15, ftype="fitacf", coords="mlt", hemi="north",
                                   dbdir="../data/sqlite3/",
-                                  input_dbname=None, output_dbname=None):
+                                  input_dbname=None, output_dbname=None,
+                                  nprocs=None, batch_size=100000):
    
     """ combines all the gridded data (NOT median filtered) into
     one master table to do superposed epoch analysis. 
@@ -151,10 +135,17 @@ def build_superposed_master_table(output_table, df_events=None, half_interval_le
     coords : str
         Coordinates in which the binning process took place.
         Default to "mlt, can be "geo" as well. 
+    hemi : str
+        Hemisphere of the grids in which the data were binned.
     input_dbname : str, default to None
         Name of the sqlite db where xxx-min median data are stored.
     output_dbname : str, default to None
         Name of the master db
+    nprocs : int, default to None
+        Number of processes that read and explode the event windows.
+        Default to the number of CPUs. If set to 1 all is done in serial.
+    batch_size : int
+        Number of rows written by a single executemany
 
     Returns
     -------
@@ -169,16 +160,12 @@ def build_superposed_master_table(output_table, df_events=None, half_interval_le
         output_dbname = "sd_master_" + coords + "_" + ftype + ".sqlite"
     if df_events is None:
         df_events = build_event_database(IMF_turning="all", event_status="all")
+    if coords == "mlt":
+        coords_prefix = "mag"
+    elif coords == "geo":
+        coords_prefix = "geo"
 
-    # make a db connection 
-    try:
-        conn_in = sqlite3.connect(dbdir + input_dbname,
-                                  detect_types = sqlite3.PARSE_DECLTYPES)
-        cur_in = conn_in.cursor()
-    except Exception, e:
-        logging.error(e, exc_info=True)
-
-    # make a connection to master db
+    # make a connection to master db. This process is the only writer.
     try:
         conn_out = sqlite3.connect(dbdir + output_dbname,
                                    detect_types = sqlite3.PARSE_DECLTYPES)
@@ -188,113 +175,178 @@ def build_superposed_master_table(output_table, df_events=None, half_interval_le
 
     # create a table
     if coords == "mlt":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " mag_glatc float(7,2)," +\
-                  " mag_gltc float(8,2)," +\
-                  " mag_gazmc SMALLINT," +\
-                  " mag_bmazm REAL," +\
-                  " datetime DATETIME, " +\
-                  " relative_time REAL, " +\
-                  " rad VARCHAR(3), " +\
-                  " CONSTRAINT all_rads PRIMARY KEY (" +\
-                  "mag_glatc, mag_gltc, mag_gazmc, datetime, rad))"
+        bmazm_col = "mag_bmazm"
     elif coords == "geo":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " geo_glatc float(7,2)," +\
-                  " geo_gltc float(8,2)," +\
-                  " geo_gazmc SMALLINT," +\
-                  " bmazm REAL," +\
-                  " datetime DATETIME, " +\
-                  " relative_time REAL, " +\
-                  " rad VARCHAR(3), " +\
-                  " CONSTRAINT all_rads PRIMARY KEY (" +\
-                  "geo_glatc, geo_gltc, geo_gazmc, datetime, rad))"
-    command = command.format(tb=output_table)
+        bmazm_col = "bmazm"
+    command = "CREATE TABLE IF NOT EXISTS {tb}" +\
+              "(vel float(9,2)," +\
+              " {prefix}_glatc float(7,2)," +\
+              " {prefix}_gltc float(8,2)," +\
+              " {prefix}_gazmc SMALLINT," +\
+              " cell_id INTEGER," +\
+              " azm_id SMALLINT," +\
+              " {bmazm} REAL," +\
+              " datetime DATETIME, " +\
+              " relative_time REAL, " +\
+              " rad VARCHAR(3), " +\
+              " event_id INTEGER, " +\
+              " CONSTRAINT all_rads PRIMARY KEY (" +\
+              "cell_id, azm_id, datetime, rad))"
+    command = command.format(tb=output_table, prefix=coords_prefix, bmazm=bmazm_col)
     try:
         cur_out.execute(command)
     except Exception, e:
         logging.error(e, exc_info=True)
 
-    for i, df_row in df_events.iterrows():
+    # the event windows. An event is identified by its position in df_events.
+    events = []
+    for event_id, (i, df_row) in enumerate(df_events.iterrows()):
         imf_dtm = df_row.datetime.to_pydatetime()
         response_dtm = imf_dtm + dt.timedelta(seconds=60. * df_row.lag_time)
-        rad = df_row.rad
 
         # Build stm and etm
         lagged_imf_dtm = imf_dtm + dt.timedelta(seconds=60. * imf_lagtime)
         stm = lagged_imf_dtm - dt.timedelta(seconds=60. * half_interval_length)
         etm = lagged_imf_dtm + dt.timedelta(seconds=60. * half_interval_length)
-        if coords == "mlt":
-            command = "SELECT vel, mag_glatc, mag_gltc, mag_gazmc, mag_bmazm, " +\
-                      "datetime FROM {tb1} "+\
-                      "WHERE datetime BETWEEN '{stm}' AND '{etm}' "+\
-                      "ORDER By datetime ASC"
-        elif coords == "geo":
-            command = "SELECT vel, geo_glatc, geo_gltc, geo_gazmc, bmazm, " +\
-                      "datetime FROM {tb1} "+\
-                      "WHERE datetime BETWEEN '{stm}' AND '{etm}' "+\
-                      "ORDER By datetime ASC"
-        command = command.format(tb1=rad, stm=stm, etm=etm)
-
-        # fetch the data
-        try:
-            cur_in.execute(command)
-        except Exception, e:
-            logging.error(e, exc_info=True)
-        rows = cur_in.fetchall()
-
-        # insert the data into a table
-        if rows:
-            if coords == "mlt":
-                command = "INSERT OR IGNORE INTO {tb2} (vel, mag_glatc, mag_gltc, " +\
-                          "mag_gazmc, mag_bmazm, datetime, relative_time, rad) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
-            elif coords == "geo":
-                command = "INSERT OR IGNORE INTO {tb2} (vel, geo_glatc, geo_gltc, " +\
-                          "geo_gazmc, bmazm, datetime, relative_time, rad) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
-            command = command.format(tb2=output_table)
-            for rw in rows:
-                vels, lats, lts, azms, bmazm, dtm = rw
-                if vels:
-                    vels = json.loads(vels)
-                    lats = json.loads(lats)
-                    lts = json.loads(lts)
-                    azms = json.loads(azms)
-                    relative_time = int(round((dtm - response_dtm).total_seconds()/60.))
-                    
-                    for i in range(len(vels)):
-                        vel = vels[i]
-                        lat = lats[i]
-                        lt = lts[i]
-                        azm = azms[i]
-                        # insert the data
-                        try:
-                            cur_out.execute(command, (vel, lat, lt, azm, bmazm, dtm, relative_time, rad))
-                        except Exception, e:
-                            logging.error(e, exc_info=True)
-                else:
-                    continue
+        events.append((df_row.rad, stm, etm, response_dtm, event_id))
+
+    command = "INSERT OR IGNORE INTO {tb2} (vel, {prefix}_glatc, {prefix}_gltc, " +\
+              "{prefix}_gazmc, cell_id, azm_id, {bmazm}, datetime, relative_time, rad, " +\
+              "event_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    command = command.format(tb2=output_table, prefix=coords_prefix, bmazm=bmazm_col)
+
+    # the events are read and exploded in parallel (or in serial if nprocs
+    # is 1), and written here in the order of the events
+    args = [(ev, coords, hemi, dbdir + input_dbname) for ev in events]
+    if nprocs == 1:
+        results = itertools.imap(_explode_event, args)
+    else:
+        pool = mp.Pool(processes=nprocs)
+        results = pool.imap(_explode_event, args)
+
+    try:
+        for ev, rows in itertools.izip(events, results):
+            # insert the data into a table
+            for j in xrange(0, len(rows), batch_size):
+                try:
+                    cur_out.executemany(command, rows[j:j+batch_size])
+                except Exception, e:
+                    logging.error(e, exc_info=True)
 
             # commit the change
             try:
                 conn_out.commit()
             except Exception, e:
                 logging.error(e, exc_info=True)
-        print("Done with event ", df_row)
+            print("Done with event " + str(ev[:3]))
+    finally:
+        if nprocs != 1:
+            pool.close()
+            pool.join()
 
     # close db connections
-    conn_in.close()
     conn_out.close()
 
     return
 
-def master_summary(input_table, output_table, coords="mlt",
-                   db_name=None, dbdir="../data/sqlite3/"):
+def _explode_event(args):
+    """ reads the gridded data of an event window and explodes them into
+    gate-level rows of the superposed master table. Used as the target
+    of the process pool in build_superposed_master_table. """
+
+    (rad, stm, etm, response_dtm, event_id), coords, hemi, input_db = args
+    if coords == "mlt":
+        coords_prefix = "mag"
+        bmazm_col = "mag_bmazm"
+    elif coords == "geo":
+        coords_prefix = "geo"
+        bmazm_col = "bmazm"
+
+    conn = sqlite3.connect(input_db, detect_types = sqlite3.PARSE_DECLTYPES)
+    cur = conn.cursor()
+    command = "SELECT vel, {prefix}_glatc, {prefix}_gltc, {prefix}_gazmc, {bmazm}, " +\
+              "datetime FROM {tb1} "+\
+              "WHERE datetime BETWEEN ? AND ? "+\
+              "ORDER By datetime ASC"
+    command = command.format(tb1=rad, prefix=coords_prefix, bmazm=bmazm_col)
+
+    # fetch the data
+    rows = []
+    try:
+        cur.execute(command, (stm, etm))
+        rows = cur.fetchall()
+    except Exception, e:
+        logging.error(e, exc_info=True)
+    conn.close()
+
+    return explode_rows(rows, response_dtm, rad, hemi_grids(hemi),
+                        coords_prefix=coords_prefix, event_id=event_id)
+
+def explode_rows(rows, response_dtm, rad, grds, coords_prefix="mag", event_id=None):
+    """ turns beam-level rows of gridded data into gate-level rows.
+
+    Parameters
+    ----------
+    rows : list
+        (vel, glatc, gltc, gazmc, bmazm, datetime) rows, where the first
+        four are encoded arrays
+    response_dtm : datetime.datetime
+        The time of the response to an IMF turning. relative_time is the
+        time of a row relative to it, rounded to minutes.
+    rad : str
+    grds : grids object
+        The grids in which the data were binned
+    coords_prefix : str
+        "mag" or "geo"
+    event_id : int, default to None
+
+    Returns
+    -------
+    A list of (vel, glatc, gltc, gazmc, cell_id, azm_id, bmazm, datetime,
+    relative_time, rad, event_id) tuples, excluding the cells outside the grids.
+
+    """
+
+    rows = [x for x in rows if (x[0] is not None) and (None not in x[1:4])]
+    if not rows:
+        return []
+
+    # flat columns of all the gates
+    vels = [decode_array(x[0], "vel") for x in rows]
+    row_idx = np.repeat(np.arange(len(rows)), [len(x) for x in vels])
+    vels = np.round(np.concatenate(vels).astype(float), 2)
+    lats = np.concatenate([decode_array(x[1], coords_prefix + "_glatc") for x in rows])
+    lts = np.concatenate([decode_array(x[2], coords_prefix + "_gltc") for x in rows])
+    azms = np.concatenate([decode_array(x[3], coords_prefix + "_gazmc") for x in rows])
+    cell_ids, azm_ids = grds.encode_ids(lats, lts, azms)
+
+    # relative times in minutes, rounded half away from zero as round does
+    dtms = np.array([x[5] for x in rows], dtype="datetime64[us]")
+    mins = (dtms - np.datetime64(response_dtm, "us")) / np.timedelta64(60, "s")
+    reltms = (np.sign(mins) * np.floor(np.abs(mins) + 0.5)).astype(int)
+
+    # exclude the cells that fall outside the grids
+    valid = (cell_ids >= 0) & (azm_ids >= 0)
+    row_idx = row_idx[valid]
+    bmazms = [x[4] for x in rows]
+    row_dtms = [x[5] for x in rows]
+
+    return zip(vels[valid].tolist(), lats[valid].astype(float).tolist(),
+               lts[valid].astype(float).tolist(), azms[valid].astype(float).tolist(),
+               cell_ids[valid].tolist(), azm_ids[valid].tolist(),
+               [bmazms[k] for k in row_idx], [row_dtms[k] for k in row_idx],
+               reltms[row_idx].tolist(), [rad] * len(row_idx),
+               [event_id] * len(row_idx))
+
+def master_summary(input_table, output_table, coords="mlt", ftype="fitacf",
+                   hemi="north", db_name=None, dbdir="../data/sqlite3/",
+                   vel_clip=500.):
     
     """ stores the summay statistics of the data in master table into 
     a different table in the same database.
     Time and rad informatin are all lost at this point.
+    The master table is read in a single scan and the statistics of all
+    the (cell_id, azm_id) groups are calculated by group_stats.
 
     Parameters
     ----------
@@ -309,8 +361,12 @@ def master_summary(input_table, output_table, coords="mlt",
         name and path of the configuration file
     section: str, default to "midlat"
         section of database configuration
+    hemi : str
+        Hemisphere of the grids in which the data were binned.
     db_name : str, default to None
         Name of the master db
+    vel_clip : float
+        The |vel| limit of the values used for vel_std
 
     Returns
     -------
@@ -334,46 +390,33 @@ def master_summary(input_table, output_table, coords="mlt",
     except Exception, e:
         logging.error(e, exc_info=True)
 
-    # create a table
     if coords == "mlt":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel_mean float(9,2)," +\
-                  " vel_median float(9,2)," +\
-                  " vel_std float(9,2)," +\
-                  " vel_count INT," +\
-                  " mag_glatc float(7,2)," +\
-                  " mag_gltc float(8,2)," +\
-                  " mag_gazmc SMALLINT," +\
-                  " CONSTRAINT master_summary PRIMARY KEY (" +\
-                  "mag_glatc, mag_gltc, mag_gazmc))"
+        coords_prefix = "mag"
     elif coords == "geo":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel_mean float(9,2)," +\
-                  " vel_median float(9,2)," +\
-                  " vel_std float(9,2)," +\
-                  " vel_count INT," +\
-                  " geo_glatc float(7,2)," +\
-                  " geo_gltc float(8,2)," +\
-                  " geo_gazmc SMALLINT," +\
-                  " CONSTRAINT master_summary PRIMARY KEY (" +\
-                  "geo_glatc, geo_gltc, geo_gazmc))"
-    command = command.format(tb=output_table)
+        coords_prefix = "geo"
+
+    # create a table
+    command = "CREATE TABLE IF NOT EXISTS {tb}" +\
+              "(vel_mean float(9,2)," +\
+              " vel_median float(9,2)," +\
+              " vel_std float(9,2)," +\
+              " vel_count INT," +\
+              " {prefix}_glatc float(7,2)," +\
+              " {prefix}_gltc float(8,2)," +\
+              " {prefix}_gazmc SMALLINT," +\
+              " cell_id INTEGER," +\
+              " azm_id SMALLINT," +\
+              " CONSTRAINT master_summary PRIMARY KEY (" +\
+              "cell_id, azm_id))"
+    command = command.format(tb=output_table, prefix=coords_prefix)
     try:
         cur.execute(command)
     except Exception, e:
         logging.error(e, exc_info=True)
 
-    if coords == "mlt":
-	command = "SELECT AVG(vel), STD(vel), COUNT(vel), " +\
-                  "mag_glatc, mag_gltc, mag_gazmc " +\
-		  "FROM {tb1} GROUP BY mag_glatc, mag_gltc, mag_gazmc"
-    elif coords == "geo":
-	command = "SELECT AVG(vel), STD(vel), COUNT(vel), " +\
-                  "geo_glatc, geo_gltc, geo_gazmc " +\
-		  "FROM {tb1} GROUP BY geo_glatc, geo_gltc, geo_gazmc"
+    # read the master table in a single scan
+    command = "SELECT vel, cell_id, azm_id FROM {tb1} WHERE cell_id >= 0"
     command = command.format(tb1=input_table)
-
-    # fetch the data
     try:
 	cur.execute(command)
     except Exception, e:
@@ -382,48 +425,33 @@ def master_summary(input_table, output_table, coords="mlt",
 
     # insert the data into a table
     if rows:
-	if coords == "mlt":
-	    command = "INSERT OR IGNORE INTO {tb2} (vel_mean, vel_median, vel_std, vel_count, " +\
-                      "mag_glatc, mag_gltc, mag_gazmc) " +\
-                      "VALUES (?, ?, ?, ?, ?, ?)"
-	elif coords == "geo":
-	    command = "INSERT OR IGNORE INTO {tb2} (vel_mean, vel_median, vel_std, vel_count, " +\
-                      "geo_glatc, geo_gltc, geo_gazmc) " +\
-                      "VALUES (?, ?, ?, ?, ?, ?)"
-	command = command.format(tb2=output_table)
-	for rw in rows:
-            vel_mean, vel_std, vel_count, lat, lt, azm = rw
-
-            # find median and std
-            if coords == "mlt":
-                command_tmp = "SELECT vel FROM {tb1} " +\
-                              "WHERE mag_glatc={lat} and mag_gltc={lt} and "+\
-                              "mag_gazmc={azm}"
-            elif coords == "geo":
-                command_tmp = "SELECT vel FROM {tb1} " +\
-                              "WHERE geo_glatc={lat} and geo_gltc={lt} and "+\
-                              "geo_gazmc={azm}"
-            command_tmp = command_tmp.format(tb1=input_table, lat=lat, lt=lt,
-                                             azm=azm)
-            try:
-                cur.execute(command_tmp)
-            except Exception, e:
-                logging.error(e, exc_info=True)
-
-            vels_tmp = cur.fetchall()
-            vels_tmp = [x[0] for x in vels_tmp]
-            vel_median = np.median(vels_tmp)
-            vel_std = np.std([x for x in vels_tmp if np.abs(x) < 500.])
-            if np.isnan(vel_std):
-                vel_std = 500.
-
-	    # insert the data
-	    try:
-		cur.execute(command,
-                            (round(vel_mean,2), round(vel_median,2), round(vel_std,2),
-                             vel_count, lat, lt, azm))
-	    except Exception, e:
-		logging.error(e, exc_info=True)
+        vels = np.array([x[0] for x in rows], dtype=float)
+        cell_ids = np.array([x[1] for x in rows], dtype=np.int64)
+        azm_ids = np.array([x[2] for x in rows], dtype=np.int64)
+        rows = None
+
+        # group by (cell_id, azm_id)
+        grds = hemi_grids(hemi)
+        nazms = len(grds.center_azms)
+        keys, vel_mean, vel_median, vel_std, vel_count = \
+                group_stats(cell_ids * nazms + azm_ids, vels, vel_clip=vel_clip)
+        cell_ids = keys // nazms
+        azm_ids = keys % nazms
+        lats, lts = grds.decode_cell_ids(cell_ids)
+        azms = grds.decode_azm_ids(azm_ids)
+
+        command = "INSERT OR IGNORE INTO {tb2} (vel_mean, vel_median, vel_std, vel_count, " +\
+                  "{prefix}_glatc, {prefix}_gltc, {prefix}_gazmc, cell_id, azm_id) " +\
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        command = command.format(tb2=output_table, prefix=coords_prefix)
+        params = zip(np.round(vel_mean, 2).tolist(), np.round(vel_median, 2).tolist(),
+                     np.round(vel_std, 2).tolist(), vel_count.tolist(),
+                     np.round(lats, 2).tolist(), np.round(lts, 2).tolist(),
+                     azms.astype(int).tolist(), cell_ids.tolist(), azm_ids.tolist())
+        try:
+            cur.executemany(command, params)
+        except Exception, e:
+            logging.error(e, exc_info=True)
 
     # commit the change
     try:
@@ -436,6 +464,46 @@ def master_summary(input_table, output_table, coords="mlt",
 
     return
 
+def group_stats(keys, vels, vel_clip=500.):
+    """ calculates the statistics of vels grouped by keys, in one sort.
+
+    Parameters
+    ----------
+    keys : np.array of int
+        Group key of each value, e.g., cell_id * number of azm bins + azm_id
+    vels : np.array
+    vel_clip : float
+        vel_std only uses the values with |vel| < vel_clip. It is set to
+        vel_clip for the groups that have no such value.
+
+    Returns
+    -------
+    keys, vel_mean, vel_median, vel_std, vel_count : np.arrays
+        One entry per group, sorted by key
+
+    """
+
+    # sort by key, then by vel within each key
+    order = np.lexsort((vels, keys))
+    keys = keys[order]
+    vels = vels[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+
+    vel_mean = np.add.reduceat(vels, starts) / counts
+    vel_median = (vels[starts + (counts - 1) // 2] + vels[starts + counts // 2]) / 2.
+
+    # std of the values within vel_clip
+    inside = np.abs(vels) < vel_clip
+    ninside = np.add.reduceat(inside.astype(int), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        clip_mean = np.add.reduceat(np.where(inside, vels, 0.), starts) / ninside
+        dev = np.where(inside, vels - np.repeat(clip_mean, counts), 0.)
+        vel_std = np.sqrt(np.add.reduceat(dev**2, starts) / ninside)
+    vel_std[ninside == 0] = vel_clip
+
+    return keys[starts], vel_mean, vel_median, vel_std, counts
+
 def main(master_table=True, superposed_master_table=False, master_summary_table=True):
 
     # input parameters
@@ -0,0 +1,154 @@
+"""
+Set-based bulk UPDATE of the per-beam rows of a db table.
+
+Instead of issuing one UPDATE per row, the new values are written into a
+temporary staging table with executemany and then applied to the target
+table with a single UPDATE per time chunk, keyed on (datetime, bmnum).
+Each chunk is committed as soon as it is applied, so the write lock of the
+db is not held while the rows of the next chunk are computed, and the
+writers of different shards of a db can interleave.
+"""
+
+import sqlite3
+
+# UPDATE ... FROM is available since SQLite 3.33.0
+_HAS_UPDATE_FROM = sqlite3.sqlite_version_info >= (3, 33, 0)
+
+class bulk_updater(object):
+    """ Collects the new values of some columns of a table and applies
+    them in bulk.
+
+    Parameters
+    ----------
+    conn : sqlite3.connect
+    table_name : str
+        The table to be updated
+    columns : list
+        The columns to be updated
+    keys : tuple
+        The columns that identify a row. Default to ("datetime", "bmnum"),
+        the primary key of the LOS data tables.
+    chunk_size : int
+        Number of rows staged before they are applied to table_name
+    commit : bool
+        If True (default), conn is committed after each chunk is applied.
+
+    Example
+    -------
+    updater = bulk_updater(conn, "bks", ["geo_latc", "geo_lonc"])
+    for ...:
+        updater.add((latc, lonc), (date_time, bmnum))
+    updater.close()
+
+    """
+
+    def __init__(self, conn, table_name, columns, keys=("datetime", "bmnum"),
+                 chunk_size=5000, commit=True):
+
+        self.conn = conn
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.keys = list(keys)
+        self.chunk_size = chunk_size
+        self.commit = commit
+        self.stage_name = "stage_" + table_name
+        self.nrows = 0
+        self._rows = []
+
+        cur = self.conn.cursor()
+        cur.execute("DROP TABLE IF EXISTS temp.{st}".format(st=self.stage_name))
+        command = "CREATE TEMP TABLE {st} ({keys}, {cols}, PRIMARY KEY({pk}))"
+        command = command.format(st=self.stage_name,
+                                 keys=", ".join([_key_def(x) for x in self.keys]),
+                                 cols=", ".join(self.columns),
+                                 pk=", ".join(self.keys))
+        cur.execute(command)
+
+        self._command_insert = "INSERT OR REPLACE INTO temp.{st} ({cols}) VALUES ({qs})"
+        self._command_insert = self._command_insert.format(
+            st=self.stage_name, cols=", ".join(self.keys + self.columns),
+            qs=", ".join(["?"] * (len(self.keys) + len(self.columns))))
+        self._command_update = _update_command(self.table_name, self.stage_name,
+                                               self.columns, self.keys)
+
+    def add(self, values, key):
+        """ stages the new values of a row.
+
+        Parameters
+        ----------
+        values : tuple
+            The new values, in the order of self.columns
+        key : tuple
+            The key values of the row, in the order of self.keys
+        """
+
+        self._rows.append(tuple(key) + tuple(values))
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+
+        return
+
+    def flush(self):
+        """ applies the staged rows to self.table_name, and commits if
+        self.commit is True. Errors (e.g., "database is locked") are
+        raised to the caller. """
+
+        if not self._rows:
+            return
+
+        cur = self.conn.cursor()
+        cur.executemany(self._command_insert, self._rows)
+
+        # limit the update to the time range of the chunk so that only
+        # the rows of the chunk are scanned
+        if "datetime" in self.keys:
+            i = self.keys.index("datetime")
+            tms = [x[i] for x in self._rows]
+            cur.execute(self._command_update, (min(tms), max(tms)))
+        else:
+            cur.execute(self._command_update)
+
+        cur.execute("DELETE FROM temp.{st}".format(st=self.stage_name))
+        if self.commit:
+            self.conn.commit()
+        self.nrows += len(self._rows)
+        self._rows = []
+
+        return
+
+    def close(self):
+        """ applies the remaining staged rows and drops the staging table """
+
+        self.flush()
+        self.conn.execute("DROP TABLE IF EXISTS temp.{st}".format(st=self.stage_name))
+
+        return
+
+def _key_def(key):
+    if key == "datetime":
+        return "datetime TIMESTAMP"
+    return key
+
+def _update_command(table_name, stage_name, columns, keys):
+    """ creates the UPDATE statement that copies columns from the staging
+    table into table_name """
+
+    time_range = ""
+    if "datetime" in keys:
+        time_range = "{tb}.datetime BETWEEN ? AND ? AND "
+
+    if _HAS_UPDATE_FROM:
+        command = "UPDATE {tb} SET " +\
+                  ", ".join([x + "=s." + x for x in columns]) +\
+                  " FROM temp.{st} AS s WHERE " + time_range +\
+                  " AND ".join(["{tb}." + x + "=s." + x for x in keys])
+    else:
+        # correlated subqueries on the primary key of the staging table
+        match = " AND ".join(["s." + x + "={tb}." + x for x in keys])
+        command = "UPDATE {tb} SET " +\
+                  ", ".join([x + "=(SELECT s." + x + " FROM temp.{st} AS s WHERE " +\
+                             match + ")" for x in columns]) +\
+                  " WHERE " + time_range +\
+                  "EXISTS (SELECT 1 FROM temp.{st} AS s WHERE " + match + ")"
+
+    return command.format(tb=table_name, st=stage_name)
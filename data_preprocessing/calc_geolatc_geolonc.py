@@ -9,11 +9,13 @@ from davitpy.utils.coordUtils import coord_conv
 
 import pdb
 
+from hdw_catalog import rad_id_dict, get_catalog, load_catalog
 
 class latc_lonc_to_db(object):
 
     def __init__(self, rad, stm, etm, ftype="fitacf",
-		 dbdir="../data/sqlite3/", db_name=None):
+		 dbdir="../data/sqlite3/", db_name=None,
+                 fov_dbname=None):
 
         """ calculates the center points of range-beam cells of a given radar
         in geo coords and add them into the same db.
@@ -28,12 +30,13 @@ class latc_lonc_to_db(object):
             The end time. 
         ftype : str
             SuperDARN file type 
+        fov_dbname : str, default to None
+            Name of the sqlite db built by fov_geometry.build_fov_geometry.
+            If set, the FOV geometry is loaded from it instead of being
+            recomputed. 
 
         """ 
 
-        rad_id_dict = {"bks":33, "wal":32, "cve":207, "cvw":206,
-                       "fhe":205, "fhw":204, "ade":209, "adw":208,
-                       "hok":40, "hkw":41, "tig":14, "unw":18, "bpk":24 }
         self.rad = rad
         self.rad_id = rad_id_dict[rad]
         self.stm = stm
@@ -54,6 +57,15 @@ class latc_lonc_to_db(object):
         else:    
             self.table_name = None
 
+        # cache of the center lats and lons of range gates, shared by all
+        # the rows of self.rad
+        if fov_dbname is None:
+            store = None
+        else:
+            from fov_geometry import fov_geometry_store
+            store = fov_geometry_store(rad, fov_dbname=fov_dbname, dbdir=dbdir)
+        self.fov_cache = latc_lonc_cache(maxsize=1024, store=store)
+
     def _create_dbconn(self):
 
 	""" creates a db connection
@@ -66,7 +78,7 @@ class latc_lonc_to_db(object):
 	"""
 	import sqlite3
         # make a db connection
-        conn = sqlite3.connect(self.dbdir + self.db_name,
+        conn = sqlite3.connect(self.dbdir + self.db_name, timeout=600.,
 			       detect_types = sqlite3.PARSE_DECLTYPES)
 
         return conn
@@ -76,43 +88,23 @@ class latc_lonc_to_db(object):
         """ creats a list of sites for a given self.rad for the period between
         self.stm and self.etm """
 
-        import sqlite3
-
-        # create a sqlite3 db connection to the radar.sqlite3
-        conn = sqlite3.connect(database="../data/sqlite3/radars.sqlite",
-                               detect_types = sqlite3.PARSE_DECLTYPES)
-        cur = conn.cursor()
-
-        # select all the datetime values (tval) later than stm
-        command = "SELECT tval FROM hdw WHERE id=? "
-        command = '{:s}and tval>=? ORDER BY tval ASC'.format(command)
-        cur.execute(command, (self.rad_id, self.stm))
-        tvals_stm = cur.fetchall()
-        tvals_stm = [x[0] for x in tvals_stm]
-
-        # select all the datetime values (tval) later than etm
-        command = "SELECT tval FROM hdw WHERE id=? "
-        command = '{:s}and tval>=? ORDER BY tval ASC'.format(command)
-        cur.execute(command, (self.rad_id, self.etm))
-        tval_etm = cur.fetchone()[0]
-        indx_etm = tvals_stm.index(tval_etm)
-
-        # select the tvals of interest
-        tvals = tvals_stm[:indx_etm+1]
-
-        site_list = []
-        for tval in tvals:
-            site_list.append(site(code=self.rad, dt=tval))
-        return site_list
+        return site_list(self.rad, self.stm, self.etm)
 
-
-    def add_latclonc_to_db(self):
+    def add_latclonc_to_db(self, chunk_size=5000):
         """ calculates latc and lonc of each range-beam cell in 'geo'
         coordinates and update them into a newly copied table.
-        If self.table_name does not exist in the db, it will not do anything"""
+        If self.table_name does not exist in the db, it will not do anything
+
+        Parameters
+        ----------
+        chunk_size : int
+            Maximum number of rows written to the db by a single UPDATE
+        """
 
         import logging
-	import json
+        import numpy as np
+        from array_codec import encode_array, decode_array
+        from bulk_update import bulk_updater
 
         if self.table_name is None:
             # close db connection
@@ -134,6 +126,11 @@ class latc_lonc_to_db(object):
             # pass if the column geo_lonc exists
             pass
 
+        # the results are written in bulk through a staging table
+        updater = bulk_updater(self.conn, self.table_name,
+                               ["slist", "vel", "geo_latc", "geo_lonc"],
+                               chunk_size=chunk_size)
+
         # iterate through tvals of the self.sites
         sdtm = self.stm
         for ii, st in enumerate(self.sites):
@@ -156,53 +153,115 @@ class latc_lonc_to_db(object):
                 # loop through rows 
                 for row in rows:
                     slist, vel, bmnum, frang, rsep, date_time = row
-		    # calculate latc_all and lonc_all in 'geo' coords
-		    latc_all, lonc_all = calc_latc_lonc(self.sites[ii],
-							bmnum, frang, rsep, 
-							altitude=300., elevation=None,
-							date_time=None)
-                        
-		    vel = json.loads(vel)
-		    slist = json.loads(slist)
+                    # calculate latc_all and lonc_all in 'geo' coords
+                    latc_all, lonc_all = self.fov_cache.get(self.sites[ii],
+                                                            bmnum, frang, rsep,
+                                                            altitude=300.)
+
+                    vel = decode_array(vel, "vel")
+                    slist = decode_array(slist, "slist")
 
                     # exclude the slist values beyond maxgate and their correspinding velocities
-                    vel = [vel[i] for i in range(len(vel)) if slist[i] < st.maxgate]
-                    slist = [s for s in slist if s < st.maxgate]
+                    vel = vel[slist < st.maxgate]
+                    slist = slist[slist < st.maxgate]
 
                     # extract latc and lonc values
-                    latc = [round(latc_all[s],2) for s in slist]
-                    lonc = [round(lonc_all[s], 2) for s in slist]
-
-                    # convert to comma seperated text
-		    slist = json.dumps(slist)
-		    vel = json.dumps(vel)
-		    latc = json.dumps(latc)
-		    lonc = json.dumps(lonc)
-
-                    # update the table
-                    command = "UPDATE {tb} SET slist='{slist}', vel='{vel}', " +\
-                              "geo_latc='{latc}', geo_lonc='{lonc}' WHERE datetime = '{dtm}'"
-                    command = command.format(tb=self.table_name, slist=slist, vel=vel,\
-                                             latc=latc, lonc=lonc, dtm=date_time)
-                    try:
-                        cur.execute(command)
-                    except Exception, e:
-                        logging.error(e, exc_info=True)
+                    latc = np.round(latc_all[slist], 2)
+                    lonc = np.round(lonc_all[slist], 2)
+
+                    # encode the arrays
+                    slist = encode_array(slist, "slist")
+                    vel = encode_array(vel, "vel")
+                    latc = encode_array(latc, "geo_latc")
+                    lonc = encode_array(lonc, "geo_lonc")
+
+                    # stage the new values
+                    updater.add((slist, vel, latc, lonc), (date_time, bmnum))
+
+                # update the table once for the rows of the current hdw epoch
+                # and commit. Write errors (e.g., "database is locked" after
+                # the timeout) are raised, so that a unit fails instead of
+                # silently losing its rows.
+                updater.flush()
 
             # update sdtm
             sdtm = edtm
 
-        # commit the data into the db
-        try:
-            self.conn.commit()
-        except Exception, e:
-            logging.error(e, exc_info=True)
+        updater.close()
 
         # close db connection
         self.conn.close()
+        print("FOV cache for " + self.rad + ": " + str(self.fov_cache.hits) +\
+              " hits, " + str(self.fov_cache.misses) + " misses")
             
         return
 
+def site_list(rad, stm, etm, hdw_db="../data/sqlite3/radars.sqlite"):
+
+    """ creats a list of sites (one per hdw epoch) for a given rad
+    for the period between stm and etm. The sites are looked up in the
+    in-memory hdw catalog (see hdw_catalog.py). """
+
+    return get_catalog(hdw_db).site_list(rad, stm, etm)
+
+class latc_lonc_cache(object):
+    """ A bounded LRU cache of the center lats and lons of range gates
+    calculated by calc_latc_lonc. The result only depends on the site
+    (i.e., the hardware epoch of a radar), bmnum, frang, rsep and altitude.
+
+    Attributes
+    ----------
+    maxsize : int
+        Maximum number of entries kept in the cache
+    store : fov_geometry.fov_geometry_store or None
+        Precomputed FOV geometry looked up before calling calc_latc_lonc
+    hits : int
+        Number of calls served from the cache
+    misses : int
+        Number of calls that run calc_latc_lonc
+    """
+
+    def __init__(self, maxsize=1024, store=None):
+
+        from collections import OrderedDict
+
+        self.maxsize = maxsize
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def get(self, site, bmnum, frang, rsep, altitude=300.):
+        """ returns the same values as calc_latc_lonc, from the
+        cache if available.
+        NOTE: The returned arrays are shared, do not modify them in place.
+        """
+
+        # tval identifies the hardware epoch of a radar. The site location
+        # and boresite are added so that a cache can be shared by radars.
+        key = (site.tval, site.geolat, site.geolon, site.boresite,
+               bmnum, frang, rsep, altitude)
+        try:
+            val = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            val = None
+            if self.store is not None:
+                val = self.store.get_centers(site, bmnum, frang, rsep,
+                                             altitude=altitude)
+            if val is None:
+                val = calc_latc_lonc(site, bmnum, frang, rsep, altitude=altitude,
+                                     elevation=None, date_time=None)
+            self.misses += 1
+            if len(self._cache) >= self.maxsize:
+                # remove the least recently used entry
+                self._cache.popitem(last=False)
+
+        # move the entry to the most recently used end
+        self._cache[key] = val
+
+        return val
+
 def calc_latc_lonc(site, bmnum, frang, rsep, altitude=300.,
                    elevation=None,
                    date_time=None):
@@ -222,61 +281,275 @@ def calc_latc_lonc(site, bmnum, frang, rsep, altitude=300.,
         Default to 300. [km]
     elevation : float
         Defalut to None, in which case it will be estimated by the algorithm.
+        NOTE: only elevation=None is supported by the vectorized projection.
     date_time : datetime.datetime
         the datetime for which the FOV is desired. Required for mag and mlt,
         and possibly others in the future. Default: None
 
     Returns
     -------
-    two lists
+    two np.arrays
         Calculated center latitudes and longitudes of range gates of a given beam
     
+    """
+
+    if elevation is not None:
+        raise ValueError("calc_latc_lonc only supports elevation=None")
+
+    lat_center, lon_center = calc_fov_latc_lonc(site, frang, rsep,
+                                                altitude=altitude,
+                                                bmnums=[bmnum], center=True)
+
+    return lat_center[0], lon_center[0]
+
+def calc_fov_latc_lonc(site, frang, rsep, altitude=300., bmnums=None,
+                       center=True):
+
+    """ calculates lat and lon of all the range-gates of all the beams of a
+    radar at once.
+
+    Parameters
+    ----------
+    site : davitpy.pydarn.radar.radStruct.site object
+    frang : int 
+        Distance at which the zero range-gate starts [km]
+    rsep : int
+        Range seperation [km]
+    altitude : float
+        Default to 300. [km]
+    bmnums : list, default to None
+        Beams of interest. Default to all the beams of site.
+    center : bool
+        If True, the centers of the range gates are calculated. Otherwise, the
+        edges of the range gates along the left edge of each beam (the same as
+        latFull and lonFull of davitpy's radFov.fov) are calculated.
+
+    Returns
+    -------
+    two np.arrays of shape (len(bmnums), site.maxgate), or
+    (len(bmnums), site.maxgate+1) if center is False.
+
     """
     import numpy as np
 
-    # initialze papameters
-    nbeams = site.maxbeam
-    ngates = site.maxgate
-    bmsep = site.bmsep
-    recrise = site.recrise
-    siteLat = site.geolat
-    siteLon = site.geolon
-    siteAlt = site.alt
-    siteBore = site.boresite
-    gates = np.arange(ngates)
+    if bmnums is None:
+        bmnums = np.arange(site.maxbeam)
+    bmnums = np.asarray(bmnums, dtype="float")
 
-    # Create output arrays
-    lat_center = np.zeros(ngates, dtype='float')
-    lon_center = np.zeros(ngates, dtype='float')
+    # Calculate deviation from boresight for each beam
+    if center:
+        gates = np.arange(site.maxgate)
+        boff = site.bmsep * (bmnums - (site.maxbeam - 1) / 2.0)
+    else:
+        gates = np.arange(site.maxgate + 1)
+        boff = site.bmsep * (bmnums - site.maxbeam / 2.0)
 
-    # Calculate deviation from boresight for center of beam
-    boff_center = bmsep * (bmnum - (nbeams - 1) / 2.0)
+    # Calculate slant range of each gate
+    srang = slantRange(frang, rsep, site.recrise, gates, center=center)
 
-    # Calculate center slant range
-    srang_center = slantRange(frang, rsep, recrise,
-                              gates, center=True)
+    return calc_field_pnt(site.geolat, site.geolon, site.alt * 1e-3,
+                          site.boresite, boff[:, np.newaxis],
+                          srang[np.newaxis, :], altitude=altitude,
+                          fov_dir="front")
 
-    # Calculate coordinates for Center of the current beam
-    for ig in gates:
-        talt = altitude
-        telv = elevation
+# WGS84 ellipsoid, the same as the one used by davitpy.utils.geoPack
+_WGS84_A = 6378.137
+_WGS84_B = _WGS84_A * (1. - 1. / 298.257223563)
 
-        # calculate projections
-        latc, lonc = calcFieldPnt(siteLat, siteLon, siteAlt * 1e-3,
-                                  siteBore, boff_center,
-                                  srang_center[ig], elevation=telv,
-                                  altitude=talt, model="IS",
-                                  fov_dir="front")
+def _geod_to_geoc(lat, inverse=False):
+    """ vectorized version of davitpy.utils.geoPack.geodToGeoc.
+    Converts geodetic lat to geocentric lat (or the inverse) and returns
+    the converted lat and the Earth radius [km] at that point """
 
-        # Save into output arrays
-        lat_center[ig] = latc
-        lon_center[ig] = lonc
+    import numpy as np
 
-    return lat_center, lon_center
+    ab2 = (_WGS84_A / _WGS84_B)**2
+    if inverse:
+        lat_gc = lat
+        lat_out = np.degrees(np.arctan(ab2 * np.tan(np.radians(lat))))
+    else:
+        lat_out = np.degrees(np.arctan(np.tan(np.radians(lat)) / ab2))
+        lat_gc = lat_out
+    re = _WGS84_A / np.sqrt(1. + (ab2 - 1.) * np.sin(np.radians(lat_gc))**2)
+
+    return lat_out, re
+
+def _calc_az_off_bore(elevation, boff_zero, fov_dir="front"):
+    """ vectorized version of davitpy.pydarn.radar.radFov.calcAzOffBore """
+
+    import numpy as np
+
+    # Test to see where the true beam direction lies
+    bdir = np.cos(np.radians(boff_zero))**2 - np.sin(np.radians(elevation))**2
+
+    # Calculate the front fov azimuthal angle off the boresite
+    with np.errstate(invalid="ignore", divide="ignore"):
+        boff = np.where(bdir < 0.0, np.pi / 2.0,
+                        np.arctan(np.sqrt(np.sin(np.radians(boff_zero))**2 / bdir)))
+    boff = np.where(boff_zero < 0.0, -boff, boff)
+
+    # If the rear fov is desired, find the azimuth
+    if fov_dir == "back":
+        boff = np.sign(boff_zero) * (np.pi - np.abs(boff))
+
+    return np.degrees(boff)
+
+def calc_field_pnt(tr_glat, tr_glon, tr_alt, boresight, beam_off, slant_range,
+                   altitude=300., fov_dir="front", max_iter=11):
+
+    """ vectorized version of davitpy's calcFieldPnt with model="IS" and
+    elevation=None. beam_off and slant_range are broadcast against each
+    other, so all the gates of all the beams are projected at once.
+
+    Parameters
+    ----------
+    tr_glat, tr_glon : float
+        Geodetic lat and lon of the radar [deg]
+    tr_alt : float
+        Altitude of the radar [km]
+    boresight : float
+        Boresight of the radar [deg]
+    beam_off : np.array
+        Beam deviation from the boresight [deg]
+    slant_range : np.array
+        Slant range [km]
+    altitude : float
+        Default to 300. [km]
+    fov_dir : str
+        "front" or "back"
+    max_iter : int
+        Maximum number of iterations on the elevation angle. Same as
+        the one in calcFieldPnt.
+
+    Returns
+    -------
+    two np.arrays
+        Geodetic lat and lon of the field points
+
+    """
+
+    import numpy as np
+
+    beam_off, slant_range = np.broadcast_arrays(np.asarray(beam_off, dtype="float"),
+                                                np.asarray(slant_range, dtype="float"))
+    shape = beam_off.shape
+    boff_zero = beam_off.ravel()
+    srang = slant_range.ravel()
+
+    # Standard virtual height model for ionospheric scatter
+    xalt = np.ones(srang.shape) * altitude
+    if altitude > 150.:
+        xalt[srang <= 600.] = 115.
+        idx = (srang > 600.) & (srang <= 800.)
+        xalt[idx] = 115. + (srang[idx] - 600.) / 200. * (altitude - 115.)
+
+    # Geocentric position of the radar
+    gc_lat, tr_rad = _geod_to_geoc(tr_glat)
+    r0 = tr_rad + tr_alt
+    slat, clat = np.sin(np.radians(gc_lat)), np.cos(np.radians(gc_lat))
+    slon, clon = np.sin(np.radians(tr_glon)), np.cos(np.radians(tr_glon))
+    origin = r0 * np.array([clat * clon, clat * slon, slat])
+    # local east, north and up unit vectors at the radar
+    east = np.array([-slon, clon, 0.])
+    north = np.array([-slat * clon, -slat * slon, clat])
+    up = np.array([clat * clon, clat * slon, slat])
+    # angle between the geodetic and geocentric verticals
+    sdel = np.sin(np.radians(tr_glat - gc_lat))
+    cdel = np.cos(np.radians(tr_glat - gc_lat))
+
+    lat = np.zeros(srang.shape) * np.nan
+    lon = np.zeros(srang.shape) * np.nan
+    rad_pos = np.ones(srang.shape) * tr_rad
+
+    # Iterate until the altitude corresponding to the calculated elevation
+    # matches the desired altitude. Only the points that have not
+    # converged yet are updated.
+    todo = np.arange(len(srang))
+    for n in range(max_iter):
+        sr = srang[todo]
+        xa = xalt[todo]
+
+        with np.errstate(invalid="ignore"):
+            # pointing elevation (spherical Earth value) [degree]
+            tel = np.degrees(np.arcsin(((rad_pos[todo] + xa)**2 - r0**2 - sr**2) /\
+                                       (2. * r0 * sr)))
+        # pointing azimuth
+        taz = boresight + _calc_az_off_bore(tel, boff_zero[todo], fov_dir=fov_dir)
+
+        # pointing direction in geodetic local cartesian coords
+        kx = np.cos(np.radians(tel)) * np.sin(np.radians(taz))
+        ky = np.cos(np.radians(tel)) * np.cos(np.radians(taz))
+        kz = np.sin(np.radians(tel))
+        # rotate to geocentric local cartesian coords
+        ky, kz = ky * cdel + kz * sdel, -ky * sdel + kz * cdel
+
+        # position of the field point in global cartesian coords
+        pos = origin[:, np.newaxis] + sr * (kx * east[:, np.newaxis] +\
+                                            ky * north[:, np.newaxis] +\
+                                            kz * up[:, np.newaxis])
+        frad = np.sqrt((pos**2).sum(axis=0))
+        with np.errstate(invalid="ignore"):
+            flat = np.degrees(np.arcsin(pos[2] / frad))
+        flon = np.degrees(np.arctan2(pos[1], pos[0]))
+        flat, fre = _geod_to_geoc(flat, inverse=True)
+
+        lat[todo] = flat
+        lon[todo] = flon
+        rad_pos[todo] = fre
+
+        # stop if the altitude is what we want it to be (or close enough)
+        with np.errstate(invalid="ignore"):
+            done = np.abs(xa - (frad - fre)) <= 0.5
+        todo = todo[~done]
+        if len(todo) == 0:
+            break
+
+    return lat.reshape(shape), lon.reshape(shape)
+
+def check_field_pnt(site, frang, rsep, altitude=300., center=True):
+
+    """ checks calc_fov_latc_lonc against davitpy's calcFieldPnt for all the
+    range-gates of all the beams of a radar.
+
+    Returns
+    -------
+    The maximum absolute differences in lat and lon [deg]
+
+    """
+
+    import numpy as np
+
+    lat, lon = calc_fov_latc_lonc(site, frang, rsep, altitude=altitude,
+                                  center=center)
+    if center:
+        boff = site.bmsep * (np.arange(site.maxbeam) - (site.maxbeam - 1) / 2.0)
+    else:
+        boff = site.bmsep * (np.arange(site.maxbeam) - site.maxbeam / 2.0)
+    srang = slantRange(frang, rsep, site.recrise, np.arange(lat.shape[1]),
+                       center=center)
+
+    lat_ref = np.zeros(lat.shape)
+    lon_ref = np.zeros(lon.shape)
+    for ib in range(lat.shape[0]):
+        for ig in range(lat.shape[1]):
+            lat_ref[ib, ig], lon_ref[ib, ig] = \
+                calcFieldPnt(site.geolat, site.geolon, site.alt * 1e-3,
+                             site.boresite, boff[ib], srang[ig],
+                             elevation=None, altitude=altitude,
+                             model="IS", fov_dir="front")
+
+    dlat = np.abs(lat - lat_ref)
+    dlon = np.abs((lon - lon_ref + 180.) % 360. - 180.)
+    # both methods should give NaN for the same gates
+    if not np.array_equal(np.isnan(dlat), np.isnan(lat_ref)):
+        raise ValueError("calc_fov_latc_lonc and calcFieldPnt disagree on NaN gates")
+
+    return np.nanmax(dlat), np.nanmax(dlon)
 
 
 def worker(rad, stm, etm, ftype="fitacf", 
-   	   dbdir="../data/sqlite3/", db_name=None):
+   	   dbdir="../data/sqlite3/", db_name=None,
+           fov_dbname=None):
 
     import datetime as dt
     import sys
@@ -286,7 +559,8 @@ def worker(rad, stm, etm, ftype="fitacf",
     print("creating an latc_lonc_to_db object for " + \
           rad + " for period between " + str(stm) + " and " + str(etm))
     obj = latc_lonc_to_db(rad, stm, etm, ftype=ftype,
-			  dbdir=dbdir, db_name=db_name)
+			  dbdir=dbdir, db_name=db_name,
+                          fov_dbname=fov_dbname)
 
     # calculate geolatc and geolonc and write them into a db
     obj.add_latclonc_to_db()
@@ -300,13 +574,14 @@ def worker(rad, stm, etm, ftype="fitacf",
     
     return
 
-def main(run_in_parallel=True):
+def main(run_in_parallel=True, chunk_minutes=None):
     """ Call the functions above. Acts as an example code.
     Multiprocessing has been implemented to do parallel computing.
-    A unit process is for a radar (i.e. a db table)"""
+    A unit process is for a radar (i.e. a db table), or for a time shard
+    of a radar if chunk_minutes is set."""
 
     import datetime as dt
-    import multiprocessing as mp
+    from unit_scheduler import run_sharded
     from shutil import copyfile 
     import logging
     import os
@@ -335,27 +610,14 @@ def main(run_in_parallel=True):
 #    if not os.path.isfile(dbdir + db_name):
 #        copyfile(dbdir + old_dbname, dbdir + db_name)
 
-    # loop through the rads
-    # store the multiprocess
-    procs = []
-    for rad in rad_list:
-	if run_in_parallel:
-	    # cteate a process
-	    worker_kwargs = {"ftype":ftype, "db_name":db_name, "dbdir":dbdir}
-	    p = mp.Process(target=worker, args=(rad, stm, etm),
-			   kwargs=worker_kwargs)
-	    procs.append(p)
-
-	    # run the process
-	    p.start()
-
-	else:
-	    worker(rad, stm, etm, ftype=ftype, dbdir=dbdir, db_name=db_name)
-
-    if run_in_parallel:
-        # make sure the processes terminate
-        for p in procs:
-            p.join()
+    # load the hdw catalog once so that the processes inherit it
+    load_catalog(rads=rad_list)
+
+    # run a unit per (radar, time shard)
+    worker_kwargs = {"ftype":ftype, "db_name":db_name, "dbdir":dbdir}
+    run_sharded(worker, rad_list, stm, etm, chunk_minutes=chunk_minutes,
+                worker_kwargs=worker_kwargs,
+                nprocs=None if run_in_parallel else 1)
 
     return
 
@@ -1,9 +1,12 @@
 def combine_xxx_min_median(rads, ftype="fitacf", coords="mlt", 
                            filtered_interval=2.,
-                           dbdir="../data/sqlite3/", db_name=None):
+                           dbdir="../data/sqlite3/", db_name=None,
+                           defer_index=False):
 
     """ combines xxx-minute median filtered gridded data from radars 
     specified by rads argument into a single table.
+    The rows of each radar table are moved with a single
+    INSERT OR IGNORE ... SELECT inside the db.
 
     Parameters
     ----------
@@ -19,6 +22,10 @@ def combine_xxx_min_median(rads, ftype="fitacf", coords="mlt",
         section of database configuration
     db_name : str, default to None
         Name of the MySQL db where xxx-min median data is stored.
+    defer_index : bool, default to False
+        If True and the table does not exist yet, it is created without
+        its primary key, and a unique index on the key columns is built
+        after all the rows have been moved (see build_key_index).
 
     Returns
     -------
@@ -44,28 +51,28 @@ def combine_xxx_min_median(rads, ftype="fitacf", coords="mlt",
     except Exception, e: 
         logging.error(e, exc_info=True)
 
-    # create a table that combines gridded data from all the radar
     if coords == "mlt":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " mag_glatc float(7,2)," +\
-                  " mag_gltc float(8,2)," +\
-                  " mag_gazmc SMALLINT," +\
-                  " datetime DATETIME, " +\
-                  " rad VARCHAR(3), " +\
-                  " CONSTRAINT all_rads PRIMARY KEY (" +\
-                  "mag_glatc, mag_gltc, mag_gazmc, datetime, rad))"
+        coords_prefix = "mag"
     elif coords == "geo":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " geo_glatc float(7,2)," +\
-                  " geo_gltc float(8,2)," +\
-                  " geo_gazmc SMALLINT," +\
-                  " datetime DATETIME, " +\
-                  " rad VARCHAR(3), " +\
-                  " CONSTRAINT all_rads PRIMARY KEY (" +\
-                  "geo_glatc, geo_gltc, geo_gazmc, datetime, rad))"
-    command = command.format(tb=output_table)
+        coords_prefix = "geo"
+
+    # create a table that combines gridded data from all the radar
+    key_columns = ["cell_id", "azm_id", "datetime", "rad"]
+    command = "CREATE TABLE IF NOT EXISTS {tb}" +\
+              "(vel float(9,2)," +\
+              " {prefix}_glatc float(7,2)," +\
+              " {prefix}_gltc float(8,2)," +\
+              " {prefix}_gazmc SMALLINT," +\
+              " cell_id INTEGER," +\
+              " azm_id SMALLINT," +\
+              " datetime DATETIME, " +\
+              " rad VARCHAR(3)"
+    if defer_index:
+        command = command + ")"
+    else:
+        command = command + ", CONSTRAINT all_rads PRIMARY KEY (" +\
+                  ", ".join(key_columns) + "))"
+    command = command.format(tb=output_table, prefix=coords_prefix)
     try:
         cur.execute(command)
     except Exception, e:
@@ -75,39 +82,18 @@ def combine_xxx_min_median(rads, ftype="fitacf", coords="mlt",
     tbl_names = rads
 
     # move the data between tables 
+    columns = "vel, {prefix}_glatc, {prefix}_gltc, {prefix}_gazmc, " +\
+              "cell_id, azm_id, datetime"
+    columns = columns.format(prefix=coords_prefix)
     for i, tbl_name in enumerate(tbl_names):
         rad = tbl_name
-        if coords == "mlt":
-            command = "SELECT vel, mag_glatc, mag_gltc, mag_gazmc, " +\
-                      "datetime FROM {tb1} ORDER By datetime ASC"
-        elif coords == "geo":
-            command = "SELECT vel, geo_glatc, geo_gltc, geo_gazmc, " +\
-                      "datetime FROM {tb1} ORDER By datetime ASC"
-        command = command.format(tb1=tbl_name)
-
-        # fetch the data
+        command = "INSERT OR IGNORE INTO {tb2} ({cols}, rad) " +\
+                  "SELECT {cols}, ? FROM {tb1} ORDER BY datetime ASC"
+        command = command.format(tb1=tbl_name, tb2=output_table, cols=columns)
         try:
-            cur.execute(command)
+            cur.execute(command, (rad,))
         except Exception, e:
             logging.error(e, exc_info=True)
-        rows = cur.fetchall()
-
-        # insert the data into a table
-        if rows:
-            if coords == "mlt":
-                command = "INSERT OR IGNORE INTO {tb2} (vel, mag_glatc, mag_gltc, " +\
-                          "mag_gazmc, datetime, rad) VALUES (?, ?, ?, ?, ?, ?)"
-            elif coords == "geo":
-                command = "INSERT OR IGNORE INTO {tb2} (vel, geo_glatc, geo_gltc, " +\
-                          "geo_gazmc, datetime, rad) VALUES (?, ?, ?, ?, ?, ?)"
-            command = command.format(tb2=output_table)
-            for rw in rows:
-                vel, lat, lt, azm, dtm = rw
-
-                try:
-                    cur.execute(command, (vel, lat, lt, azm, dtm, rad))
-                except Exception, e:
-                    logging.error(e, exc_info=True)
 
         # commit the change
         try:
@@ -115,11 +101,47 @@ def combine_xxx_min_median(rads, ftype="fitacf", coords="mlt",
         except Exception, e:
             logging.error(e, exc_info=True)
 
+    # build the index on the key columns
+    if defer_index:
+        build_key_index(conn, output_table, key_columns)
+
     # close db connections
     conn.close()
 
     return
 
+def build_key_index(conn, table_name, key_columns):
+    """ builds a unique index on the key columns of a table that was
+    filled without its primary key. Duplicate rows are removed first,
+    keeping the one inserted first, as INSERT OR IGNORE would have done.
+
+    Parameters
+    ----------
+    conn : sqlite3.connect
+    table_name : str
+    key_columns : list of str
+
+    Returns
+    -------
+    Nothing
+    """
+
+    import logging
+
+    cur = conn.cursor()
+    keys = ", ".join(key_columns)
+    command = "DELETE FROM {tb} WHERE rowid NOT IN " +\
+              "(SELECT MIN(rowid) FROM {tb} GROUP BY {keys})"
+    try:
+        cur.execute(command.format(tb=table_name, keys=keys))
+        command = "CREATE UNIQUE INDEX IF NOT EXISTS {tb}_key ON {tb} ({keys})"
+        cur.execute(command.format(tb=table_name, keys=keys))
+        conn.commit()
+    except Exception, e:
+        logging.error(e, exc_info=True)
+
+    return
+
 def main():
     """executes the above function."""
 
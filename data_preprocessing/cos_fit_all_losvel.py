@@ -2,14 +2,17 @@ import numpy as np
 import datetime as dt
 import logging
 import sqlite3
+from bin_data import hemi_grids
+from superposed_store import load_slab, superposed_store
 
 def cosfit_superposed_epoch(input_table, output_table, db_name=None,
                             dbdir="../data/sqlite3/", ftype="fitacf", coords="mlt",
-                            reltime_list=[-20, 20], reltime_resolution=2,
+                            hemi="north", reltime_list=[-20, 20], reltime_resolution=2,
                             mlt_width=1., fit_by_bmazm=False, fit_by_losvel_azm=True,
                             abs_azm_maxlim = 90., abs_losvel_maxlim=500.,
                             fitvel_bounds=(-1000., 1000.), 
-                            unique_azm_count_minlim=3, weighting=None):
+                            unique_azm_count_minlim=3, weighting=None,
+                            store_path=None, drop_at_bounds=False):
     
     """ Does cosine fitting to all the LOS data in each MLAT/MLT grid, 
     and stores the results in a different table named "master_cosfit_superposed". 
@@ -27,6 +30,8 @@ def cosfit_superposed_epoch(input_table, output_table, db_name=None,
     coords : str
         Coordinates in which the binning process took place.
         Default to "mlt, can be "geo" as well. 
+    hemi : str
+        Hemisphere of the grids in which the data were binned.
     reltime_list : a list of int
         The start of the relative time, e.g., -30, -20, 20, -30, ...,
     reltime_resolution : int
@@ -46,11 +51,20 @@ def cosfit_superposed_epoch(input_table, output_table, db_name=None,
         have to be qualified for cosfitting. 
     fitvel_bounds : tuple
         Values to put bounds on estimated 2-D vels
+    drop_at_bounds : bool (Default to False)
+        What to do with the cells whose fitted 2-D vel is beyond fitvel_bounds.
+        If False, the vel is clipped to the bounds and kept, as the bounded
+        curve_fit did. If True, the cells are dropped from output_table.
     weighting : str (Default to None)
         Type of weighting used for curve fitting
         if set to None, all azimuthal bins are
         considered equal regardless of the nubmer of points
         each of them contains.
+    store_path : str, default to None
+        Path of a store of input_table written by
+        superposed_store.build_superposed_store. If None, the rows of
+        all the relative times in reltime_list are loaded from input_table
+        with a single query.
 
     Returns
     -------
@@ -75,34 +89,26 @@ def cosfit_superposed_epoch(input_table, output_table, db_name=None,
     if weighting is not None:
         output_table = output_table + "_" + weighting + "_weight"
 
-    # create output_table
     if coords == "mlt":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel_mag float(9,2)," +\
-                  " vel_mag_err float(9,2)," +\
-                  " vel_dir float(9,2)," +\
-                  " vel_dir_err float(9,2)," +\
-                  " vel_count INT," +\
-                  " mag_gazmc_span REAL," +\
-                  " mag_glatc float(7,2)," +\
-                  " mag_gltc float(8,2)," +\
-                  " relative_time SMALLINT, " +\
-                  " CONSTRAINT reltime PRIMARY KEY (" +\
-                  "mag_glatc, mag_gltc, relative_time))"
+        coords_prefix = "mag"
     elif coords == "geo":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel_mag float(9,2)," +\
-                  " vel_mag_err float(9,2)," +\
-                  " vel_dir float(9,2)," +\
-                  " vel_dir_err float(9,2)," +\
-                  " vel_count INT," +\
-                  " geo_gazmc_span REAL," +\
-                  " geo_glatc float(7,2)," +\
-                  " geo_gltc float(8,2)," +\
-                  " relative_time SMALLINT, " +\
-                  " CONSTRAINT reltime PRIMARY KEY (" +\
-                  "geo_glatc, geo_gltc, relative_time))"
-    command = command.format(tb=output_table)
+        coords_prefix = "geo"
+
+    # create output_table
+    command = "CREATE TABLE IF NOT EXISTS {tb}" +\
+              "(vel_mag float(9,2)," +\
+              " vel_mag_err float(9,2)," +\
+              " vel_dir float(9,2)," +\
+              " vel_dir_err float(9,2)," +\
+              " vel_count INT," +\
+              " {prefix}_gazmc_span REAL," +\
+              " {prefix}_glatc float(7,2)," +\
+              " {prefix}_gltc float(8,2)," +\
+              " cell_id INTEGER," +\
+              " relative_time SMALLINT, " +\
+              " CONSTRAINT reltime PRIMARY KEY (" +\
+              "cell_id, relative_time))"
+    command = command.format(tb=output_table, prefix=coords_prefix)
     try:
         cur.execute(command)
     except Exception, e:
@@ -121,121 +127,378 @@ def cosfit_superposed_epoch(input_table, output_table, db_name=None,
         col_gazmc = "geo_gazmc"
         col_azmc_span = "geo_gazmc_span"
 
-    try:
-        cur.execute(command)
-    except Exception, e:
-        logging.error(e, exc_info=True)
+    # the grids in which the data were binned
+    grds = hemi_grids(hemi)
+
+    # load the rows of all the relative times at once (or map the store)
+    # and index them by (relative_time, cell_id).
+    # NOTE: the rows are loaded without the |vel| limit, so that a cell
+    # whose own rows all exceed it is still fitted from its MLT window.
+    # The limit is applied to the rows of each lat band below.
+    if store_path is None:
+        slab = load_slab(cur, input_table, min(reltime_list),
+                         max(reltime_list) + (reltime_resolution-1),
+                         hemi=hemi, coords=coords)
+    else:
+        slab = superposed_store(store_path)
+
+    center_azms = grds.decode_azm_ids(np.arange(len(grds.center_azms)))
 
     # Do the fitting for each range of relative time with a given relative time resolution
+    results = []
     for reltm in reltime_list:
         sreltm = reltm
         ereltm = reltm + (reltime_resolution-1)
-        # query  the data
-        command = "SELECT {glatc}, {gltc} FROM {tb2} "+\
-                  "WHERE relative_time BETWEEN {sreltm} AND {ereltm} " +\
-                  "GROUP BY {glatc}, {gltc}"
-        command = command.format(tb2=input_table, glatc=col_glatc, gltc=col_gltc,
-                                 sreltm=sreltm, ereltm=ereltm)
-        try:
-            cur.execute(command)
-        except Exception, e:
-            logging.error(e, exc_info=True)
-        rws = cur.fetchall()
-
-        lats = [x[0] for x in rws]
-        lons = [x[1] for x in rws]
-
-        # Do cosing fitting for each MLAT-MLT cell
-        for ii in xrange(len(lats)):
-            if lats[ii] is None:
+        reltimes = range(sreltm, ereltm+1)
+        cell_ids = slab.cells(sreltm, ereltm)
+        lats, lons = grds.decode_cell_ids(cell_ids)
+
+        # the statistics of the MLT window of each MLAT-MLT cell, which
+        # are cumulated along MLT for each lat band
+        bands = grds.cell_bands[cell_ids]
+        window_stats = []
+        for band in np.unique(bands):
+            rows = slab.select(reltimes, np.arange(grds.band_offsets[band],
+                                                   grds.band_offsets[band+1]))
+            keep = np.abs(rows["vel"]) <= abs_losvel_maxlim
+            stats = mlt_window_stats(grds, band, rows["cell_id"][keep],
+                                     rows["azm_id"][keep], rows["vel"][keep])
+            window_stats.append(stats.window(mlt_width*15., cell_ids[bands == band]))
+        if not window_stats:
+            continue
+
+        # do cosine fitting with weight for all the cells at once.
+        # cell_ids are sorted, thus in the order of the bands.
+        fitpars, perrs, ok, vel_counts, azm_spans = fit_window_stats(
+            np.concatenate(window_stats), center_azms,
+            abs_azm_maxlim=abs_azm_maxlim,
+            unique_azm_count_minlim=unique_azm_count_minlim,
+            fitvel_bounds=fitvel_bounds, drop_at_bounds=drop_at_bounds,
+            weighting=weighting)
+        for ii in xrange(len(cell_ids)):
+            if not ok[ii]:
                 continue
-            gltc_left = lons[ii] - mlt_width/2.*15.
-            gltc_right = lons[ii] + mlt_width/2.*15.
-            if gltc_right >=360 or gltc_left < 0:
-                gltc_left =  gltc_left % 360
-                where_clause = "AND (({gltc} BETWEEN {gltc_left} AND 360) or ({gltc} BETWEEN 0 AND {gltc_right})) "
-            else:
-                where_clause = "AND ({gltc} BETWEEN {gltc_left} AND {gltc_right}) "
-            command = "SELECT vel, {gazmc} FROM {tb2} " +\
-                      "WHERE {glatc}={lat} " + where_clause + \
-                      "AND (relative_time BETWEEN {sreltm} AND {ereltm}) " +\
-                      "AND ABS(vel) <= {abs_losvel_maxlim} "+\
-                      "ORDER BY {gazmc}"
-            command = command.format(tb2=input_table, glatc=col_glatc, gltc=col_gltc,
-                                     gltc_left=gltc_left, gltc_right=gltc_right, 
-                                     sreltm=sreltm, ereltm=ereltm,
-                                     abs_losvel_maxlim=abs_losvel_maxlim,
-                                     gazmc=col_gazmc, lat=lats[ii])
-            try:
-                cur.execute(command)
-            except Exception, e:
-                logging.error(e, exc_info=True)
-
-            rows = cur.fetchall()
-            if rows:
-                los_vel = np.array([x[0] for x in rows])
-                azm = np.array([x[1] for x in rows])
-
-                # Limit azm range within +/- abs_azm_maxlim
-                azm = [x if x <=180 else x-360 for x in azm]
-                los_vel = [los_vel[i] for i in range(len(los_vel))\
-                           if abs(azm[i]) <= abs_azm_maxlim]
-                azm = [x for x in azm if abs(x) <= abs_azm_maxlim]
-                vel_count = len(los_vel)
-                unique_azm_count = len(np.unique(azm))
-                if unique_azm_count <= unique_azm_count_minlim:
-                    continue
-                azm_span = np.max(azm) - np.min(azm)
-
-                if weighting == "std":
-                    los_vel_tmp = np.array(los_vel)
-                    #std_val_tmp = np.std(los_vel_tmp[np.where(azm==azm[i])])
-                    # Calculate std values of losvels in each azm bin.
-                    # Add 1. to avoid having 0. values
-                    sigma =  np.array([1. + np.std(los_vel_tmp[np.where(azm==x)]) for x in azm])
-                else:
-                    sigma =  np.array([1.0 for x in azm])
-
-                # do cosine fitting with weight
-                try:
-                    fitpars, perrs = cos_curve_fit(azm, los_vel, sigma, bounds=fitvel_bounds)
-                except:
-                    continue
-                vel_mag = round(fitpars[0],2)
-                vel_dir = round(np.rad2deg(fitpars[1]) % 360,1)
-                vel_mag_err = round(perrs[0],2)
-                vel_dir_err = round(np.rad2deg(perrs[1]) % 360, 1)
-
-                # populate the out table 
-                command = "INSERT OR IGNORE INTO {tb1} (vel_mag, "+\
-                          "vel_mag_err, vel_dir, vel_dir_err, vel_count, {azmc_span_txt}, "+\
-                          "{glatc_txt}, {gltc_txt}, relative_time) VALUES ({vel_mag}, "\
-                          "{vel_mag_err}, {vel_dir}, {vel_dir_err}, {vel_count}, "+\
-                          "{azmc_span}, {glatc}, {gltc}, {reltime})"
-                command = command.format(tb1=output_table, azmc_span_txt=col_azmc_span,
-                                         glatc_txt=col_glatc,
-                                         gltc_txt=col_gltc, vel_mag=vel_mag,
-                                         vel_mag_err=vel_mag_err, vel_dir=vel_dir,
-                                         vel_dir_err=vel_dir_err, vel_count=vel_count,
-                                         azmc_span =azm_span, glatc=lats[ii], gltc=lons[ii],
-                                         reltime=reltm)
-                try:
-                    cur.execute(command)
-                except Exception, e:
-                    logging.error(e, exc_info=True)
-                print("finish inserting cosfit result at " +\
-                      str((lats[ii], lons[ii], reltm)))
-
-        try:
-            conn.commit()
-        except Exception, e:
-            logging.error(e, exc_info=True)
+            vel_mag = round(fitpars[ii, 0],2)
+            vel_dir = round(np.rad2deg(fitpars[ii, 1]) % 360,1)
+            vel_mag_err = round(perrs[ii, 0],2)
+            vel_dir_err = round(np.rad2deg(perrs[ii, 1]) % 360, 1)
+            results.append((vel_mag, vel_mag_err, vel_dir, vel_dir_err,
+                            int(vel_counts[ii]), float(azm_spans[ii]),
+                            round(lats[ii],2), round(lons[ii],2),
+                            int(cell_ids[ii]), reltm))
+
+        print("finish cosfitting at relative time " + str(reltm))
+
+    # populate the out table 
+    command = "INSERT OR IGNORE INTO {tb1} (vel_mag, "+\
+              "vel_mag_err, vel_dir, vel_dir_err, vel_count, {azmc_span_txt}, "+\
+              "{glatc_txt}, {gltc_txt}, cell_id, relative_time) " +\
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    command = command.format(tb1=output_table, azmc_span_txt=col_azmc_span,
+                             glatc_txt=col_glatc, gltc_txt=col_gltc)
+    try:
+        cur.executemany(command, results)
+        conn.commit()
+    except Exception, e:
+        logging.error(e, exc_info=True)
 
     # close db connection
     conn.close()
 
     return
 
+def prepare_losvel(los_vel, azm, abs_azm_maxlim=90., unique_azm_count_minlim=3,
+                   weighting=None):
+    """ selects the LOS vels of an MLAT-MLT neighborhood that qualify for
+    cosine fitting and calculates their weights. fit_window_stats does the
+    same from cumulative statistics, see check_fit_window_stats.
+
+    Parameters
+    ----------
+    los_vel : np.array
+    azm : np.array
+        Azimuths of los_vel [deg], in [0, 360)
+    See cosfit_superposed_epoch for the other parameters.
+
+    Returns
+    -------
+    (los_vel, azm, sigma, vel_count, azm_span), with azm in [-180, 180],
+    or None if the data do not qualify for fitting.
+
+    """
+
+    if len(los_vel) == 0:
+        return None
+
+    # Limit azm range within +/- abs_azm_maxlim
+    azm = np.where(azm <= 180, azm, azm - 360)
+    inside = np.abs(azm) <= abs_azm_maxlim
+    los_vel = los_vel[inside]
+    azm = azm[inside]
+    vel_count = len(los_vel)
+    unique_azms, azm_idx = np.unique(azm, return_inverse=True)
+    if len(unique_azms) <= unique_azm_count_minlim:
+        return None
+    azm_span = np.max(azm) - np.min(azm)
+
+    if weighting == "std":
+        # Calculate std values of losvels in each azm bin.
+        # Add 1. to avoid having 0. values
+        counts = np.bincount(azm_idx)
+        means = np.bincount(azm_idx, weights=los_vel) / counts
+        stds = np.sqrt(np.bincount(azm_idx, weights=(los_vel - means[azm_idx])**2) / counts)
+        sigma = 1. + stds[azm_idx]
+    else:
+        sigma =  np.ones(len(azm))
+
+    return los_vel, azm, sigma, vel_count, float(azm_span)
+
+def cos_fit_batch(azms, vels, sigma, groups, ngroups, bounds=(-np.inf, np.inf),
+                  drop_at_bounds=False):
+    """ fits Amp * cos(azm - phi) to many groups of points (e.g., the MLT
+    neighborhoods of all the cells of a relative time) at once.
+
+    The model is linear as a*cos(azm) + b*sin(azm), so the weighted least
+    squares solution of each group follows from its 2x2 normal equations.
+    Amp = sqrt(a**2 + b**2) and phi = arctan2(b, a). The errors are those of
+    scipy.optimize.curve_fit with absolute_sigma=False, i.e., the covariance
+    of (a, b) scaled by the reduced chi-square and propagated to (Amp, phi).
+
+    Parameters
+    ----------
+    azms : np.array
+        Azimuths [deg]
+    vels : np.array
+    sigma : np.array
+        Uncertainty of each vel. The weights are 1/sigma**2.
+    groups : np.array of int
+        Group index of each point, in [0, ngroups)
+    ngroups : int
+    bounds : tuple
+        (lower, upper) bounds of Amp. Amp is clipped to them. The errors
+        are those of the unbounded fit.
+    drop_at_bounds : bool
+        If True, the groups whose Amp was clipped are flagged as not ok.
+
+    Returns
+    -------
+    fitpars : np.array of shape (ngroups, 2)
+        Amp and phi [radians] of each group
+    perrs : np.array of shape (ngroups, 2)
+        Standard errors of Amp and phi
+    ok : np.array of bool
+        False for the groups that have less than 3 points, that are
+        singular, or, if drop_at_bounds is True, whose Amp was clipped
+        to the bounds.
+
+    """
+
+    x = np.deg2rad(azms)
+    c = np.cos(x)
+    s = np.sin(x)
+    w = 1. / np.asarray(sigma, dtype=float)**2
+    vels = np.asarray(vels, dtype=float)
+
+    def gsum(values):
+        return np.bincount(groups, weights=values, minlength=ngroups)
+
+    return cos_fit_sums(gsum(w * c * c), gsum(w * s * s), gsum(w * c * s),
+                        gsum(w * c * vels), gsum(w * s * vels), gsum(w * vels**2),
+                        np.bincount(groups, minlength=ngroups), bounds=bounds,
+                        drop_at_bounds=drop_at_bounds)
+
+def cos_fit_sums(scc, sss, scs, scv, ssv, svv, npts, bounds=(-np.inf, np.inf),
+                 drop_at_bounds=False):
+    """ fits Amp * cos(azm - phi) from the weighted sums of the points
+    of each group (see cos_fit_batch), e.g., scc = sum(w * cos(azm)**2),
+    scv = sum(w * cos(azm) * vel), svv = sum(w * vel**2), npts = number
+    of points. The sums are np.arrays of the same shape. bounds and
+    drop_at_bounds are as in cos_fit_batch.
+
+    Returns
+    -------
+    fitpars, perrs, ok as in cos_fit_batch
+
+    """
+
+    det = scc * sss - scs**2
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # the solution of the normal equations
+        a = (sss * scv - scs * ssv) / det
+        b = (scc * ssv - scs * scv) / det
+
+        # reduced chi-square. The sum of weighted squared residuals
+        # is expanded in terms of the sums.
+        chi2 = svv - 2 * (a * scv + b * ssv) + a**2 * scc + 2 * a * b * scs + b**2 * sss
+        chi2 = np.maximum(chi2, 0.) / (npts - 2)
+
+        # covariance of (a, b)
+        var_a = chi2 * sss / det
+        var_b = chi2 * scc / det
+        cov_ab = -chi2 * scs / det
+
+        # propagate to (Amp, phi)
+        amp = np.sqrt(a**2 + b**2)
+        phi = np.arctan2(b, a)
+        da = a / amp
+        db = b / amp
+        var_amp = da**2 * var_a + db**2 * var_b + 2 * da * db * cov_ab
+        var_phi = (b**2 * var_a + a**2 * var_b - 2 * a * b * cov_ab) / amp**4
+
+    ok = (npts > 2) & (det > 0) & np.isfinite(amp)
+    clipped = np.clip(amp, bounds[0], bounds[1])
+    if drop_at_bounds:
+        ok = ok & (clipped == amp)
+
+    fitpars = np.column_stack([clipped, phi])
+    perrs = np.sqrt(np.abs(np.column_stack([var_amp, var_phi])))
+
+    return fitpars, perrs, ok
+
+class mlt_window_stats(object):
+    """ Sufficient statistics of the LOS vels of a latitude band at a
+    relative time, for cosine fitting within sliding MLT windows.
+
+    The vels are summed per (grid-cell, azm bin). As all the vels of an
+    azm bin share its center azm, the counts, sums and sums of squares
+    of the vels of each azm bin determine the weighted sums of the fit
+    (see cos_fit_sums), the std weights, and the number of distinct azms.
+    The statistics are cumulated along MLT, so the statistics of any
+    window of grid-cells are the difference of two cumulative sums,
+    wrapped around 0/360, for any window width.
+
+    Parameters
+    ----------
+    grds : bin_data.grids
+    band : int
+        Index of the latitude band
+    cell_ids : np.array
+        Cell ids of the vels, all within band
+    azm_ids : np.array
+    vels : np.array
+
+    Attributes
+    ----------
+    nlons : int
+        Number of grid-cells in the band
+    cumsums : np.array of shape (nlons+1, number of azm bins, 3)
+        Cumulative counts, sums and sums of squares of the vels. The
+        first row is zeros.
+
+    """
+
+    def __init__(self, grds, band, cell_ids, azm_ids, vels):
+
+        self.grds = grds
+        self.band = band
+        self.nlons = int(grds.band_nlons[band])
+        nazms = len(grds.center_azms)
+
+        idx = (np.asarray(cell_ids) - grds.band_offsets[band]) * nazms + np.asarray(azm_ids)
+        vels = np.asarray(vels, dtype=float)
+        size = self.nlons * nazms
+        stats = np.dstack([np.bincount(idx, minlength=size),
+                           np.bincount(idx, weights=vels, minlength=size),
+                           np.bincount(idx, weights=vels**2, minlength=size)])
+        stats = stats.reshape(self.nlons, nazms, 3)
+        self.cumsums = np.zeros((self.nlons + 1, nazms, 3))
+        np.cumsum(stats, axis=0, out=self.cumsums[1:])
+
+    def _cumsum(self, idx):
+        # cumulative sums up to idx, which may be beyond [0, nlons]
+        # for the windows that wrap around 0/360
+        return self.cumsums[idx % self.nlons] +\
+               (idx // self.nlons)[:, np.newaxis, np.newaxis] * self.cumsums[-1]
+
+    def window(self, lt_width, cell_ids=None):
+        """ returns the statistics of the MLT windows centered at cell_ids.
+
+        Parameters
+        ----------
+        lt_width : float
+            Width of the window in degrees, e.g., 15 * (MLT width in hours)
+        cell_ids : np.array, default to None
+            Cell ids within the band. All the cells of the band if None.
+
+        Returns
+        -------
+        np.array of shape (len(cell_ids), number of azm bins, 3)
+        """
+
+        offset = self.grds.band_offsets[self.band]
+        if cell_ids is None:
+            cell_ids = np.arange(offset, offset + self.nlons)
+        before, after = self.grds.window_extents(lt_width)
+        k = np.asarray(cell_ids) - offset
+
+        return self._cumsum(k + after[cell_ids] + 1) - self._cumsum(k - before[cell_ids])
+
+def fit_window_stats(stats, center_azms, abs_azm_maxlim=90., unique_azm_count_minlim=3,
+                     fitvel_bounds=(-1000., 1000.), drop_at_bounds=False,
+                     weighting=None):
+    """ fits cosine curves to the statistics of MLT windows
+    (see mlt_window_stats.window). The selection and the weights are
+    those of prepare_losvel.
+
+    Parameters
+    ----------
+    stats : np.array of shape (number of windows, number of azm bins, 3)
+    center_azms : np.array
+        Center azms [deg] of the azm bins
+    See cosfit_superposed_epoch for the other parameters.
+
+    Returns
+    -------
+    fitpars, perrs, ok as in cos_fit_batch, and the vel_count and
+    azm_span of each window
+
+    """
+
+    # Limit azm range within +/- abs_azm_maxlim
+    azm = np.where(center_azms <= 180, center_azms, center_azms - 360)
+    inside = np.abs(azm) <= abs_azm_maxlim
+    cnt = stats[:, :, 0] * inside
+    sv = stats[:, :, 1] * inside
+    svv = stats[:, :, 2] * inside
+    present = cnt > 0
+    vel_count = cnt.sum(axis=1)
+    unique_azm_count = present.sum(axis=1)
+    with np.errstate(invalid="ignore"):
+        azm_span = np.where(present, azm, -np.inf).max(axis=1) -\
+                   np.where(present, azm, np.inf).min(axis=1)
+
+    if weighting == "std":
+        # std values of losvels in each azm bin. Add 1. to avoid having 0. values
+        # NOTE: svv and sv are differences of band-wide cumulative sums, so
+        # svv/cnt - means**2 keeps their round-off. A bin with a single vel
+        # has std 0, and variances below std_rtol of svv/cnt are round-off
+        # of equal vels, as np.std in prepare_losvel gives 0 for them.
+        std_rtol = 1e-9
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sv / cnt
+            msq = svv / cnt
+            variances = msq - means**2
+        variances = np.where((cnt > 1) & (variances > std_rtol * msq), variances, 0.)
+        stds = np.sqrt(variances)
+        w = np.where(present, 1. / (1. + stds)**2, 0.)
+    else:
+        w = np.ones(cnt.shape)
+
+    c = np.cos(np.deg2rad(azm))
+    s = np.sin(np.deg2rad(azm))
+    fitpars, perrs, ok = cos_fit_sums(np.sum(w * cnt * c**2, axis=1),
+                                      np.sum(w * cnt * s**2, axis=1),
+                                      np.sum(w * cnt * c * s, axis=1),
+                                      np.sum(w * sv * c, axis=1),
+                                      np.sum(w * sv * s, axis=1),
+                                      np.sum(w * svv, axis=1),
+                                      vel_count, bounds=fitvel_bounds,
+                                      drop_at_bounds=drop_at_bounds)
+    ok = ok & (unique_azm_count > unique_azm_count_minlim)
+
+    return fitpars, perrs, ok, vel_count.astype(int), azm_span
+
 def cosfunc(x, Amp, phi):
     import numpy as np
     return Amp * np.cos(1 * x - phi)
@@ -248,6 +511,83 @@ def cos_curve_fit(azms, vels, sigma, bounds=(-np.inf, np.inf)):
 
     return fitpars, perrs
 
+def check_cos_fit_batch(azms, vels, sigma):
+    """ checks cos_fit_batch against cos_curve_fit for a single group of
+    points.
+
+    Returns
+    -------
+    The absolute differences in Amp, phi [deg], and in their errors.
+    Amp of cos_curve_fit may be negative, in which case it is compared
+    with phi shifted by 180 deg.
+
+    """
+
+    fitpars, perrs, ok = cos_fit_batch(azms, vels, sigma,
+                                       np.zeros(len(azms), dtype=int), 1)
+    fitpars_ref, perrs_ref = cos_curve_fit(azms, vels, sigma)
+    amp_ref, phi_ref = fitpars_ref
+    if amp_ref < 0:
+        amp_ref, phi_ref = -amp_ref, phi_ref + np.pi
+    dphi = (np.rad2deg(fitpars[0, 1] - phi_ref) + 180.) % 360. - 180.
+
+    return (abs(fitpars[0, 0] - amp_ref), abs(dphi),
+            abs(perrs[0, 0] - perrs_ref[0]), abs(np.rad2deg(perrs[0, 1] - perrs_ref[1])))
+
+def check_fit_window_stats(slab, grds, reltimes, cell_id, mlt_width=1.,
+                           abs_azm_maxlim=90., abs_losvel_maxlim=500.,
+                           unique_azm_count_minlim=3, weighting=None):
+    """ checks the fit of a cell from the cumulative statistics
+    (mlt_window_stats and fit_window_stats) against the fit of the rows of
+    its MLT window (window_cell_ids, prepare_losvel and cos_fit_batch).
+
+    Parameters
+    ----------
+    slab : superposed_store.superposed_store
+    grds : bin_data.grids
+    reltimes : list of int
+    cell_id : int
+    See cosfit_superposed_epoch for the other parameters.
+
+    Returns
+    -------
+    The absolute differences in Amp, phi [deg], vel_count and azm_span,
+    or None if the cell does not qualify for fitting in either path.
+
+    """
+
+    # the fit from the rows of the window
+    rows = slab.select(reltimes, grds.window_cell_ids(cell_id, mlt_width*15.))
+    keep = np.abs(rows["vel"]) <= abs_losvel_maxlim
+    prepared = prepare_losvel(rows["vel"][keep].astype(float),
+                              grds.decode_azm_ids(rows["azm_id"][keep]),
+                              abs_azm_maxlim=abs_azm_maxlim,
+                              unique_azm_count_minlim=unique_azm_count_minlim,
+                              weighting=weighting)
+
+    # the fit from the cumulative statistics of the lat band
+    band = grds.cell_bands[cell_id]
+    rows = slab.select(reltimes, np.arange(grds.band_offsets[band],
+                                           grds.band_offsets[band+1]))
+    keep = np.abs(rows["vel"]) <= abs_losvel_maxlim
+    stats = mlt_window_stats(grds, band, rows["cell_id"][keep],
+                             rows["azm_id"][keep], rows["vel"][keep])
+    center_azms = grds.decode_azm_ids(np.arange(len(grds.center_azms)))
+    fitpars, perrs, ok, vel_counts, azm_spans = fit_window_stats(
+        stats.window(mlt_width*15., np.array([cell_id])), center_azms,
+        abs_azm_maxlim=abs_azm_maxlim,
+        unique_azm_count_minlim=unique_azm_count_minlim, weighting=weighting)
+
+    if prepared is None or not ok[0]:
+        return None
+    los_vel, azm, sigma, vel_count, azm_span = prepared
+    fitpars_ref, perrs_ref, ok_ref = cos_fit_batch(azm, los_vel, sigma,
+                                                   np.zeros(len(azm), dtype=int), 1)
+    dphi = (np.rad2deg(fitpars[0, 1] - fitpars_ref[0, 1]) + 180.) % 360. - 180.
+
+    return (abs(fitpars[0, 0] - fitpars_ref[0, 0]), abs(dphi),
+            abs(vel_counts[0] - vel_count), abs(azm_spans[0] - azm_span))
+
 def main():
     
     import logging
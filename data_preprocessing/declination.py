@@ -0,0 +1,169 @@
+"""
+Provides magnetic declination angles for arrays of points.
+
+The geomagnetic model (geomag.GeoMag) is evaluated once per day on a
+lat-lon grid of each hemisphere, the grids are cached on disk, and the
+declinations at any points are bilinearly interpolated from the grids.
+"""
+
+import os
+import numpy as np
+
+class declination_grid(object):
+    """ Declination angles on lat-lon grids, one grid per day and
+    hemisphere. The grid of a hemisphere is only built when it has points
+    to be interpolated.
+
+    Parameters
+    ----------
+    alt : float
+        Altitude passed to geomag.GeoMag as h. Default to 300.
+    dlat : float
+        Lat resolution of the grids [deg]. The grid of the northern
+        hemisphere covers lats 0 to 90, the one of the southern hemisphere
+        lats -90 to 0.
+    dlon : float
+        Lon resolution of the grids [deg]. The grids cover all lons.
+    cache_dir : str, default to "../data/declination/"
+        Directory in which the grids are saved. If None, the grids are
+        only kept in memory.
+
+    """
+
+    def __init__(self, alt=300., dlat=1., dlon=1., cache_dir="../data/declination/"):
+
+        self.alt = alt
+        self.hemi_lats = {"north":np.arange(0., 90. + dlat/2., dlat),
+                          "south":np.arange(-90., 0. + dlat/2., dlat)}
+        self.lons = np.arange(0., 360. + dlon/2., dlon)
+        self.dlat = dlat
+        self.dlon = dlon
+        self.cache_dir = cache_dir
+        self._grids = {}
+        self._points = {}
+
+    def _fname(self, day, hemi):
+        lats = self.hemi_lats[hemi]
+        fname = "dec_" + day.strftime("%Y%m%d") + "_alt" + str(self.alt) +\
+                "_lat" + str(lats[0]) + "_" + str(lats[-1]) +\
+                "_dlat" + str(self.dlat) + "_dlon" + str(self.dlon) + ".npy"
+        return os.path.join(self.cache_dir, fname)
+
+    def grid(self, day, hemi="north"):
+        """ returns the declination grid of a day and a hemisphere, of shape
+        (len(self.hemi_lats[hemi]), len(self.lons)) """
+
+        import tempfile
+        from geomag import geomag
+
+        key = (day, hemi)
+        if key in self._grids:
+            return self._grids[key]
+
+        fname = None
+        if self.cache_dir is not None:
+            fname = self._fname(day, hemi)
+            if os.path.isfile(fname):
+                self._grids[key] = np.load(fname)
+                return self._grids[key]
+
+        gm = geomag.GeoMag()
+        lats = self.hemi_lats[hemi]
+        decs = np.zeros((len(lats), len(self.lons)))
+        for i, lat in enumerate(lats):
+            for j, lon in enumerate(self.lons[:-1]):
+                decs[i, j] = gm.GeoMag(lat, lon, h=self.alt, time=day).dec
+        # lon 360 is the same as lon 0
+        decs[:, -1] = decs[:, 0]
+
+        if fname is not None:
+            if not os.path.isdir(self.cache_dir):
+                try:
+                    os.makedirs(self.cache_dir)
+                except OSError:
+                    # created by another process
+                    pass
+            # write into a temp file in the same directory and rename it,
+            # so that other processes never load a partially written grid
+            fd, tmp_fname = tempfile.mkstemp(suffix=".npy", dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, decs)
+            os.rename(tmp_fname, fname)
+        self._grids[key] = decs
+
+        return decs
+
+    def dec(self, lats, lons, day):
+        """ returns the declinations at the given points by bilinear
+        interpolation on the grids of a day.
+
+        Parameters
+        ----------
+        lats : list or np.array
+            Geo lats [deg], within [-90, 90]
+        lons : list or np.array
+            Geo lons [deg]
+        day : datetime.date
+
+        Returns
+        -------
+        np.array. NaN where lats or lons are NaN.
+
+        Raises
+        ------
+        ValueError if any lat is outside [-90, 90]
+        """
+
+        lats = np.asarray(lats, dtype="float")
+        lons = np.asarray(lons, dtype="float")
+        nans = np.isnan(lats) | np.isnan(lons)
+        if np.any(np.abs(lats[~nans]) > 90.):
+            raise ValueError("lats outside [-90, 90] have no declination")
+
+        val = np.zeros(lats.shape) + np.nan
+        for hemi, inside in [("north", ~nans & (lats >= 0.)),
+                             ("south", ~nans & (lats < 0.))]:
+            if np.any(inside):
+                val[inside] = self._interpolate(lats[inside], lons[inside],
+                                                day, hemi)
+
+        return val
+
+    def _interpolate(self, lats, lons, day, hemi):
+        # bilinear interpolation on the grid of a hemisphere
+
+        decs = self.grid(day, hemi)
+        grid_lats = self.hemi_lats[hemi]
+        x = (lats - grid_lats[0]) / self.dlat
+        y = (lons % 360.) / self.dlon
+        i = np.minimum(np.floor(x).astype(int), len(grid_lats) - 2)
+        j = np.minimum(np.floor(y).astype(int), len(self.lons) - 2)
+        tx = x - i
+        ty = y - j
+
+        return (1 - tx) * (1 - ty) * decs[i, j] + (1 - tx) * ty * decs[i, j+1] +\
+               tx * (1 - ty) * decs[i+1, j] + tx * ty * decs[i+1, j+1]
+
+    def point_dec(self, lat, lon, day):
+        """ returns the declination at a single point (e.g., a radar site)
+        evaluated by geomag.GeoMag, cached per day """
+
+        from geomag import geomag
+
+        key = (lat, lon, day)
+        if key not in self._points:
+            gm = geomag.GeoMag()
+            self._points[key] = gm.GeoMag(lat, lon, h=self.alt, time=day).dec
+
+        return self._points[key]
+
+# declination_grid objects shared by the users of this module, keyed by alt
+_grids = {}
+
+def get_declination_grid(alt=300., cache_dir="../data/declination/"):
+    """ returns a declination_grid shared within the process """
+
+    if alt not in _grids:
+        _grids[alt] = declination_grid(alt=alt, cache_dir=cache_dir)
+
+    return _grids[alt]
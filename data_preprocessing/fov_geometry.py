@@ -0,0 +1,237 @@
+"""
+Precomputes the FOV geometry (center and edge lats and lons of range gates
+in 'geo' coords) of each radar for each hardware (hdw) epoch, and stores it
+in a small sqlite db so that it is computed once per epoch instead of once
+per run.
+
+Each radar has a table in the FOV db with one row per
+(tval, bmnum, frang, rsep, altitude).
+"""
+
+import sqlite3
+import numpy as np
+
+def calc_lat_lon_edges(site, bmnum, frang, rsep, altitude=300.,
+                       ngates=None):
+    """ calculates lat and lon of the range-gate edges along the left edge
+    of a given beam. This is the same as latFull[bmnum] and lonFull[bmnum]
+    of davitpy's pydarn.radar.radFov.fov in 'geo' coords.
+
+    Parameters
+    ----------
+    site : davitpy.pydarn.radar.radStruct.site object
+    bmnum : int
+    frang : int
+        Distance at which the zero range-gate starts [km]
+    rsep : int
+        Range seperation [km]
+    altitude : float
+        Default to 300. [km]
+    ngates : int, default to None
+        Number of range gates, not larger than site.maxgate.
+        Default to site.maxgate
+
+    Returns
+    -------
+    two np.arrays of length ngates+1
+    """
+
+    from calc_geolatc_geolonc import calc_fov_latc_lonc
+
+    lat_edge, lon_edge = calc_fov_latc_lonc(site, frang, rsep, altitude=altitude,
+                                            bmnums=[bmnum], center=False)
+    lat_edge, lon_edge = lat_edge[0], lon_edge[0]
+    if ngates is not None:
+        lat_edge, lon_edge = lat_edge[:ngates+1], lon_edge[:ngates+1]
+
+    return lat_edge, lon_edge
+
+def _create_table(cur, table_name):
+    command = "CREATE TABLE IF NOT EXISTS {tb} (" +\
+              "tval TIMESTAMP, bmnum INTEGER, frang REAL, rsep REAL, " +\
+              "altitude REAL, geo_latc BLOB, geo_lonc BLOB, " +\
+              "geo_late BLOB, geo_lone BLOB, " +\
+              "PRIMARY KEY(tval, bmnum, frang, rsep, altitude))"
+    cur.execute(command.format(tb=table_name))
+
+    return
+
+def build_fov_geometry(rads, db_name=None, ftype="fitacf",
+                       fov_dbname="fov_geometry.sqlite",
+                       dbdir="../data/sqlite3/", altitude=300.):
+    """ Writes the FOV geometry of every (hdw epoch, beam, frang, rsep)
+    combination seen in the data of each radar into fov_dbname.
+    Combinations already in fov_dbname are skipped.
+
+    Parameters
+    ----------
+    rads : list
+        A list of three-letter radar codes
+    db_name : str, default to None
+        Name of the sqlite db that holds the LOS data.
+        Default to sd_gridded_los_data_<ftype>.sqlite
+    fov_dbname : str
+        Name of the sqlite db to which the FOV geometry will be written
+    altitude : float
+        Default to 300. [km]
+
+    Returns
+    -------
+    Nothing
+    """
+
+    from calc_geolatc_geolonc import calc_fov_latc_lonc, site_list
+    from array_codec import encode_array
+
+    if db_name is None:
+        db_name = "sd_gridded_los_data_" + ftype + ".sqlite"
+
+    conn_in = sqlite3.connect(dbdir + db_name,
+                              detect_types = sqlite3.PARSE_DECLTYPES)
+    conn_out = sqlite3.connect(dbdir + fov_dbname,
+                               detect_types = sqlite3.PARSE_DECLTYPES)
+    cur_in = conn_in.cursor()
+    cur_out = conn_out.cursor()
+
+    for rad in rads:
+        # Check whether the table of interest exists
+        command = "SELECT name FROM sqlite_master WHERE type='table' AND name='{tb}'"
+        cur_in.execute(command.format(tb=rad))
+        if not cur_in.fetchall():
+            continue
+
+        # find the time range and the (frang, rsep) combinations in data
+        cur_in.execute("SELECT datetime FROM {tb} ORDER BY datetime ASC LIMIT 1".format(tb=rad))
+        stm = cur_in.fetchone()[0]
+        cur_in.execute("SELECT datetime FROM {tb} ORDER BY datetime DESC LIMIT 1".format(tb=rad))
+        etm = cur_in.fetchone()[0]
+        cur_in.execute("SELECT DISTINCT frang, rsep FROM {tb}".format(tb=rad))
+        frang_rseps = cur_in.fetchall()
+
+        _create_table(cur_out, rad)
+        cur_out.execute("SELECT tval, bmnum, frang, rsep FROM {tb} WHERE altitude=?".\
+                        format(tb=rad), (altitude,))
+        done = set(cur_out.fetchall())
+
+        command = "INSERT OR IGNORE INTO {tb} (tval, bmnum, frang, rsep, altitude, " +\
+                  "geo_latc, geo_lonc, geo_late, geo_lone) " +\
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        command = command.format(tb=rad)
+        for st in site_list(rad, stm, etm):
+            params = []
+            for frang, rsep in frang_rseps:
+                if all([(st.tval, bmnum, frang, rsep) in done
+                        for bmnum in range(st.maxbeam)]):
+                    continue
+                # project all the beams at once
+                latc, lonc = calc_fov_latc_lonc(st, frang, rsep, altitude=altitude,
+                                                center=True)
+                late, lone = calc_fov_latc_lonc(st, frang, rsep, altitude=altitude,
+                                                center=False)
+                for bmnum in range(st.maxbeam):
+                    if (st.tval, bmnum, frang, rsep) in done:
+                        continue
+                    params.append((st.tval, bmnum, frang, rsep, altitude,
+                                   encode_array(latc[bmnum], "fov_geometry", codec="blob"),
+                                   encode_array(lonc[bmnum], "fov_geometry", codec="blob"),
+                                   encode_array(late[bmnum], "fov_geometry", codec="blob"),
+                                   encode_array(lone[bmnum], "fov_geometry", codec="blob")))
+            cur_out.executemany(command, params)
+            conn_out.commit()
+            print("FOV geometry of " + rad + " for hdw epoch " + str(st.tval) +\
+                  ": " + str(len(params)) + " beams added")
+
+    conn_in.close()
+    conn_out.close()
+
+    return
+
+class fov_geometry_store(object):
+    """ Loads the FOV geometry of a radar from the FOV db once and serves it
+    from memory.
+    """
+
+    def __init__(self, rad, fov_dbname="fov_geometry.sqlite",
+                 dbdir="../data/sqlite3/"):
+
+        from array_codec import decode_array
+        import os
+
+        self.rad = rad
+        self.centers = {}
+        self.edges = {}
+
+        if not os.path.isfile(dbdir + fov_dbname):
+            return
+        conn = sqlite3.connect(dbdir + fov_dbname,
+                               detect_types = sqlite3.PARSE_DECLTYPES)
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                    (rad,))
+        if cur.fetchall():
+            command = "SELECT tval, bmnum, frang, rsep, altitude, " +\
+                      "geo_latc, geo_lonc, geo_late, geo_lone FROM {tb}"
+            cur.execute(command.format(tb=rad))
+            for row in cur.fetchall():
+                key = tuple(row[:5])
+                self.centers[key] = (decode_array(row[5]), decode_array(row[6]))
+                self.edges[key] = (decode_array(row[7]), decode_array(row[8]))
+        conn.close()
+
+    def __len__(self):
+        return len(self.centers)
+
+    def get_centers(self, site, bmnum, frang, rsep, altitude=300.):
+        """ returns center lats and lons of the range gates of a beam,
+        the same as calc_latc_lonc, or None if they are not in the store """
+        return self.centers.get((site.tval, bmnum, frang, rsep, altitude))
+
+    def get_edges(self, site, bmnum, frang, rsep, altitude=300.):
+        """ returns lats and lons of the range-gate edges of a beam,
+        the same as calc_lat_lon_edges, or None if they are not in the store """
+        return self.edges.get((site.tval, bmnum, frang, rsep, altitude))
+
+# fov_geometry_store objects loaded by fov_lat_edges, keyed by radar
+_stores = {}
+
+def fov_lat_edges(rad, site, bmnum, frang, rsep, ngates, date_time=None,
+                  coords="mag", altitude=300.,
+                  fov_dbname="fov_geometry.sqlite", dbdir="../data/sqlite3/"):
+    """ returns the lats of the range-gate edges of a beam, the same as
+    latFull[bmnum] of davitpy's pydarn.radar.radFov.fov, from the FOV db.
+
+    Parameters
+    ----------
+    site : davitpy.pydarn.radar.radStruct.site object
+    ngates : int
+        Number of range gates
+    date_time : datetime.datetime
+        Needed for conversion to "mag" coords. Default to None
+    coords : str
+        "geo" or "mag"
+
+    Returns
+    -------
+    np.array of length ngates+1, or None if the geometry is not in the FOV db.
+    """
+
+    from davitpy.utils.coordUtils import coord_conv
+
+    if rad not in _stores:
+        _stores[rad] = fov_geometry_store(rad, fov_dbname=fov_dbname, dbdir=dbdir)
+    edges = _stores[rad].get_edges(site, bmnum, frang, rsep, altitude=altitude)
+    if edges is None or len(edges[0]) < ngates + 1:
+        return None
+    lat, lon = edges[0][:ngates+1], edges[1][:ngates+1]
+    if coords == "mag":
+        lon, lat = coord_conv(lon, lat, "geo", "mag", altitude=altitude,
+                              date_time=date_time)
+
+    return np.array(lat)
+
+if __name__ == "__main__":
+
+    rads = ["wal", "bks", "fhe", "fhw", "cve", "cvw", "ade", "adw"]
+    build_fov_geometry(rads, db_name=None, ftype="fitacf",
+                       fov_dbname="fov_geometry.sqlite",
+                       dbdir="../data/sqlite3/", altitude=300.)
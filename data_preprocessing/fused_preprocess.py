@@ -0,0 +1,219 @@
+"""
+Runs the geolocation (calc_geolatc_geolonc), geo to MLT conversion
+(geo_to_mlt) and gridding (bin_data) stages in a single pass.
+
+Each batch of beam rows is read once, kept in memory while the three
+transforms are applied back to back, and the final columns of all the
+three stages are written with one bulk update.
+"""
+
+import datetime as dt
+
+def fused_preprocess(rad, stm, etm, ftype="fitacf",
+                     dbdir="../data/sqlite3/", db_name=None,
+                     t_c_alt=300., stay_in_geo=False, hemi="north",
+                     batch_size=5000, fov_dbname=None):
+
+    """ geolocates, converts to MLT (or geo local time) and grids the
+    LOS data of a radar for the period between stm and etm.
+
+    Parameters
+    ----------
+    rad : str
+        Three-letter radar code
+    stm : datetime.datetime
+        The start time.
+    etm : datetime.datetime
+        The end time.
+    ftype : str
+        SuperDARN file type
+    db_name : str, default to None
+        Name of the sqlite db that holds the LOS data
+    t_c_alt : float, default to 300. [km]
+        The altitude need to calculate the target coords
+    stay_in_geo : bool
+        if set to True no coord conversion is done, and the data are
+        gridded in geo coords. Otherwise in MLAT-MLT coords.
+    hemi : str
+        Hemisphere. e.g., "north", "south"
+    batch_size : int
+        Number of beam rows processed and written at a time
+    fov_dbname : str, default to None
+        Name of the sqlite db built by fov_geometry.build_fov_geometry
+
+    Returns
+    -------
+    Nothing
+    """
+
+    import sqlite3
+    import logging
+    import numpy as np
+    from array_codec import encode_array, decode_array
+    from bulk_update import bulk_updater
+    from calc_geolatc_geolonc import site_list, latc_lonc_cache
+    from geo_to_mlt import convert_cells
+    from mlt_converter import mlt_converter
+    from bin_data import hemi_grids, grid_cells
+
+    if db_name is None:
+        db_name = "sd_gridded_los_data_" + ftype + ".sqlite"
+    conn = sqlite3.connect(dbdir + db_name, timeout=600.,
+                           detect_types = sqlite3.PARSE_DECLTYPES)
+    cur = conn.cursor()
+    table_name = rad
+
+    # Check whether the table of interest exists
+    command = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    cur.execute(command, (table_name,))
+    if not cur.fetchall():
+        conn.close()
+        return
+
+    # the final columns of the three stages
+    if stay_in_geo:
+        conv_columns = ["geo_ltc", "geo_azmc"]
+    else:
+        conv_columns = ["mag_bmazm", "rad_mlt", "mag_latc", "mag_ltc", "mag_azmc"]
+    prefix = "geo" if stay_in_geo else "mag"
+    grid_columns = [prefix + "_glatc", prefix + "_gltc", prefix + "_gazmc"]
+    columns = ["slist", "vel", "geo_latc", "geo_lonc"] + conv_columns + grid_columns
+
+    # add new columns
+    for col in columns[2:]:
+        col_type = "REAL" if col in ["mag_bmazm", "rad_mlt"] else "TEXT"
+        try:
+            command = "ALTER TABLE {tb} ADD COLUMN {col} {col_type}"
+            cur.execute(command.format(tb=table_name, col=col, col_type=col_type))
+        except:
+            # pass if the column exists
+            pass
+
+    # create grid points
+    grds = hemi_grids(hemi)
+
+    # objects shared by all the batches
+    if fov_dbname is None:
+        store = None
+    else:
+        from fov_geometry import fov_geometry_store
+        store = fov_geometry_store(rad, fov_dbname=fov_dbname, dbdir=dbdir)
+    fov_cache = latc_lonc_cache(maxsize=1024, store=store)
+    converters = (mlt_converter(altitude=t_c_alt), mlt_converter(altitude=0.))
+    updater = bulk_updater(conn, table_name, columns, chunk_size=batch_size)
+
+    # iterate through the hdw epochs of the radar
+    sites = site_list(rad, stm, etm)
+    sdtm = stm
+    for ii, st in enumerate(sites):
+        if ii == len(sites)-1:
+            edtm = etm
+        else:
+            edtm = st.tval
+
+        command = "SELECT slist, vel, bmnum, bmazm, frang, rsep, datetime " +\
+                  "FROM {tb} WHERE datetime BETWEEN ? AND ? ORDER BY datetime"
+        try:
+            cur.execute(command.format(tb=table_name), (sdtm, edtm))
+        except Exception, e:
+            logging.error(e, exc_info=True)
+        rows = cur.fetchall()
+
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i+batch_size]
+
+            # geolocate
+            slists = []
+            vels = []
+            latcs = []
+            loncs = []
+            beams = []
+            for row in batch:
+                slist, vel, bmnum, bmazm, frang, rsep, date_time = row
+                latc_all, lonc_all = fov_cache.get(st, bmnum, frang, rsep,
+                                                   altitude=300.)
+                vel = decode_array(vel, "vel")
+                slist = decode_array(slist, "slist")
+
+                # exclude the slist values beyond maxgate and their correspinding velocities
+                vel = vel[slist < st.maxgate]
+                slist = slist[slist < st.maxgate]
+                slists.append(slist)
+                vels.append(vel)
+                latcs.append(np.round(latc_all[slist], 2))
+                loncs.append(np.round(lonc_all[slist], 2))
+
+                # all the gates of the beam, whose mag coords are cached
+                # per beam by the converter
+                beams.append(((rad, st.tval, bmnum, frang, rsep),
+                              np.round(latc_all, 2), np.round(lonc_all, 2), slist))
+
+            # convert to MLT (or geo local time)
+            results = convert_cells(rad, latcs, loncs, [x[3] for x in batch],
+                                    [x[6] for x in batch], [x[2] for x in batch],
+                                    t_c_alt=t_c_alt, stay_in_geo=stay_in_geo,
+                                    converters=converters, beams=beams)
+
+            # grid the cells of all the rows in the batch at once
+            if stay_in_geo:
+                latc, lonc, azm = latcs, results["geo_ltc"], results["geo_azmc"]
+            else:
+                latc, lonc, azm = results["mag_latc"], results["mag_ltc"], results["mag_azmc"]
+            cell_offsets = np.cumsum([0] + [len(x) for x in latcs])
+            glatc_all, glonc_all, gazmc_all = grid_cells(grds, np.concatenate(latc),
+                                                         np.concatenate(lonc),
+                                                         np.concatenate(azm))
+
+            for j, row in enumerate(batch):
+                cells = slice(cell_offsets[j], cell_offsets[j+1])
+                glatc = glatc_all[cells]
+                glonc = glonc_all[cells]
+                gazmc = gazmc_all[cells]
+
+                # stage the final values of the row
+                params = [encode_array(slists[j], "slist"),
+                          encode_array(vels[j], "vel"),
+                          encode_array(latcs[j], "geo_latc"),
+                          encode_array(loncs[j], "geo_lonc")]
+                for col in conv_columns:
+                    if col in ["mag_bmazm", "rad_mlt"]:
+                        params.append(results[col][j])
+                    else:
+                        params.append(encode_array(results[col][j], col))
+                params.extend([encode_array(glatc, grid_columns[0]),
+                               encode_array(glonc, grid_columns[1]),
+                               encode_array(gazmc, grid_columns[2])])
+                updater.add(params, (row[6], row[2]))
+
+        # update sdtm
+        sdtm = edtm
+
+    # write the remaining rows, each chunk is committed by updater.
+    # Write errors (e.g., "database is locked" after the timeout) are
+    # raised, so that a unit fails instead of silently losing its rows.
+    updater.close()
+
+    # close db connection
+    conn.close()
+
+    return
+
+def worker(rad, stm, etm, ftype="fitacf",
+           dbdir="../data/sqlite3/", db_name=None,
+           t_c_alt=300., stay_in_geo=False, hemi="north",
+           batch_size=5000, fov_dbname=None):
+
+    """ A worker function to be used for parallel computing """
+
+    t1 = dt.datetime.now()
+    print("start the fused preprocessing for " +\
+          rad + " for period between " + str(stm) + " and " + str(etm))
+    fused_preprocess(rad, stm, etm, ftype=ftype, dbdir=dbdir, db_name=db_name,
+                     t_c_alt=t_c_alt, stay_in_geo=stay_in_geo, hemi=hemi,
+                     batch_size=batch_size, fov_dbname=fov_dbname)
+    t2 = dt.datetime.now()
+    print("Finishing the fused preprocessing for " + \
+           rad + " for period between " + str(stm) + " and " +\
+           str(etm) + " took " + str((t2-t1).total_seconds() / 60.) + " mins\n")
+
+    return
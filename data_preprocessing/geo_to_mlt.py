@@ -11,7 +11,7 @@ import pdb
 
 def geo_to_mlt(rad, stm=None, etm=None, ftype="fitacf",
 	       dbdir="../data/sqlite3/", db_name=None,
-               t_c_alt=300., stay_in_geo=False):
+               t_c_alt=300., stay_in_geo=False, fov_dbname=None):
 
     """ converts latc and lonc from GEO to MLAT-MLT coords (MLT is in degrees).
     Also calcuates the azmimuthal velocity angle (in degrees) relative to the magnetic pole.
@@ -39,26 +39,30 @@ def geo_to_mlt(rad, stm=None, etm=None, ftype="fitacf",
     stay_in_geo : bool
         if set to True no coord conversion is done. Calculation would be in geo, and
         the original UT time will be converted into local time.
+    fov_dbname : str, default to None
+        Name of the sqlite db built by fov_geometry.build_fov_geometry.
+        The geo latc and lonc of all the gates of each beam are looked up
+        there (or calculated) so that their mag coords are cached per beam.
 
     Returns
     -------
     Nothing
     """
 
-    from davitpy.utils.coordUtils import coord_conv
     import datetime as dt
     from datetime import date
     import sqlite3
-    import json
     import sys
     sys.path.append("../")
     import logging
+    from array_codec import encode_array, decode_array
+    from bulk_update import bulk_updater
 
     # make db connection
     if db_name is None:
         db_name = "sd_gridded_los_data_" + ftype + ".sqlite"
     try:
-        conn = sqlite3.connect(dbdir + db_name,
+        conn = sqlite3.connect(dbdir + db_name, timeout=600.,
                                detect_types = sqlite3.PARSE_DECLTYPES)
         cur = conn.cursor()
     except Exception, e:
@@ -128,13 +132,15 @@ def geo_to_mlt(rad, stm=None, etm=None, ftype="fitacf",
 
     # do the convertion to all the data in db if stm and etm are all None
     if (stm is not None) and (etm is not None):
-        command = "SELECT geo_latc, geo_lonc, bmazm, datetime FROM {tb} " +\
+        command = "SELECT geo_latc, geo_lonc, bmazm, datetime, bmnum, " +\
+                  "slist, frang, rsep FROM {tb} " +\
                   "WHERE datetime BETWEEN '{sdtm}' AND '{edtm}' ORDER BY datetime"
         command = command.format(tb=table_name, sdtm=stm, edtm=etm)
 
     # do the convertion to the data between stm and etm if any of them is None
     else:
-        command = "SELECT geo_latc, geo_lonc, bmazm, datetime FROM {tb} ORDER BY datetime"
+        command = "SELECT geo_latc, geo_lonc, bmazm, datetime, bmnum, " +\
+                  "slist, frang, rsep FROM {tb} ORDER BY datetime"
         command = command.format(tb=table_name)
     try:
         cur.execute(command)
@@ -142,134 +148,333 @@ def geo_to_mlt(rad, stm=None, etm=None, ftype="fitacf",
         logging.error(e, exc_info=True)
     rows = cur.fetchall() 
 
-    # do the conversion row by row
+    # only the rows with geo_latc are converted
+    rows = [x for x in rows if x[0]]
+
+    # do the conversion for all the cells of all the rows at once
     if rows:
-        for row in rows:
-            latc, lonc, bmazm, date_time= row
-            if latc:
-                # Load json string
-                latc = json.loads(latc)
-                lonc = json.loads(lonc)
-
-                # Calculates the LOS vel direction (in degrees) with respect to
-                # mag (or geo) pole for each vector in each range-beam cell.
-                azm_txt = geobmazm_to_magazm(rad, bmazm, latc, lonc, alt=t_c_alt,
-                                               time=date_time.date(), stay_in_geo=stay_in_geo)
-
-                if stay_in_geo:
-                    lonc = [x%360 for x in lonc]
-
-                    # convert utc to local time in degrees
-                    lonc_ltm = []
-                    for lonc_i in lonc:
-                        lonc_tmp = lonc_i if lonc_i<=180 else lonc_i-360
-
-                        # convert utc to local time
-                        local_dt = date_time + dt.timedelta(hours=lonc_tmp/15.)
-                        ltm = local_dt.time()  
-
-                        # convert local time to degrees. e.g. 0 (or 360) degree is midnight, 
-                        # 180 degrees is noon time. 
-                        lonc_ltm.append((ltm.hour + ltm.minute/60. + ltm.second/3600.) * 15.)
-                    lonc = lonc_ltm
-
-                else:
-
-                    # convert from geo to mlt degress
-                    lonc, latc = coord_conv(lonc, latc, "geo", "mlt",
-                                            altitude=t_c_alt,
-                                            date_time=date_time)
-
-
-                lonc = [(round(x,2))%360 for x in lonc]
-                latc = [round(x,2) for x in latc]
-
-                # convert to string
-                latc = json.dumps(latc)
-                lonc = json.dumps(lonc)
-                
-                # update into the db
-                if stay_in_geo:
-                    command = "UPDATE {tb} SET geo_ltc='{lonc}', geo_azmc='{azm_txt}'\
-                               WHERE datetime = '{dtm}'"
-                    command = command.format(tb=table_name, lonc=lonc,
-                                             azm_txt=azm_txt, dtm=date_time)
-                else:
-
-                    # Find MLT location of a radar 
-                    rad_lat, rad_lon = rad_loc_dict[rad]
-                    rad_lon, rad_lat = coord_conv(rad_lon, rad_lat, "geo", "mlt",
-                                                  altitude=0.,
-                                                  date_time=date_time)
-                    rad_lon = round(rad_lon % 360,2)
-                    # Convert bmazm from geo to mag
-                    mag_bmazm = geobmazm_to_magbmazm(rad, bmazm, alt=0.,
-                                                     time=date_time.date(),
-                                                     stay_in_geo=stay_in_geo)
-                    command = "UPDATE {tb} SET mag_bmazm={mag_bmazm}, rad_mlt={rad_mlt}, " +\
-                              "mag_latc='{latc}', mag_ltc='{lonc}', " +\
-                              "mag_azmc='{azm_txt}' WHERE datetime = '{dtm}'"
-                    command = command.format(tb=table_name, mag_bmazm=mag_bmazm, rad_mlt=rad_lon,
-                                             latc=latc, lonc=lonc, azm_txt=azm_txt,
-                                             dtm=date_time)
-
-                # do the update
-                try:
-                    cur.execute(command)
-                except Exception, e:
-                    logging.error(e, exc_info=True)
-
-            else:
-                continue
-        
-        # commit the results
-        try:
-            conn.commit()
-        except Exception, e:
-            logging.error(e, exc_info=True)
+        # the results are written in bulk through a staging table
+        if stay_in_geo:
+            columns = ["geo_ltc", "geo_azmc"]
+        else:
+            columns = ["mag_bmazm", "rad_mlt", "mag_latc", "mag_ltc", "mag_azmc"]
+        updater = bulk_updater(conn, table_name, columns)
+
+        latcs = [decode_array(x[0], "geo_latc") for x in rows]
+        loncs = [decode_array(x[1], "geo_lonc") for x in rows]
+        beams = None
+        if not stay_in_geo:
+            beams = beam_gates(rad, rows, latcs, dbdir=dbdir, fov_dbname=fov_dbname)
+        results = convert_cells(rad, latcs, loncs,
+                                [x[2] for x in rows], [x[3] for x in rows],
+                                [x[4] for x in rows], t_c_alt=t_c_alt,
+                                stay_in_geo=stay_in_geo, beams=beams)
+
+        for ii, row in enumerate(rows):
+            date_time, bmnum = row[3], row[4]
+
+            # stage the new values
+            params = tuple([encode_array(results[col][ii], col)
+                            if col not in ["mag_bmazm", "rad_mlt"]
+                            else results[col][ii] for col in columns])
+            updater.add(params, (date_time, bmnum))
+
+        # apply the remaining rows, each chunk is committed by updater.
+        # Write errors (e.g., "database is locked" after the timeout) are
+        # raised, so that a unit fails instead of silently losing its rows.
+        updater.close()
 
     # close db connection
     conn.close()
 
     return
 
+def beam_gates(rad, rows, latcs, dbdir="../data/sqlite3/", fov_dbname=None):
+    """ finds the geo latc and lonc of all the gates of the beam of each row,
+    as needed by convert_cells.
+
+    Parameters
+    ----------
+    rad : str
+    rows : list
+        (geo_latc, geo_lonc, bmazm, datetime, bmnum, slist, frang, rsep)
+        of each row, sorted by datetime
+    latcs : list of np.arrays
+        The decoded geo_latc of each row
+    fov_dbname : str, default to None
+        Name of the sqlite db built by fov_geometry.build_fov_geometry
+
+    Returns
+    -------
+    A list of (key, latc_all, lonc_all, slist), or None if the slist of
+    a row does not match its geo_latc.
+    """
+
+    import bisect
+    import numpy as np
+    from array_codec import decode_array
+    from calc_geolatc_geolonc import site_list, latc_lonc_cache
+
+    if fov_dbname is None:
+        store = None
+    else:
+        from fov_geometry import fov_geometry_store
+        store = fov_geometry_store(rad, fov_dbname=fov_dbname, dbdir=dbdir)
+    fov_cache = latc_lonc_cache(maxsize=1024, store=store)
+
+    # the hdw epoch of each row. The rows of epoch ii are those up to
+    # (and including) sites[ii].tval, as in calc_geolatc_geolonc.
+    sites = site_list(rad, rows[0][3], rows[-1][3])
+    tvals = [st.tval for st in sites[:-1]]
+
+    beams = []
+    for ii, row in enumerate(rows):
+        date_time, bmnum, slist, frang, rsep = row[3:8]
+        slist = decode_array(slist, "slist")
+        if len(slist) != len(latcs[ii]):
+            return None
+        st = sites[bisect.bisect_left(tvals, date_time)]
+        latc_all, lonc_all = fov_cache.get(st, bmnum, frang, rsep, altitude=300.)
+        # geo_latc and geo_lonc were rounded to 2 decimals
+        beams.append(((rad, st.tval, bmnum, frang, rsep),
+                      np.round(latc_all, 2), np.round(lonc_all, 2), slist))
+
+    return beams
+
+def convert_cells(rad, latcs, loncs, bmazms, date_times, bmnums,
+                  t_c_alt=300., stay_in_geo=False, converters=None, beams=None):
+    """ converts the geo latc and lonc of the cells of many beam rows at once.
+    The cells of all the rows are flattened so that each conversion
+    kernel is called once.
+
+    Parameters
+    ----------
+    rad : str
+        Three-letter radar code
+    latcs, loncs : list of np.arrays
+        geo latc and lonc of the cells of each row
+    bmazms, date_times, bmnums : list
+        bmazm, datetime and bmnum of each row
+    t_c_alt : float, default to 300. [km]
+    stay_in_geo : bool
+    converters : tuple, default to None
+        (mlt_converter at t_c_alt, mlt_converter at 0 km) objects to be
+        reused across calls. New ones are created if None.
+    beams : list, default to None
+        (key, latc_all, lonc_all, slist) of each row, where latc_all and
+        lonc_all are the geo latc and lonc of all the gates of the beam,
+        and key identifies them, e.g., (rad, site.tval, bmnum, frang, rsep).
+        If given, the mag coords are calculated once per beam and year
+        and looked up by slist (see mlt_converter.geo_to_mag).
+
+    Returns
+    -------
+    A dict of lists with one entry per row. The keys are
+    "geo_ltc" and "geo_azmc" if stay_in_geo is True, else
+    "mag_bmazm", "rad_mlt", "mag_latc", "mag_ltc" and "mag_azmc".
+    """
+
+    import numpy as np
+    from mlt_converter import mlt_converter
+    from declination import get_declination_grid
+
+    results = {}
+    if len(latcs) == 0:
+        return results
+
+    # flatten the cells, cells of row ii are in cell_offsets[ii]:cell_offsets[ii+1]
+    bmazms = np.array(bmazms, dtype="float")
+    cell_offsets = np.zeros(len(latcs) + 1, dtype=int)
+    np.cumsum([len(x) for x in latcs], out=cell_offsets[1:])
+    row_idx = np.repeat(np.arange(len(latcs)), np.diff(cell_offsets))
+    latc_all = np.concatenate(latcs).astype("float")
+    lonc_all = np.concatenate(loncs).astype("float")
+    cells = [slice(cell_offsets[ii], cell_offsets[ii+1]) for ii in range(len(latcs))]
+
+    # Calculates the LOS vel direction (in degrees) with respect to
+    # mag (or geo) pole for each vector in each range-beam cell.
+    rad_lat, rad_lon = rad_loc_dict[rad]
+    losvel_dir = calc_losvel_dir(rad_lat, rad_lon, latc_all, lonc_all,
+                                 bmazms[row_idx])
+
+    if stay_in_geo:
+        azm_all = np.round(losvel_dir, 2) % 360
+        results["geo_azmc"] = [azm_all[x] for x in cells]
+
+        # convert utc to local time in degrees
+        ltc_all = calc_local_time(lonc_all, date_times, row_idx)
+        ltc_all = np.round(ltc_all, 2) % 360
+        results["geo_ltc"] = [ltc_all[x] for x in cells]
+
+        return results
+
+    # convert losvel_dir from geo to mag by adding the magnetic
+    # declanation angle, one declination grid per day
+    days = np.array([x.date() for x in date_times])
+    cell_days = days[row_idx]
+    decs = np.zeros(len(latc_all))
+    for day in np.unique(days):
+        idx = cell_days == day
+        decs[idx] = get_declination_grid(alt=t_c_alt).dec(latc_all[idx],
+                                                          lonc_all[idx], day)
+    azm_all = np.round(losvel_dir - decs, 2) % 360
+    results["mag_azmc"] = [azm_all[x] for x in cells]
+
+    # Convert bmazm from geo to mag
+    results["mag_bmazm"] = list(geobmazm_to_magbmazm(rad, bmazms, alt=0.,
+                                                     time=days,
+                                                     stay_in_geo=stay_in_geo))
+
+    # the mag coords of the cells are cached per year and the
+    # MLT offsets are calculated once for all the rows
+    if converters is None:
+        converters = (mlt_converter(altitude=t_c_alt), mlt_converter(altitude=0.))
+    converter, rad_converter = converters
+    offsets = converter.mlt_offsets(date_times)
+    rad_offsets = rad_converter.mlt_offsets(date_times)
+
+    results["mag_latc"] = []
+    results["mag_ltc"] = []
+    results["rad_mlt"] = []
+    for ii in range(len(latcs)):
+        # convert from geo to mlt degress
+        if beams is None:
+            latc, lonc = converter.geo_to_mlt(latcs[ii], loncs[ii], date_times[ii],
+                                              key=(rad, bmnums[ii]),
+                                              offset=offsets[ii])
+        else:
+            key, latc_all, lonc_all, slist = beams[ii]
+            latc, lonc = converter.geo_to_mlt(latc_all, lonc_all, date_times[ii],
+                                              key=key, offset=offsets[ii],
+                                              slist=slist)
+        results["mag_latc"].append(np.round(latc, 2))
+        results["mag_ltc"].append(np.round(lonc, 2) % 360)
+
+        # Find MLT location of a radar 
+        rad_mlat, rad_mlt = rad_converter.geo_to_mlt([rad_lat], [rad_lon],
+                                                     date_times[ii], key=rad,
+                                                     offset=rad_offsets[ii])
+        results["rad_mlt"].append(round(rad_mlt[0] % 360,2))
+
+    return results
+
 def geobmazm_to_magbmazm(rad, bmazm, alt=300.,
                          time=None, stay_in_geo=False):
     """ Convert bmazm from geo to mag by adding
         the magnetic declanation angle.
-    bmazm : float
+    bmazm : float or np.array
         bmazm of a certain beam in geo. 
         0 degree shows the geo north direction
         180 degree shows the geo south direction
     alt : float, default to 300. [km]
         altitude value at which coords. conversions take place.
-    time : datetime.datetime
+    time : datetime.date or np.array of datetime.date
         Needed for geo to mlt conversion. Default to None. 
+        Has to be an array of the same length as bmazm if bmazm is an array.
     stay_in_geo : bool
         if set to True no coords. conversion is done. Calculation would be in geo
    
     Return
     ------
-    mag_bmazm : float
+    mag_bmazm : float or np.array
         bmazm (in degrees) with respect to the magnetic pole
 
     """
     
-    from geomag import geomag
-    from datetime import date
+    import numpy as np
+    from declination import get_declination_grid
    
     rad_lat, rad_lon = rad_loc_dict[rad]
     rad_lon = rad_lon % 360
-    gm = geomag.GeoMag()
     if stay_in_geo:
-        new_bmazm = (round(bmazm,2)) % 360
+        return np.round(bmazm, 2) % 360
+
+    # convert bmazm from geo to mag by adding
+    # the magnetic declanation angle, evaluated once per day
+    grid = get_declination_grid(alt=alt)
+    if np.ndim(bmazm) == 0:
+        dec = grid.point_dec(rad_lat, rad_lon, time)
     else:
-        # convert bmazm from geo to mag by adding
-        # the magnetic declanation angle
-        mg = gm.GeoMag(rad_lat, rad_lon, h=alt, time=time)
-        new_bmazm = (round(bmazm - mg.dec,2)) % 360
+        dec = np.array([grid.point_dec(rad_lat, rad_lon, x) for x in time])
 
-    return new_bmazm
+    return np.round(np.asarray(bmazm) - dec, 2) % 360
+
+def calc_losvel_dir(rad_lat, rad_lon, latc, lonc, bmazm):
+    """ calculates the LOS vel direction (in degrees) with respect to the
+    geo pole for arrays of range-beam cells, using spherical trigonometry.
+    The angles are defined in the same way as those in spherical
+    trigonometry section in mathworld.
+
+    Parameters
+    ----------
+    rad_lat, rad_lon : float
+        geo lat and lon of the radar
+    latc, lonc : np.array
+        center geo lats and lons of range-beam cells
+    bmazm : float or np.array
+        bmazm (in geo) of the beam of each cell
+
+    Returns
+    -------
+    np.array. NaN where latc is NaN.
+    """
+
+    import numpy as np
+
+    latc = np.asarray(latc, dtype="float")
+    lonc = np.asarray(lonc, dtype="float")
+    rad_lon = rad_lon % 360
+
+    b_prime = np.deg2rad(90. - latc)
+    a_prime = np.deg2rad(90. - rad_lat)
+    AB_dellon = np.deg2rad(np.abs(lonc - rad_lon))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        c_prime = np.arccos(np.sin(np.deg2rad(rad_lat)) * np.sin(np.deg2rad(latc)) +\
+                            np.cos(np.deg2rad(rad_lat)) * np.cos(np.deg2rad(latc)) * np.cos(AB_dellon))
+        s_prime = 1./2 * (a_prime + b_prime + c_prime)
+        A = 2 * np.arcsin(np.sqrt((np.sin(s_prime - b_prime) * np.sin(s_prime - c_prime)) /\
+                                  (np.sin(b_prime) * np.sin(c_prime))))
+
+    # the cells for which the formula above is degenerate
+    A = np.where(np.round(np.rad2deg(a_prime), 5) == np.round(np.rad2deg(s_prime), 5),
+                 np.pi, A)
+
+    return np.sign(bmazm) * (180 - np.rad2deg(A))
+
+def calc_local_time(lonc, date_times, row_idx=None):
+    """ converts utc to local time in degrees for arrays of cells.
+    e.g. 0 (or 360) degree is midnight, 180 degrees is noon time.
+
+    Parameters
+    ----------
+    lonc : np.array
+        geo lons of the cells
+    date_times : list of datetime.datetime
+        utc time of each cell, or of each row if row_idx is given
+    row_idx : np.array, default to None
+        index into date_times of each cell
+
+    Returns
+    -------
+    np.array
+    """
+
+    import numpy as np
+
+    lonc = np.asarray(lonc, dtype="float") % 360
+    lonc = np.where(lonc <= 180, lonc, lonc - 360)
+    secs = np.array([x.hour * 3600. + x.minute * 60. + x.second +\
+                     x.microsecond * 1e-6 for x in date_times])
+    if row_idx is not None:
+        secs = secs[row_idx]
+
+    # shift utc by lonc (rounded to microseconds as datetime.timedelta does),
+    # and drop the fractions of a second as the original datetime.time
+    # based conversion did
+    secs = secs + np.round(lonc / 15. * 3600. * 1e6) * 1e-6
+    secs = np.floor(secs % 86400.)
+
+    return secs / 3600. * 15.
 
 def geobmazm_to_magazm(rad, bmazm, latc, lonc, alt=300.,
                        time=None, stay_in_geo=False):
@@ -293,62 +498,31 @@ def geobmazm_to_magazm(rad, bmazm, latc, lonc, alt=300.,
    
     Return
     ------
-    azm_txt : string
+    azm_txt : string or buffer
         LOS vel. azm values (in degrees) at the positions of latc and lonc in
-        mag (or geo) coords.
+        mag (or geo) coords, encoded by array_codec.encode_array.
 
     """
     
-    from geomag import geomag
-    from datetime import date
     import numpy as np
-    import json
+    from array_codec import encode_array
+    from declination import get_declination_grid
    
     rad_lat, rad_lon = rad_loc_dict[rad]
-    rad_lon = rad_lon % 360
-    azm_lst = []
-    gm = geomag.GeoMag()
-    for i in range(len(latc)):
-        # calculate the los vel angle in geo using spherical trigonometry. Then angles are defined
-        # in the same way as those in spherical trigonometry section in mathworld
-        #B = np.deg2rad(np.abs(bmazm))
-
-        # catch nan value
-        if np.isnan(latc[i]):
-            azm_lst.append(np.nan)
-            continue
-
-        b_prime = np.deg2rad(90. - latc[i])
-        a_prime = np.deg2rad(90. - rad_lat)
-        AB_dellon = np.deg2rad(np.abs(lonc[i]-rad_lon))
-        c_prime = np.arccos(np.sin(np.deg2rad(rad_lat)) * np.sin(np.deg2rad(latc[i])) +\
-                          np.cos(np.deg2rad(rad_lat)) * np.cos(np.deg2rad(latc[i])) * np.cos(AB_dellon))
-        s_prime = 1./2 * (a_prime + b_prime + c_prime)
-        if round(np.rad2deg(a_prime),5) == round(np.rad2deg(s_prime),5):
-            A = np.pi
-        else:
-            A = 2 * np.arcsin(np.sqrt((np.sin(s_prime - b_prime) * np.sin(s_prime - c_prime)) /\
-                                  (np.sin(b_prime) * np.sin(c_prime))))
-        losvel_dir = np.sign(bmazm) * (180 - np.rad2deg(A))
-        
-        if stay_in_geo:
-            azm_mag = (round(losvel_dir,2)) % 360
-        else:
-            # convert losvel_dir from geo to mag by adding
-            # the magnetic declanation angle to the los vel angle in geo
-            mg = gm.GeoMag(latc[i], lonc[i], h=alt, time=time)
-            azm_mag = (round(losvel_dir - mg.dec,2)) % 360
-        azm_lst.append(azm_mag)
-
-#    # convert the list entries to a comma seperated strings
-#    azm_txt =",".join([str(x) for x in azm_lst])
-    azm_txt = json.dumps(azm_lst)
+    losvel_dir = calc_losvel_dir(rad_lat, rad_lon, latc, lonc, bmazm)
+    if stay_in_geo:
+        azm_txt = encode_array(np.round(losvel_dir, 2) % 360, "geo_azmc")
+    else:
+        # convert losvel_dir from geo to mag by adding
+        # the magnetic declanation angle to the los vel angle in geo
+        decs = get_declination_grid(alt=alt).dec(latc, lonc, time)
+        azm_txt = encode_array(np.round(losvel_dir - decs, 2) % 360, "mag_azmc")
 
     return azm_txt
 
 def worker(rad, stm=None, etm=None, ftype="fitacf",
            dbdir="../data/sqlite3/", db_name=None,
-           t_c_alt=300., stay_in_geo=False):
+           t_c_alt=300., stay_in_geo=False, fov_dbname=None):
 
     """ A worker function to be used for parallel computing """
 
@@ -367,7 +541,8 @@ def worker(rad, stm=None, etm=None, ftype="fitacf",
               rad + " for period between " + str(stm) + " and " + str(etm))
     geo_to_mlt(rad, stm=stm, etm=etm, ftype=ftype,
 	       dbdir=dbdir, db_name=db_name,
-               t_c_alt=t_c_alt, stay_in_geo=stay_in_geo)
+               t_c_alt=t_c_alt, stay_in_geo=stay_in_geo,
+               fov_dbname=fov_dbname)
     print("New coords. values have been written to db for " +\
            rad + " for period between " + str(stm) + " and " + str(etm))
 
@@ -378,13 +553,14 @@ def worker(rad, stm=None, etm=None, ftype="fitacf",
 
     return
 
-def main(run_in_parallel=True):
+def main(run_in_parallel=True, chunk_minutes=None):
     """ Call the functions above. Acts as an example code.
     Multiprocessing has been implemented to do parallel computing.
-    A unit process is for a radar beam (i.e. a db table)"""
+    A unit process is for a radar (i.e. a db table), or for a time shard
+    of a radar if chunk_minutes is set."""
 
     import datetime as dt
-    import multiprocessing as mp
+    from unit_scheduler import run_sharded
     import logging
     
     # create a log file to which any error occured will be written.
@@ -405,31 +581,13 @@ def main(run_in_parallel=True):
     #rad_list = ["bpk"]
     rad_list = ["wal", "bks", "fhe", "fhw", "cve", "cvw", "ade", "adw"]
     
-    # loop through the dates
-    # store the multiprocess
-    procs = []
-    for rad in rad_list:
-        if run_in_parallel:
-            # cteate a process
-            worker_kwargs = {"stm":stm, "etm":etm, "ftype":ftype,
-                             "dbdir":dbdir, "db_name":db_name,
-                             "t_c_alt":t_c_alt, "stay_in_geo":stay_in_geo}
-            p = mp.Process(target=worker, args=(rad),
-                           kwargs=worker_kwargs)
-            procs.append(p)
-            
-            # run the process
-            p.start()
-            
-        else:
-            worker(rad, stm=stm, etm=etm, ftype=ftype,
-                   dbdir=dbdir, db_name=db_name,
-                   t_c_alt=t_c_alt, stay_in_geo=stay_in_geo)
-            
-    if run_in_parallel:
-        # make sure the processes terminate
-        for p in procs:
-            p.join()
+    # run a unit per (radar, time shard). The period can only be split
+    # if stm and etm are set.
+    worker_kwargs = {"ftype":ftype, "dbdir":dbdir, "db_name":db_name,
+                     "t_c_alt":t_c_alt, "stay_in_geo":stay_in_geo}
+    run_sharded(worker, rad_list, stm, etm, chunk_minutes=chunk_minutes,
+                worker_kwargs=worker_kwargs,
+                nprocs=None if run_in_parallel else 1)
 
     return
 
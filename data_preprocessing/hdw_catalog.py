@@ -0,0 +1,116 @@
+"""
+An in-memory catalog of the hardware (hdw) epochs of radars.
+
+The hdw table of radars.sqlite is read once and kept as
+radar -> sorted epochs (tval) -> site, so finding the sites of a radar
+for a given period is a bisect on the sorted tvals with no db access.
+Load the catalog (load_catalog) in the parent process before starting
+the worker processes so that the workers inherit it through fork.
+"""
+
+import bisect
+
+# radar ids in the hdw table of radars.sqlite
+rad_id_dict = {"bks":33, "wal":32, "cve":207, "cvw":206,
+               "fhe":205, "fhw":204, "ade":209, "adw":208,
+               "hok":40, "hkw":41, "tig":14, "unw":18, "bpk":24 }
+
+# the catalog loaded by load_catalog, shared by all the users of this module
+_catalog = None
+
+class hdw_catalog(object):
+    """ Holds the sorted hdw epochs (tvals) of radars and the davitpy site
+    objects of those epochs.
+
+    Parameters
+    ----------
+    hdw_db : str
+        Path to radars.sqlite
+    rads : list, default to None
+        Three-letter radar codes to be loaded. Default to all the radars
+        in rad_id_dict.
+    preload_sites : bool
+        If True, the site objects of all the epochs are created at once.
+        Otherwise they are created when first needed.
+
+    """
+
+    def __init__(self, hdw_db="../data/sqlite3/radars.sqlite", rads=None,
+                 preload_sites=False):
+
+        if rads is None:
+            rads = rad_id_dict.keys()
+        self.hdw_db = hdw_db
+        self.tvals = {}
+        self._sites = {}
+        self._load_tvals(rads)
+
+        if preload_sites:
+            for rad in self.tvals.keys():
+                for tval in self.tvals[rad]:
+                    self.site(rad, tval)
+
+    def _load_tvals(self, rads):
+        """ reads the sorted tvals of rads from the hdw table """
+
+        import sqlite3
+
+        conn = sqlite3.connect(database=self.hdw_db,
+                               detect_types = sqlite3.PARSE_DECLTYPES)
+        cur = conn.cursor()
+        for rad in rads:
+            cur.execute("SELECT tval FROM hdw WHERE id=? ORDER BY tval ASC",
+                        (rad_id_dict[rad],))
+            self.tvals[rad] = [x[0] for x in cur.fetchall()]
+        conn.close()
+
+        return
+
+    def epochs(self, rad, stm, etm):
+        """ returns the tvals of the hdw epochs of rad that cover the
+        period between stm and etm, i.e., from the first tval later than
+        stm to the first tval later than etm """
+
+        if rad not in self.tvals:
+            self._load_tvals([rad])
+        tvals = self.tvals[rad]
+        i1 = bisect.bisect_left(tvals, stm)
+        i2 = bisect.bisect_left(tvals, etm)
+        if i2 == len(tvals):
+            raise ValueError("no hdw epoch of " + rad + " is found after " + str(etm))
+
+        return tvals[i1:i2+1]
+
+    def site(self, rad, tval):
+        """ returns the davitpy site object of rad for the epoch tval """
+
+        from davitpy.pydarn.radar.radStruct import site
+
+        key = (rad, tval)
+        if key not in self._sites:
+            self._sites[key] = site(code=rad, dt=tval)
+
+        return self._sites[key]
+
+    def site_list(self, rad, stm, etm):
+        """ returns a list of sites (one per hdw epoch) of rad for the
+        period between stm and etm """
+
+        return [self.site(rad, tval) for tval in self.epochs(rad, stm, etm)]
+
+def load_catalog(hdw_db="../data/sqlite3/radars.sqlite", rads=None,
+                 preload_sites=True):
+    """ loads the catalog into memory. Call it before forking workers. """
+
+    global _catalog
+    _catalog = hdw_catalog(hdw_db=hdw_db, rads=rads, preload_sites=preload_sites)
+
+    return _catalog
+
+def get_catalog(hdw_db="../data/sqlite3/radars.sqlite"):
+    """ returns the loaded catalog, loading it if needed """
+
+    if _catalog is None or _catalog.hdw_db != hdw_db:
+        return load_catalog(hdw_db=hdw_db, preload_sites=False)
+
+    return _catalog
@@ -0,0 +1,207 @@
+"""
+Converts geo coords to MLAT-MLT coords by splitting the conversion into
+a static part and a time-dependent part.
+
+For fixed range-gate cells, the magnetic (AACGM) lat and lon only change
+slowly with the magnetic field model epoch, so they are calculated once
+for all the gates of a beam per (radar, hdw epoch, beam, frang, rsep, year)
+and cached. The cells of a record are looked up by their slist. MLT is the magnetic lon shifted
+by an offset that only depends on time. The offset is calculated on a
+regular time grid and interpolated to the time of each record.
+"""
+
+import datetime as dt
+import numpy as np
+
+class mlt_converter(object):
+    """ Converts geo lat and lon to mag lat and MLT (in degrees).
+
+    Parameters
+    ----------
+    altitude : float
+        Altitude at which the conversion takes place. Default to 300. [km]
+    grid_minutes : int
+        Resolution of the time grid on which the MLT offset is calculated.
+        The offset changes smoothly (~15 degrees per hour), so it is
+        linearly interpolated between the grid points.
+    maxsize : int
+        Maximum number of entries kept in the cache of mag coords. The
+        least recently used entries are dropped first.
+
+    Attributes
+    ----------
+    hits : int
+        Number of conversions whose mag coords were found in the cache
+    misses : int
+        Number of conversions that called coord_conv for the mag coords
+
+    """
+
+    def __init__(self, altitude=300., grid_minutes=10, maxsize=4096):
+
+        from collections import OrderedDict
+
+        self.altitude = altitude
+        self.grid_minutes = grid_minutes
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._mag = OrderedDict()
+        self._offsets = {}
+
+    def geo_to_mag(self, latc, lonc, year, key=None, slist=None):
+        """ returns the mag lat and lon of geo lat and lon for a given year.
+
+        Parameters
+        ----------
+        latc : list or np.array
+        lonc : list or np.array
+        year : int
+        key : hashable, default to None
+            Identifies the cells. If slist is given, key identifies the
+            full set of gates of a beam, e.g.,
+            (rad, site.tval, bmnum, frang, rsep), and is the cache key
+            together with year. Otherwise the geo lat and lon are part of
+            the cache key too, which is meant for fixed points such as the
+            radar site.
+        slist : np.array, default to None
+            If given, latc and lonc are the center lats and lons of all the
+            gates of the beam identified by key, and the mag coords of the
+            gates in slist are returned.
+
+        NOTE: The returned arrays may be shared, do not modify them in place.
+
+        """
+
+        from davitpy.utils.coordUtils import coord_conv
+
+        if slist is None:
+            latc = np.asarray(latc, dtype="float")
+            lonc = np.asarray(lonc, dtype="float")
+            cache_key = (key, year, latc.tobytes(), lonc.tobytes())
+        else:
+            cache_key = (key, year)
+        try:
+            val = self._mag.pop(cache_key)
+            self.hits += 1
+        except KeyError:
+            # the mag coords are calculated at the middle of the year
+            mlon, mlat = coord_conv(np.asarray(lonc, dtype="float"),
+                                    np.asarray(latc, dtype="float"), "geo", "mag",
+                                    altitude=self.altitude,
+                                    date_time=dt.datetime(year, 7, 1))
+            val = (np.asarray(mlat, dtype="float"),
+                   np.asarray(mlon, dtype="float"))
+            self.misses += 1
+            if len(self._mag) >= self.maxsize:
+                self._mag.popitem(last=False)
+        self._mag[cache_key] = val
+
+        if slist is not None:
+            return val[0][slist], val[1][slist]
+
+        return val
+
+    def _grid_offset(self, grid_time):
+        """ returns the MLT (in degrees) of mag lon 0 at grid_time """
+
+        from davitpy.utils.coordUtils import coord_conv
+
+        if grid_time not in self._offsets:
+            mlt, mlat = coord_conv([0.], [60.], "mag", "mlt",
+                                   altitude=self.altitude,
+                                   date_time=grid_time)
+            self._offsets[grid_time] = float(np.asarray(mlt).ravel()[0]) % 360
+
+        return self._offsets[grid_time]
+
+    def mlt_offsets(self, date_times):
+        """ returns the MLT offsets (in degrees) for a list of times.
+        MLT = (mag lon + offset) % 360
+
+        Parameters
+        ----------
+        date_times : list of datetime.datetime
+
+        Returns
+        -------
+        np.array
+
+        """
+
+        step = dt.timedelta(minutes=self.grid_minutes)
+        step_secs = step.total_seconds()
+        t0 = min(date_times)
+        t0 = t0.replace(minute=0, second=0, microsecond=0)
+
+        # position of each time on the grid
+        secs = np.array([(x - t0).total_seconds() for x in date_times])
+        idx = np.floor(secs / step_secs).astype(int)
+        frac = secs / step_secs - idx
+
+        # offsets at the grid points that are needed, unwrapped so that
+        # they can be interpolated
+        nodes = np.unique(np.concatenate([idx, idx + 1]))
+        node_offsets = np.array([self._grid_offset(t0 + step * int(i)) for i in nodes])
+        pos = np.searchsorted(nodes, idx)
+        left = node_offsets[pos]
+        right = node_offsets[pos + 1]
+        right = left + (right - left + 180.) % 360. - 180.
+
+        return (left + frac * (right - left)) % 360.
+
+    def geo_to_mlt(self, latc, lonc, date_time, key=None, offset=None,
+                   slist=None):
+        """ converts geo lat and lon to mag lat and MLT (in degrees).
+
+        Parameters
+        ----------
+        latc : list or np.array
+        lonc : list or np.array
+        date_time : datetime.datetime
+        key : hashable, default to None
+            Identifies the cells (see geo_to_mag)
+        offset : float, default to None
+            The MLT offset of date_time, if already calculated by mlt_offsets.
+        slist : np.array, default to None
+            The gates of the beam to be converted (see geo_to_mag)
+
+        Returns
+        -------
+        mlat, mlt : np.arrays
+
+        """
+
+        mlat, mlon = self.geo_to_mag(latc, lonc, date_time.year, key=key,
+                                     slist=slist)
+        if offset is None:
+            offset = self.mlt_offsets([date_time])[0]
+
+        return mlat, (mlon + offset) % 360.
+
+def check_mlt_converter(latc, lonc, date_times, altitude=300., grid_minutes=10):
+    """ checks mlt_converter against coord_conv for some cells at
+    some times.
+
+    Returns
+    -------
+    The maximum absolute differences in mag lat and MLT [deg]
+
+    """
+
+    from davitpy.utils.coordUtils import coord_conv
+
+    conv = mlt_converter(altitude=altitude, grid_minutes=grid_minutes)
+    offsets = conv.mlt_offsets(date_times)
+    dlat_max = 0.
+    dlon_max = 0.
+    for i, date_time in enumerate(date_times):
+        mlat, mlt = conv.geo_to_mlt(latc, lonc, date_time, offset=offsets[i])
+        mlt_ref, mlat_ref = coord_conv(list(lonc), list(latc), "geo", "mlt",
+                                       altitude=altitude, date_time=date_time)
+        dlat = np.abs(mlat - np.asarray(mlat_ref))
+        dlon = np.abs((mlt - np.asarray(mlt_ref) + 180.) % 360. - 180.)
+        dlat_max = max(dlat_max, np.nanmax(dlat))
+        dlon_max = max(dlon_max, np.nanmax(dlon))
+
+    return dlat_max, dlon_max
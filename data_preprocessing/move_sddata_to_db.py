@@ -10,7 +10,8 @@ class los_data_to_db(object):
     """ A class that reads and holds sd LOS data from a given radar.
     It writes the data into a sqlite db using its move_to_db method."""
 
-    def __init__(self, rad, stime, etime, ftype="fitacf", channel=None):
+    def __init__(self, rad, stime, etime, ftype="fitacf", channel=None,
+                 stream=False):
 
         """ 
         Parameters
@@ -21,6 +22,11 @@ class los_data_to_db(object):
         etime : datetime.datetime
         ftype : str, default to "fitacf"
             SuperDARN file type. Valid inputs are "fitacf", "fitex"
+        stream : bool, default to False
+            If set to True, nothing is read here. Instead, move_to_db reads
+            the data from files batch by batch and writes each batch
+            before reading the next one. self.data is None in this case.
+            Otherwise self.data is a beam_batch.BeamBatch object.
 
         Returns
         -------
@@ -38,63 +44,145 @@ class los_data_to_db(object):
         self.stime = stime 
         self.etime = etime 
 	self.channel = channel
+        self.stream = stream
 
         # read data from file 
-        self.data = read_data_from_file(rad, stime, etime, ftype=self.ftype,
-					channel=channel,
-                                        tbands=None, coords="geo")
+        if stream:
+            self.data = None
+        else:
+            self.data = read_data_from_file(rad, stime, etime, ftype=self.ftype,
+                                            channel=channel,
+                                            tbands=None, coords="geo")
 
-    def move_to_db(self, conn):
-        """ writes the data into sqlite db
+    def move_to_db(self, conn, batch_size=5000, pragmas=None):
+        """ writes the data into sqlite db.
+        The INSERT statement is prepared once and the records are written
+        through executemany in batches of batch_size, one transaction per batch.
+        If self.stream is True, the data are read from files in batches of
+        batch_size and each batch is written as soon as it is read.
 
         Parameters
         ----------
         conn : sqlite3.connect
+        batch_size : int, default to 5000
+            Number of records written in a single transaction
+        pragmas : dict, default to None
+            PRAGMAs to set on conn before writing.
+            Default to DEFAULT_PRAGMAS.
 
         Returns
         -------
-        Nothing
+        Number of records written per second
         """
 
-        import json 
-        import sqlite3
+        import datetime as dt
+        from read_sddata_from_file import read_data_from_file_in_batches
+
+        if pragmas is None:
+            pragmas = DEFAULT_PRAGMAS
+        set_pragmas(conn, pragmas)
 
         cur = conn.cursor()
 
+        # create a table in sqlite db
+        table_name = self.rad
+        command = "CREATE TABLE IF NOT EXISTS {tb} (" +\
+                  "vel TEXT, slist TEXT, gflg TEXT," +\
+                  "bmnum INTEGER, bmazm REAL, nrang INTEGER, " +\
+                  "rsep REAL, frang REAL, stid INTEGER, "+\
+                  "datetime TIMESTAMP, "+\
+                  "PRIMARY KEY(datetime, bmnum))"
+        command = command.format(tb=table_name)
+        cur.execute(command)
+
+        # Write the data into table_name in the sqlite db
+        if self.stream:
+            batches = read_data_from_file_in_batches(self.rad, self.stime, self.etime,
+                                                     ftype=self.ftype, channel=self.channel,
+                                                     tbands=None, batch_size=batch_size)
+        elif self.data is None:
+            return 0.
+        else:
+            batches = [self.data]
 
-	# create a table in sqlite db
-	table_name = self.rad
-	command = "CREATE TABLE IF NOT EXISTS {tb} (" +\
-		  "vel TEXT, slist TEXT, gflg TEXT," +\
-		  "bmnum INTEGER, bmazm REAL, nrang INTEGER, " +\
-		  "rsep REAL, frang REAL, stid INTEGER, "+\
-		  "datetime TIMESTAMP, "+\
-		  "PRIMARY KEY(datetime, bmnum))"
+        command = "INSERT OR IGNORE INTO {tb} (vel, slist, gflg, bmnum,"+\
+                  "bmazm, nrang, rsep, frang, stid, datetime) "+\
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
         command = command.format(tb=table_name)
-	cur.execute(command)
 
-	# Write the data into table_name in the sqlite db
-	data_dict = self.data
-        if data_dict is None:
-            pass
-        else:
-            for i in xrange(len(data_dict['datetime'])):
-                command = "INSERT OR IGNORE INTO {tb} (vel, slist, gflg, bmnum,"+\
-                          "bmazm, nrang, rsep, frang, stid, datetime) "+\
-                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                command = command.format(tb=table_name)
-                cur.execute(command, (json.dumps(data_dict["vel"][i]),
-                            json.dumps(data_dict["slist"][i]), json.dumps(data_dict["gflg"][i]),
-                            data_dict["bmnum"][i], data_dict["bmazm"][i], data_dict["nrang"][i],
-                            data_dict["rsep"][i],data_dict["frang"][i],data_dict["stid"][i],
-                            data_dict["datetime"][i]))
-
-            # commit the change, once at one day of data points
-            conn.commit()
-
-        return
-
-def worker(db_name, dbdir, rad, stime, etime, ftype, channel):
+        t1 = dt.datetime.now()
+        nrecs = 0
+        for batch in batches:
+            n = len(batch)
+            for i in xrange(0, n, batch_size):
+                cur.executemany(command, _records(batch, i, min(i + batch_size, n)))
+
+                # commit the change, once per batch
+                conn.commit()
+            nrecs += n
+        t2 = dt.datetime.now()
+
+        rate = nrecs / max((t2-t1).total_seconds(), 1e-6)
+        print("wrote " + str(nrecs) + " records of " + self.rad + " at " +\
+              str(round(rate, 1)) + " records/sec")
+
+        return rate
+
+def _records(batch, i, j):
+    """ Converts the beams between i and j in a BeamBatch
+    into tuples of values to be inserted into a db table"""
+
+    from array_codec import encode_array
+
+    # per-beam values as python scalars, which sqlite3 can bind
+    time = batch.datetimes()[i:j]
+    bmnum = batch.bmnum[i:j].tolist()
+    bmazm = batch.bmazm[i:j].astype("f8").round(2).tolist()
+    nrang = batch.nrang[i:j].tolist()
+    rsep = batch.rsep[i:j].tolist()
+    frang = batch.frang[i:j].tolist()
+    stid = batch.stid[i:j].tolist()
+
+    recs = []
+    for k in xrange(i, j):
+        vel, slist, gflg = batch.beam(k)
+        # NOTE: vel is float32, round it again so that the JSON codec
+        # writes 2 decimals as before
+        recs.append((encode_array(vel.astype("f8").round(2), "vel"),
+                     encode_array(slist, "slist"),
+                     encode_array(gflg, "gflg"),
+                     bmnum[k-i], bmazm[k-i], nrang[k-i],
+                     rsep[k-i], frang[k-i], stid[k-i], time[k-i]))
+
+    return recs
+
+# PRAGMAs used while bulk writing into sqlite db. They only last for the
+# connection.
+# NOTE: journal_mode=WAL is left out on purpose. It is stored in the db
+# file, so it would change the db for every later reader and leave -wal
+# and -shm files next to it. Pass it in pragmas to opt in deliberately.
+DEFAULT_PRAGMAS = {"synchronous":"NORMAL",
+                   "cache_size":-64000, "temp_store":"MEMORY"}
+
+def set_pragmas(conn, pragmas):
+    """ Sets PRAGMAs on a sqlite db connection.
+
+    Parameters
+    ----------
+    conn : sqlite3.connect
+    pragmas : dict
+        e.g., {"synchronous":"NORMAL", "cache_size":-64000}.
+        NOTE: "journal_mode":"WAL" changes the db file permanently.
+    """
+
+    cur = conn.cursor()
+    for key in pragmas.keys():
+        cur.execute("PRAGMA {key}={val}".format(key=key, val=pragmas[key]))
+
+    return
+
+def worker(db_name, dbdir, rad, stime, etime, ftype, channel,
+           batch_size=5000, stream=False):
     """ A worker function used for multiprocessing.
     """
 
@@ -102,17 +190,18 @@ def worker(db_name, dbdir, rad, stime, etime, ftype, channel):
     import datetime as dt
 
     # make a db connection
-    conn = sqlite3.connect(dbdir + db_name)
+    conn = sqlite3.connect(dbdir + db_name, timeout=600.)
 
     # collect the data 
     t1 = dt.datetime.now()
     print "creating an object for " + rad + " for " + \
 	  str(stime) + "--" +  str(etime)
-    obj = los_data_to_db(rad, stime, etime, ftype=ftype, channel=channel)
+    obj = los_data_to_db(rad, stime, etime, ftype=ftype, channel=channel,
+                         stream=stream)
     print "object created for " + rad
-    if obj.data is not None:
+    if obj.stream or obj.data is not None:
         # move data to db
-        obj.move_to_db(conn)
+        obj.move_to_db(conn, batch_size=batch_size)
         print ("object has been moved to db")
 
     t2 = dt.datetime.now()
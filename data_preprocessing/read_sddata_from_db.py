@@ -52,20 +52,21 @@ def read_beamdata_from_db(rad, stm, etm, dbName, ftype="fitacf",
 
         Returns
         -------
-        A list of sd_beam_data objects
+        A beam_batch.BeamBatch object.
+        None if no data is available.
         """
 
         import sqlite3
-        import json
         import sys
         import datetime as dt
+        from array_codec import decode_array
+        from beam_batch import BeamBatch
 
         # make a db connection
         conn = sqlite3.connect(baseLocation + dbName, detect_types=sqlite3.PARSE_DECLTYPES)
         cur = conn.cursor()
 
         table_name = rad
-        beams_dict = {}
         # get the data from db
         command = "SELECT vel, slist, gflg, bmnum, "+\
                   "bmazm, nrang, rsep, frang, stid, datetime FROM {tb} "+\
@@ -74,29 +75,19 @@ def read_beamdata_from_db(rad, stm, etm, dbName, ftype="fitacf",
         command = command.format(tb=table_name, stm=stm, etm=etm)
         cur.execute(command)
         rws = cur.fetchall()
-        if rws:
-            beams_dict['vel'] = [json.loads(x[0]) for x in rws]
-            beams_dict['slist'] = [json.loads(x[1]) for x in rws]
-            beams_dict['gflg'] = [json.loads(x[2]) for x in rws]
-            beams_dict['bmnum'] = [x[3] for x in rws]
-            beams_dict['bmazm'] = [x[4] for x in rws]
-            beams_dict['nrang'] = [x[5] for x in rws]
-            beams_dict['rsep'] = [x[6] for x in rws]
-            beams_dict['frang'] = [x[7] for x in rws]
-            beams_dict['stid'] = [x[8] for x in rws]
-            beams_dict['datetime'] = [x[9] for x in rws]
-
-        if not beams_dict:
-            beams_data = None 
-        else:
-            # Construct sd_beam_data objects
-            beams_data = []
-            keys = beams_dict.keys()
-            for k in range(len(beams_dict['datetime'])):
-                values = [beams_dict[key][k] for key in keys]
-                dct =  {keys[i]:values[i] for i in range(len(keys))}
-                beams_data.append(sd_beam_data(dct))
-            
+        conn.close()
+
+        if not rws:
+            return None
+
+        # Construct a BeamBatch from the columns
+        cols = zip(*rws)
+        beams_data = BeamBatch.from_arrays([decode_array(x, "vel") for x in cols[0]],
+                                           [decode_array(x, "slist") for x in cols[1]],
+                                           [decode_array(x, "gflg") for x in cols[2]],
+                                           cols[9], cols[3], cols[4], cols[5],
+                                           cols[6], cols[7], cols[8])
+
         return beams_data
 
 if __name__ == "__main__":
@@ -17,15 +17,54 @@ def read_data_from_file(rad, stm, etm, ftype="fitacf", channel=None,
 
     Returns
     -------
-    A dictionary 
+    A beam_batch.BeamBatch object.
+    None if no data is available.
 
     Written by Muhammad 20180502
 
     """
 
-    from davitpy import pydarn
-    import copy
+    from beam_batch import BeamBatch
+
+    # Initialization.
+    data = None
+
+    # concatenate the batches
+    batches = list(read_data_from_file_in_batches(rad, stm, etm, ftype=ftype,
+                                                  channel=channel, tbands=tbands,
+                                                  batch_size=5000))
+    if batches:
+        data = BeamBatch.concatenate(batches)
+
+    return data
+
+def read_data_from_file_in_batches(rad, stm, etm, ftype="fitacf", channel=None,
+                                   tbands=None, batch_size=5000):
+
+    """A generator that reads data from file for a given radar and yields
+    them in batches of batch_size beams, so that the memory use does not
+    grow with the length of [stm, etm].
+
+    Parameters
+    ----------
+    rad : str
+        Three-letter code for a rad
+    ftype : str, default to "fitacf"
+        SuperDARN file type. Valid inputs are "fitacf", "fitex"
+    tbands : list
+        a list of the frequency bands to separate data into
+    batch_size : int, default to 5000
+        Maximum number of beams in a batch
+
+    Yields
+    ------
+    A beam_batch.BeamBatch object per batch.
+    Nothing is yielded if no data is available.
+
+    """
+
     from davitpy.pydarn.sdio import radDataOpen
+    from beam_batch import BeamBatch
 
     # read from a file
     myPtr = radDataOpen(stm, rad, eTime=etm, fileType=ftype, channel=channel)
@@ -33,22 +72,18 @@ def read_data_from_file(rad, stm, etm, ftype="fitacf", channel=None,
     if tbands is None:
         tbands = [8000, 20000]
 
-    # Initialization.
-    data = dict() 
-
     # Parameters to read from dmap file
     data_keys = ['datetime', 'slist', 'vel', 'gflg', 'bmnum', 'bmazm',
                  'nrang', 'rsep', 'frang', 'stid']
 
-    for d in data_keys:
-        data[d] = []
-
-    # return None if no data available
+    # return if no data available
     try:
         myPtr.rewind()
     except:
-        data = None
-        return data
+        return
+
+    # Initialization.
+    data = dict([(d, []) for d in data_keys])
 
     # Read the parameters of interest.
     myBeam = myPtr.readRec()
@@ -71,14 +106,17 @@ def read_data_from_file(rad, stm, etm, ftype="fitacf", channel=None,
                 data['frang'].append(myBeam.prm.frang)
                 data['stid'].append(myBeam.stid)
 
+                # hand over a full batch and start a new one
+                if len(data['datetime']) >= batch_size:
+                    yield BeamBatch.from_dict(data)
+                    data = dict([(d, []) for d in data_keys])
+
         # Read data from next record
         myBeam = myPtr.readRec()
 
-    # Set data to None if it is empty
-    if data['datetime'] == []:
-        data = None
-
-    return data
+    # the last, partially filled batch
+    if data['datetime'] != []:
+        yield BeamBatch.from_dict(data)
 
 if __name__ == "__main__":
 
@@ -89,5 +127,5 @@ if __name__ == "__main__":
     #channel = "all"
     rad = "fhw"
     channel = None
-    data_dict = read_data_from_file(rad, stm, etm, ftype="fitacf", channel=channel,
-                                    tbands=None, coords="geo")
+    beams_data = read_data_from_file(rad, stm, etm, ftype="fitacf", channel=channel,
+                                     tbands=None, coords="geo")
@@ -195,13 +195,15 @@ def median_filter(rads, stms, etms, hemi="north",
 		  filtered_interval=2.,
 		  input_dbname=None, output_dbname=None,
 		  dbdir="../data/sqlite3/",
-                  run_in_parallel=False):
+                  run_in_parallel=False, single_scan=False):
     """ Bins the gridded data from a single radar into xxx-minute intervals.
     e.g., at each xxx-minute interval, median vector in each azimuth bin within a grid cell is
     selected as the representative velocity for that bin. 
     The results are stored in a different db such that data from a given radar
     are written into a single table named by the radar name.
-    Then it runs combine_xxx_min_median to combine all the table into one"""
+    Then it runs combine_xxx_min_median to combine all the table into one.
+    If single_scan is True, the data of each radar are read at once and the
+    medians of all the windows are calculated in one pass."""
 
     from xxx_min_median import worker
     from combine_xxx_min_median import combine_xxx_min_median
@@ -224,7 +226,8 @@ def median_filter(rads, stms, etms, hemi="north",
 		worker_kwargs = {"ftype":ftype, "coords":coords,
 				 "filtered_interval":filtered_interval,
 				 "dbdir":dbdir, "input_dbname":input_dbname,
-				 "output_dbname":output_dbname}
+				 "output_dbname":output_dbname,
+				 "hemi":hemi, "single_scan":single_scan}
 		p = mp.Process(target=worker, args=(rad, stm, etm),
 			       kwargs=worker_kwargs)
 		procs.append(p)
@@ -237,7 +240,8 @@ def median_filter(rads, stms, etms, hemi="north",
 		worker(rad, stm, etm, ftype=ftype,
 		       coords=coords, filtered_interval=filtered_interval,
 		       dbdir=dbdir, input_dbname=input_dbname,
-		       output_dbname=output_dbname)
+		       output_dbname=output_dbname,
+		       hemi=hemi, single_scan=single_scan)
 
 	if run_in_parallel:
 	    # make sure the processes terminate
@@ -257,6 +261,154 @@ def median_filter(rads, stms, etms, hemi="north",
 
     return
 
+def fused_preprocess_all(rads, stms, etms, ftype="fitacf",
+                         stay_in_geo=False, t_c_alt=300., hemi="north",
+                         db_name=None, dbdir="../data/sqlite3/",
+                         run_in_parallel=False):
+
+    """ Geolocates, converts to MLT (or geo local time) and grids the data
+    in a single pass over the db. Replaces add_geolatc_geolonc,
+    convert_geo_to_mlt and bin_to_grids. """
+
+    from fused_preprocess import worker
+
+    # create a log file to which any error occured will be written.
+    logging.basicConfig(filename="./log_files/fused_preprocess.log",
+                        level=logging.INFO)
+
+    if db_name is None:
+        db_name = "sd_gridded_los_data_" + ftype + ".sqlite"
+
+    # load the hdw catalog once so that the processes inherit it
+    from hdw_catalog import load_catalog
+    load_catalog(rads=rads)
+
+    # loop through the datetimes in stms
+    for i in range(len(stms)):
+        stm = stms[i]
+        etm = etms[i]
+
+        # loop through the rads
+        # store the multiprocess
+        procs = []
+        for rad in rads:
+            worker_kwargs = {"ftype":ftype, "db_name":db_name, "dbdir":dbdir,
+                             "t_c_alt":t_c_alt, "stay_in_geo":stay_in_geo,
+                             "hemi":hemi}
+            if run_in_parallel:
+                # cteate a process
+                p = mp.Process(target=worker, args=(rad, stm, etm),
+                               kwargs=worker_kwargs)
+                procs.append(p)
+
+                # run the process
+                p.start()
+
+            else:
+                worker(rad, stm, etm, **worker_kwargs)
+
+        if run_in_parallel:
+            # make sure the processes terminate
+            for p in procs:
+                p.join()
+
+    return
+
+def run_scheduled(stms, etms, rads, channels, stages=None,
+                  ftype="fitacf", db_name=None, dbdir="../data/sqlite3/",
+                  stay_in_geo=False, t_c_alt=300., hemi="north",
+                  coords="mlt", filtered_interval=2.,
+                  input_dbname=None, output_dbname=None,
+                  nprocs=None, fused=False, single_scan=False,
+                  chunk_minutes=None):
+    """ Runs the stages for all the (event window, radar) pairs through a
+    single process pool instead of looping through stms one at a time.
+    A stage for a given radar starts as soon as the previous stage for the
+    same radar and event window finishes.
+
+    Parameters
+    ----------
+    stages : list, default to None
+        A subset of unit_scheduler.STAGES. Default to all the stages.
+    nprocs : int, default to None
+        Size of the process pool. Default to the number of CPUs.
+    fused : bool, default to False
+        If True, the geolatc_geolonc, geo_to_mlt and bin_to_grid stages
+        are replaced by the single-pass "fused" stage.
+    single_scan : bool, default to False
+        If True, the median_filter stage reads the data of a unit at once
+        (see xxx_min_median.single_scan_median).
+    chunk_minutes : float, default to None
+        If set, the period of each radar is split into time shards of this
+        length that are run concurrently (see unit_scheduler.split_interval).
+        The shards are aligned to filtered_interval.
+
+    Returns
+    -------
+    A list of per-unit reports (see unit_scheduler.run_unit)
+    """
+
+    from unit_scheduler import build_units, run_units, summarize_reports
+
+    if db_name is None:
+        db_name = "sd_gridded_los_data_" + ftype + ".sqlite"
+
+    # create a log file to which any error occured will be written.
+    logging.basicConfig(filename="./log_files/run_scheduled.log",
+                        level=logging.INFO)
+
+    if stages is None:
+        from unit_scheduler import STAGES
+        stages = [x for x in STAGES if x != "fused"]
+    if fused:
+        fused_stages = ["geolatc_geolonc", "geo_to_mlt", "bin_to_grid"]
+        if any([x in stages for x in fused_stages]):
+            stages = [x for x in stages if x not in fused_stages] + ["fused"]
+
+    stage_kwargs = {"move_to_db":{"ftype":ftype, "db_name":db_name, "dbdir":dbdir},
+                    "geolatc_geolonc":{"ftype":ftype, "db_name":db_name, "dbdir":dbdir},
+                    "geo_to_mlt":{"ftype":ftype, "db_name":db_name, "dbdir":dbdir,
+                                  "t_c_alt":t_c_alt, "stay_in_geo":stay_in_geo},
+                    "bin_to_grid":{"ftype":ftype, "db_name":db_name, "dbdir":dbdir,
+                                   "coords":coords, "hemi":hemi},
+                    "fused":{"ftype":ftype, "db_name":db_name, "dbdir":dbdir,
+                             "t_c_alt":t_c_alt, "stay_in_geo":stay_in_geo,
+                             "hemi":hemi},
+                    "median_filter":{"ftype":ftype, "coords":coords, "dbdir":dbdir,
+                                     "filtered_interval":filtered_interval,
+                                     "input_dbname":input_dbname,
+                                     "output_dbname":output_dbname,
+                                     "hemi":hemi, "single_scan":single_scan}}
+
+    t1 = dt.datetime.now()
+    # load the hdw catalog once so that the worker processes inherit it
+    if ("geolatc_geolonc" in stages) or ("fused" in stages):
+        from hdw_catalog import load_catalog
+        load_catalog(rads=rads)
+
+    chains = build_units(stms, etms, rads, stages=stages, channels=channels,
+                         chunk_minutes=chunk_minutes, align_minutes=filtered_interval)
+    reports = run_units(chains, stage_kwargs=stage_kwargs, nprocs=nprocs)
+    t2 = dt.datetime.now()
+
+    summary = summarize_reports(reports)
+    for stage in summary.keys():
+        n, total, tmax = summary[stage]
+        print(stage + ": " + str(n) + " units, " + str(round(total / 60., 2)) +\
+              " mins in total, " + str(round(tmax / 60., 2)) + " mins for the slowest")
+    print("Running all the units took " +\
+          str((t2-t1).total_seconds() / 60.) + " mins\n")
+
+    # combine the median filtered data of all the radars into one table
+    if "median_filter" in stages:
+        from combine_xxx_min_median import combine_xxx_min_median
+        print("moving xxx_min_median of " + str(rads) + " into all_radars table")
+        combine_xxx_min_median(rads, ftype=ftype, coords=coords,
+                               filtered_interval=filtered_interval,
+                               dbdir=dbdir, db_name=output_dbname)
+
+    return reports
+
 def create_master_db(ftype = "fitacf", coords="mlt",
 		     filtered_interval=2.,
 		     input_dbname=None, output_dbname=None,
@@ -406,13 +558,49 @@ if __name__ == "__main__":
     do_convert_geo_to_mlt = True
     do_bin_to_grids = True
     do_median_filter = False
-    do_create_master_db = False    # NOTE: need to be completed 
+    do_create_master_db = False    # NOTE: need to be completed
+
+    # Do geolatc_geolonc, geo_to_mlt and bin_to_grids in a single pass
+    do_fused_preprocess = False
+
+    # Run all the (event, radar, stage) units through one process pool
+    # instead of running the stages one after another
+    use_scheduler = False
+    nprocs = None    # if set to None, the number of CPUs is used
+    if use_scheduler:
+        stage_flags = [("move_to_db", do_move_to_db),
+                       ("geolatc_geolonc", do_add_geolatc_geolonc),
+                       ("geo_to_mlt", do_convert_geo_to_mlt),
+                       ("bin_to_grid", do_bin_to_grids),
+                       ("median_filter", do_median_filter)]
+        stages = [x[0] for x in stage_flags if x[1]]
+        run_scheduled(stms, etms, rads, channels, stages=stages,
+                      ftype=ftype, db_name=db_name, dbdir=dbdir,
+                      stay_in_geo=False, t_c_alt=300., hemi="north",
+                      coords="mlt", filtered_interval=2.,
+                      nprocs=nprocs, fused=do_fused_preprocess)
+        do_move_to_db = False
+        do_add_geolatc_geolonc = False
+        do_convert_geo_to_mlt = False
+        do_bin_to_grids = False
+        do_median_filter = False
+        do_fused_preprocess = False
 
     # Move data from files to db 
     if do_move_to_db:
 	move_to_db(stms, etms, rads, channels, db_name, ftype=ftype,
 		   dbdir=dbdir, run_in_parallel=run_in_parallel)
 
+    # Geolocate, convert to MLT and grid the data in a single pass
+    if do_fused_preprocess:
+        fused_preprocess_all(rads, stms, etms, ftype=ftype,
+                             stay_in_geo=False, t_c_alt=300., hemi="north",
+                             db_name=db_name, dbdir=dbdir,
+                             run_in_parallel=run_in_parallel)
+        do_add_geolatc_geolonc = False
+        do_convert_geo_to_mlt = False
+        do_bin_to_grids = False
+
     # Add geolatc geolonc to db
     if do_add_geolatc_geolonc:
 	add_geolatc_geolonc(rads, stms, etms, ftype=ftype,
@@ -0,0 +1,301 @@
+"""
+A memory-mapped copy of a superposed epoch master table
+(see build_master_db.build_superposed_master_table).
+
+The table is written once as a set of .npy columns sorted by
+(relative_time, cell_id, azm_id), together with an offset index that
+holds the first position of every (relative_time, cell_id) pair. The
+rows of a relative time and a range of cell ids (e.g., the cells of a
+lat band within an MLT window) are then a zero-copy view of the
+memory-mapped columns, so repeated slicing (cosine fitting, plotting)
+reads from the page cache instead of running SQL queries.
+"""
+
+import os
+import json
+import numpy as np
+
+# the columns of the store and their dtypes
+COLUMNS = [("relative_time", "i2"), ("cell_id", "i4"), ("azm_id", "i2"),
+           ("vel", "f4"), ("rad_code", "i1"), ("event_id", "i4")]
+
+def build_superposed_store(input_table, store_dir="../data/superposed_store/",
+                           db_name=None, dbdir="../data/sqlite3/",
+                           ftype="fitacf", coords="mlt", hemi="north",
+                           chunk_size=500000):
+
+    """ writes a superposed epoch master table into a memory-mapped store.
+
+    Parameters
+    ----------
+    input_table : str
+        Name of a superposed epoch master table, e.g.,
+        "master_superposed_epoch_northward"
+    store_dir : str
+        The store is written into store_dir + input_table
+    db_name : str, default to None
+        Name of the master db
+    ftype : str
+        SuperDARN file type
+    coords : str
+        Coordinates in which the binning process took place.
+    hemi : str
+        Hemisphere of the grids in which the data were binned.
+    chunk_size : int
+        Number of rows read from the db at a time
+
+    Returns
+    -------
+    The path of the store
+
+    """
+
+    import sqlite3
+    from bin_data import hemi_grids
+
+    if db_name is None:
+        db_name = "sd_master_" + coords + "_" + ftype + ".sqlite"
+    path = os.path.join(store_dir, input_table)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    conn = sqlite3.connect(dbdir + db_name, detect_types = sqlite3.PARSE_DECLTYPES)
+    cur = conn.cursor()
+
+    # the radars and the range of relative times
+    cur.execute("SELECT DISTINCT rad FROM {tb} ORDER BY rad".format(tb=input_table))
+    rads = [x[0] for x in cur.fetchall()]
+    command = "SELECT COUNT(*), MIN(relative_time), MAX(relative_time) " +\
+              "FROM {tb} WHERE cell_id >= 0 AND azm_id >= 0"
+    cur.execute(command.format(tb=input_table))
+    nrows, reltime_min, reltime_max = cur.fetchone()
+    if nrows == 0:
+        conn.close()
+        raise ValueError("no gridded rows are found in " + input_table)
+    reltime_min = int(round(reltime_min))
+    reltime_max = int(round(reltime_max))
+
+    columns = dict([(col, np.lib.format.open_memmap(os.path.join(path, col + ".npy"),
+                                                     mode="w+", dtype=dtype,
+                                                     shape=(nrows,)))
+                    for col, dtype in COLUMNS])
+
+    # the rows are sorted by sqlite and copied chunk by chunk
+    command = "SELECT relative_time, cell_id, azm_id, vel, rad, event_id " +\
+              "FROM {tb} WHERE cell_id >= 0 AND azm_id >= 0 " +\
+              "ORDER BY relative_time, cell_id, azm_id"
+    cur.execute(command.format(tb=input_table))
+    rad_codes = dict([(rad, i) for i, rad in enumerate(rads)])
+    pos = 0
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        n = len(rows)
+        columns["relative_time"][pos:pos+n] = [int(round(x[0])) for x in rows]
+        columns["cell_id"][pos:pos+n] = [x[1] for x in rows]
+        columns["azm_id"][pos:pos+n] = [x[2] for x in rows]
+        columns["vel"][pos:pos+n] = [x[3] for x in rows]
+        columns["rad_code"][pos:pos+n] = [rad_codes[x[4]] for x in rows]
+        columns["event_id"][pos:pos+n] = [-1 if x[5] is None else x[5] for x in rows]
+        pos += n
+    conn.close()
+
+    # the offset index of the (relative_time, cell_id) pairs
+    ncells = int(hemi_grids(hemi).band_offsets[-1])
+    keys, starts = offset_index(columns["relative_time"], columns["cell_id"],
+                                reltime_min, ncells)
+    np.save(os.path.join(path, "index_keys.npy"), keys)
+    np.save(os.path.join(path, "index_starts.npy"), starts)
+    for col in columns.keys():
+        columns[col].flush()
+
+    meta = {"table":input_table, "rads":rads, "nrows":int(nrows),
+            "reltime_min":reltime_min, "reltime_max":reltime_max,
+            "ncells":ncells, "coords":coords, "hemi":hemi}
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    return path
+
+def offset_index(reltimes, cell_ids, reltime_min, ncells):
+    """ returns the offset index of columns sorted by (relative_time, cell_id).
+
+    Returns
+    -------
+    keys : np.array
+        (relative_time - reltime_min) * ncells + cell_id of every
+        (relative_time, cell_id) pair, sorted
+    starts : np.array
+        The position of the first row of each key. The last entry is the
+        number of rows.
+    """
+
+    keys = (np.asarray(reltimes, dtype=np.int64) - reltime_min) * ncells +\
+           np.asarray(cell_ids, dtype=np.int64)
+    if len(keys) == 0:
+        return keys, np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+    return keys[starts], np.r_[starts, len(keys)].astype(np.int64)
+
+def load_slab(cur, input_table, sreltm, ereltm, hemi="north",
+              coords="mlt", abs_losvel_maxlim=None):
+    """ loads the rows of a superposed epoch master table between two
+    relative times into memory, in a single query, and returns them as a
+    superposed_store.
+
+    Parameters
+    ----------
+    cur : sqlite3 cursor of the master db
+    input_table : str
+    sreltm, ereltm : int
+        The range of relative times (inclusive)
+    hemi : str
+        Hemisphere of the grids in which the data were binned.
+    abs_losvel_maxlim : float, default to None
+        If set, the rows with |vel| > abs_losvel_maxlim are not loaded.
+        NOTE: the cells of those rows then drop out of cells() too.
+
+    Returns
+    -------
+    superposed_store
+    """
+
+    from bin_data import hemi_grids
+
+    command = "SELECT relative_time, cell_id, azm_id, vel, rad, event_id " +\
+              "FROM {tb} WHERE relative_time BETWEEN ? AND ? " +\
+              "AND cell_id >= 0 AND azm_id >= 0 "
+    params = [sreltm, ereltm]
+    if abs_losvel_maxlim is not None:
+        command = command + "AND ABS(vel) <= ? "
+        params.append(abs_losvel_maxlim)
+    command = command + "ORDER BY relative_time, cell_id, azm_id"
+    cur.execute(command.format(tb=input_table), params)
+    rows = cur.fetchall()
+
+    rads = sorted(set([x[4] for x in rows]))
+    rad_codes = dict([(rad, i) for i, rad in enumerate(rads)])
+    columns = {"relative_time":np.array([int(round(x[0])) for x in rows], dtype="i2"),
+               "cell_id":np.array([x[1] for x in rows], dtype="i4"),
+               "azm_id":np.array([x[2] for x in rows], dtype="i2"),
+               "vel":np.array([x[3] for x in rows], dtype="f4"),
+               "rad_code":np.array([rad_codes[x[4]] for x in rows], dtype="i1"),
+               "event_id":np.array([-1 if x[5] is None else x[5] for x in rows], dtype="i4")}
+    meta = {"table":input_table, "rads":rads, "nrows":len(rows),
+            "reltime_min":int(sreltm), "reltime_max":int(ereltm),
+            "ncells":int(hemi_grids(hemi).band_offsets[-1]),
+            "coords":coords, "hemi":hemi}
+
+    return superposed_store(columns=columns, meta=meta)
+
+class superposed_store(object):
+    """ Reads a store written by build_superposed_store, or wraps columns
+    that are already in memory (see load_slab).
+
+    Parameters
+    ----------
+    path : str, default to None
+        The path returned by build_superposed_store
+    columns : dict, default to None
+        Columns sorted by (relative_time, cell_id, azm_id), used if path
+        is None
+    meta : dict, default to None
+        The meta data of columns, as written by build_superposed_store
+
+    Attributes
+    ----------
+    columns : dict
+        The memory-mapped columns, keyed by the names in COLUMNS
+    rads : list
+        The radars. rad_code is the index of a radar in rads.
+
+    """
+
+    def __init__(self, path=None, columns=None, meta=None):
+
+        if path is not None:
+            with open(os.path.join(path, "meta.json")) as f:
+                self.meta = json.load(f)
+            self.columns = dict([(col, np.load(os.path.join(path, col + ".npy"), mmap_mode="r"))
+                                 for col, dtype in COLUMNS])
+            self._keys = np.load(os.path.join(path, "index_keys.npy"))
+            self._starts = np.load(os.path.join(path, "index_starts.npy"))
+        else:
+            self.meta = meta
+            self.columns = columns
+            self._keys, self._starts = offset_index(columns["relative_time"],
+                                                    columns["cell_id"],
+                                                    meta["reltime_min"], meta["ncells"])
+        self.rads = self.meta["rads"]
+
+    def _key(self, reltime, cell_id):
+        return (int(reltime) - self.meta["reltime_min"]) * self.meta["ncells"] + int(cell_id)
+
+    def span(self, reltime, cell_lo, cell_hi=None):
+        """ returns the (start, end) positions of the rows of a relative time
+        whose cell ids are between cell_lo and cell_hi (inclusive) """
+
+        if cell_hi is None:
+            cell_hi = cell_lo
+        i1 = np.searchsorted(self._keys, self._key(reltime, cell_lo), side="left")
+        i2 = np.searchsorted(self._keys, self._key(reltime, cell_hi), side="right")
+
+        return self._starts[i1], self._starts[i2]
+
+    def cells(self, sreltm, ereltm):
+        """ returns the ids of the cells that have rows between two relative
+        times (inclusive) """
+
+        i1 = np.searchsorted(self._keys, self._key(sreltm, 0), side="left")
+        i2 = np.searchsorted(self._keys, self._key(ereltm + 1, 0), side="left")
+
+        return np.unique(self._keys[i1:i2] % self.meta["ncells"])
+
+    def rows(self, reltime, cell_lo, cell_hi=None):
+        """ returns the rows of a relative time whose cell ids are between
+        cell_lo and cell_hi (inclusive), as a dict of zero-copy views """
+
+        start, end = self.span(reltime, cell_lo, cell_hi)
+
+        return dict([(col, self.columns[col][start:end]) for col in self.columns.keys()])
+
+    def select(self, reltimes, cell_ids):
+        """ returns the rows of a list of relative times and a list of cell
+        ids (e.g., grids.window_cell_ids) as a dict of arrays. The cell ids
+        are split into runs of consecutive ids, so the rows are gathered
+        from one view per (relative time, run). """
+
+        cell_ids = np.unique(cell_ids)
+        if len(cell_ids) == 0:
+            return dict([(col, self.columns[col][:0]) for col in self.columns.keys()])
+        breaks = np.flatnonzero(np.diff(cell_ids) != 1)
+        lows = cell_ids[np.r_[0, breaks + 1]]
+        highs = cell_ids[np.r_[breaks, len(cell_ids) - 1]]
+
+        spans = [self.span(reltime, lo, hi) for reltime in reltimes
+                 for lo, hi in zip(lows, highs)]
+        idx = np.concatenate([np.arange(0)] + [np.arange(start, end) for start, end in spans])
+
+        return dict([(col, self.columns[col][idx]) for col in self.columns.keys()])
+
+def main():
+    """ builds the stores of the superposed epoch master tables """
+
+    import logging
+
+    logging.basicConfig(filename="./log_files/superposed_store.log",
+                        level=logging.INFO)
+
+    for IMF_turning in ["northward", "southward"]:
+        input_table = "master_superposed_epoch_" + IMF_turning
+        path = build_superposed_store(input_table, store_dir="../data/superposed_store/",
+                                      db_name=None, dbdir="../data/sqlite3/",
+                                      ftype="fitacf", coords="mlt", hemi="north")
+        print("The store of " + input_table + " has been written to " + path)
+
+    return
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
-import json
 import sqlite3
 import datetime as dt
 import pandas as pd
 import numpy as np
+from array_codec import encode_array, decode_list
 
 def sddb_to_tecdb(rad, sd_db="sd_gridded_los_data_fitacf.sqlite", 
                   tec_db="tec_at_rangecell.sqlite", dbdir="../data/sqlite3/"): 
@@ -121,9 +121,9 @@ def geo_to_mag(rad, stm=None, etm=None,
         for row in rows:
             latc, lonc, date_time= row
             if latc:
-                # Load json string
-                latc = json.loads(latc)
-                lonc = json.loads(lonc)
+                # decode the arrays
+                latc = decode_list(latc, "geo_latc")
+                lonc = decode_list(lonc, "geo_lonc")
 
                 # convert from geo to mag coords
                 lonc, latc = coord_conv(lonc, latc, "geo", "mag",
@@ -134,20 +134,19 @@ def geo_to_mag(rad, stm=None, etm=None,
                 lonc = [(round(x,1))%360 for x in lonc]
                 latc = [round(x,1) for x in latc]
 
-                # convert to string
-                latc = json.dumps(latc)
-                lonc = json.dumps(lonc)
+                # encode the arrays
+                latc = encode_array(latc, "mag_latc")
+                lonc = encode_array(lonc, "mag_lonc")
                 
                 # Add to db
                 command = "UPDATE {tb} SET " +\
-                          "mag_latc='{latc}', mag_lonc='{lonc}' " +\
-                          "WHERE datetime = '{dtm}'"
-                command = command.format(tb=table_name, latc=latc,
-                                         lonc=lonc, dtm=date_time)
+                          "mag_latc=?, mag_lonc=? " +\
+                          "WHERE datetime = ?"
+                command = command.format(tb=table_name)
 
                 # do the update
                 try:
-                    cur.execute(command)
+                    cur.execute(command, (latc, lonc, date_time))
                 except Exception, e:
                     logging.error(e, exc_info=True)
 
@@ -216,9 +215,9 @@ def add_tec_at_rangecell(rad, stm=None, etm=None,
         for row in rows:
             latc, lonc, date_time= row
             if latc:
-                # Load json string
-                latc = json.loads(latc)
-                lonc = json.loads(lonc)
+                # decode the arrays
+                latc = decode_list(latc, "mag_latc")
+                lonc = decode_list(lonc, "mag_lonc")
 
                 # Find the time that is closed to the datetime of interest
                 dtm_tmp = date_time.replace(minute=5*int(date_time.minute/5))
@@ -235,23 +234,24 @@ def add_tec_at_rangecell(rad, stm=None, etm=None,
                                              lonc_i=lonc_i, dtm_tmp=dtm_tmp)
                     cur_in.execute(command)
                     rw = cur_in.fetchall()
+                    # rw[0] is the one-column row (med_tec,), so the value
+                    # itself is rw[0][0]
                     if rw:
-                        tecc.append(rw[0])
+                        tecc.append(rw[0][0])
                     else:
                         tecc.append(np.nan)
 
-                tecc = json.dumps(tecc)
+                tecc = encode_array(tecc, "tec")
 
                 # do the update
                 command = "UPDATE {tb} SET " +\
-                          "tec='{tecc}' " +\
-                          "WHERE datetime = '{dtm}'"
-                command = command.format(tb=output_table, tecc=tecc,
-                                         dtm=date_time)
+                          "tec=? " +\
+                          "WHERE datetime = ?"
+                command = command.format(tb=output_table)
                 try:
                     #import pdb
                     #pdb.set_trace()
-                    cur_out.execute(command)
+                    cur_out.execute(command, (tecc, date_time))
                 except Exception, e:
                     logging.error(e, exc_info=True)
 
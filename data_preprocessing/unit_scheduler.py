@@ -0,0 +1,487 @@
+"""
+Runs the preprocessing stages of run_all.py as (event window, radar, stage)
+work units on a bounded process pool.
+
+A unit becomes ready as soon as the previous stage of the same
+(event window, radar) pair has finished, so a slow radar only delays
+its own chain instead of the whole batch.
+
+The period of a radar can also be split into time shards (see
+split_interval) that are run as independent chains. The shards of a
+radar write disjoint (or identical) rows keyed by datetime, so the
+results do not depend on the order in which the shards finish. The
+stage modules open their dbs with a long timeout so that the shards
+wait for each other's write locks.
+"""
+
+import datetime as dt
+import logging
+
+# The stages in the order in which they have to be run for a given
+# (event window, radar) pair.
+# NOTE: "fused" does geolatc_geolonc, geo_to_mlt and bin_to_grid in a
+# single pass, so it is used instead of those three stages.
+STAGES = ["move_to_db", "fused", "geolatc_geolonc", "geo_to_mlt",
+          "bin_to_grid", "median_filter"]
+
+def split_interval(stm, etm, chunk_minutes=None, align_minutes=None):
+    """ splits the period between stm and etm into consecutive time shards.
+
+    Parameters
+    ----------
+    stm : datetime.datetime
+    etm : datetime.datetime
+    chunk_minutes : float, default to None
+        Length of a shard in minutes. If None (or if stm or etm is None)
+        the period is not split.
+    align_minutes : float, default to None
+        If set, chunk_minutes is rounded up to a multiple of align_minutes,
+        e.g., filtered_interval, so that no median filter window straddles
+        two shards.
+
+    Returns
+    -------
+    A list of (stm, etm) tuples
+
+    """
+
+    import math
+
+    if (chunk_minutes is None) or (stm is None) or (etm is None):
+        return [(stm, etm)]
+    if align_minutes:
+        chunk_minutes = math.ceil(float(chunk_minutes) / align_minutes) * align_minutes
+
+    step = dt.timedelta(minutes=chunk_minutes)
+    shards = []
+    sdtm = stm
+    while sdtm < etm:
+        edtm = min(sdtm + step, etm)
+        shards.append((sdtm, edtm))
+        sdtm = edtm
+    if not shards:
+        shards = [(stm, etm)]
+
+    return shards
+
+def build_units(stms, etms, rads, stages=None, channels=None,
+                chunk_minutes=None, align_minutes=None):
+    """ Flattens event windows and radars into a list of work-unit chains.
+
+    Parameters
+    ----------
+    stms : list of datetime.datetime
+        The start times of the event windows
+    etms : list of datetime.datetime
+        The end times of the event windows
+    rads : list
+        A list of three-letter radar codes
+    stages : list, default to None
+        The stages to run, a subset of STAGES. Default to all of STAGES
+        but "fused".
+    channels : list, default to None
+        Channel of each radar in rads. Only used by the move_to_db stage.
+    chunk_minutes : float, default to None
+        If set, the period of each radar is split into time shards of this
+        length and each shard gets its own chain.
+    align_minutes : float, default to None
+        See split_interval. Set it to filtered_interval when the
+        median_filter stage is run.
+
+    Returns
+    -------
+    A list of chains. Each chain is a list of unit dicts that have to be run
+    one after another.
+
+    """
+
+    if stages is None:
+        stages = [x for x in STAGES if x != "fused"]
+    # keep the stages in the order of the pipeline
+    stages = [x for x in STAGES if x in stages]
+    if channels is None:
+        channels = [None] * len(rads)
+
+    chains = []
+    for i in range(len(stms)):
+        shards = split_interval(stms[i], etms[i], chunk_minutes=chunk_minutes,
+                                align_minutes=align_minutes)
+        for j, rad in enumerate(rads):
+            for k, (stm, etm) in enumerate(shards):
+                chain = [{"event":i, "rad":rad, "channel":channels[j],
+                          "shard":k, "stm":stm, "etm":etm, "stage":stage}
+                         for stage in stages]
+                chains.append(chain)
+
+    return chains
+
+def run_unit(unit, stage_kwargs):
+    """ Runs a single work unit. Used as the target of the process pool.
+
+    Parameters
+    ----------
+    unit : dict
+        A work unit created by build_units
+    stage_kwargs : dict
+        Keyword arguments for each stage, keyed by stage name.
+
+    Returns
+    -------
+    A dict holding the unit, its wall time in seconds and the error
+    message (None if the unit succeeded).
+
+    """
+
+    t1 = dt.datetime.now()
+    error = None
+    try:
+        _call_stage(unit, stage_kwargs.get(unit["stage"], {}))
+    except Exception, e:
+        logging.error(e, exc_info=True)
+        error = repr(e)
+    t2 = dt.datetime.now()
+
+    return {"unit":unit, "wall_time":(t2-t1).total_seconds(), "error":error}
+
+# The queue through which the pool workers of run_units tell which unit
+# they have started. Set in each worker by _init_worker.
+_start_queue = None
+
+def _init_worker(start_queue):
+    """ Initializes a pool worker of run_units """
+
+    global _start_queue
+    _start_queue = start_queue
+
+    return
+
+def _run_pool_unit(key, unit, stage_kwargs):
+    """ Runs a work unit in a pool worker of run_units, after telling
+    run_units which worker process runs it and when it started. """
+
+    import os
+
+    _start_queue.put((key, os.getpid(), dt.datetime.now()))
+
+    return run_unit(unit, stage_kwargs)
+
+def _call_stage(unit, kwargs):
+    """ Calls the worker function of a given stage """
+
+    stage = unit["stage"]
+    rad = unit["rad"]
+    stm = unit["stm"]
+    etm = unit["etm"]
+    ftype = kwargs.get("ftype", "fitacf")
+    dbdir = kwargs.get("dbdir", "../data/sqlite3/")
+
+    if stage == "move_to_db":
+        from move_sddata_to_db import worker
+        db_name = kwargs.get("db_name", "sd_gridded_los_data_" + ftype + ".sqlite")
+        worker(db_name, dbdir, rad, stm, etm, ftype, unit["channel"],
+               batch_size=kwargs.get("batch_size", 5000),
+               stream=kwargs.get("stream", False))
+
+    elif stage == "fused":
+        from fused_preprocess import worker
+        worker(rad, stm, etm, ftype=ftype, dbdir=dbdir,
+               db_name=kwargs.get("db_name", None),
+               t_c_alt=kwargs.get("t_c_alt", 300.),
+               stay_in_geo=kwargs.get("stay_in_geo", False),
+               hemi=kwargs.get("hemi", "north"),
+               fov_dbname=kwargs.get("fov_dbname", None))
+
+    elif stage == "geolatc_geolonc":
+        from calc_geolatc_geolonc import worker
+        worker(rad, stm, etm, ftype=ftype, dbdir=dbdir,
+               db_name=kwargs.get("db_name", None),
+               fov_dbname=kwargs.get("fov_dbname", None))
+
+    elif stage == "geo_to_mlt":
+        from geo_to_mlt import worker
+        worker(rad, stm=stm, etm=etm, ftype=ftype,
+               dbdir=dbdir, db_name=kwargs.get("db_name", None),
+               t_c_alt=kwargs.get("t_c_alt", 300.),
+               stay_in_geo=kwargs.get("stay_in_geo", False),
+               fov_dbname=kwargs.get("fov_dbname", None))
+
+    elif stage == "bin_to_grid":
+        from bin_data import worker
+        worker(rad, stm=stm, etm=etm, ftype=ftype,
+               coords=kwargs.get("coords", "mlt"),
+               hemi=kwargs.get("hemi", "north"),
+               dbdir=dbdir, db_name=kwargs.get("db_name", None))
+
+    elif stage == "median_filter":
+        from xxx_min_median import worker
+        worker(rad, stm, etm, ftype=ftype,
+               coords=kwargs.get("coords", "mlt"),
+               filtered_interval=kwargs.get("filtered_interval", 2.),
+               dbdir=dbdir, input_dbname=kwargs.get("input_dbname", None),
+               output_dbname=kwargs.get("output_dbname", None),
+               hemi=kwargs.get("hemi", "north"),
+               single_scan=kwargs.get("single_scan", False))
+
+    else:
+        raise ValueError("unknown stage " + str(stage))
+
+    return
+
+def run_units(chains, stage_kwargs=None, nprocs=None,
+              maxtasksperchild=None, poll_interval=60.):
+    """ Runs work-unit chains on a bounded process pool. The next unit of
+    a chain is submitted as soon as its predecessor finishes.
+    If a unit fails the rest of its chain is skipped.
+    A unit whose worker process dies (e.g., a segfault) or whose result
+    can not be sent back is reported as failed instead of being waited for.
+
+    Parameters
+    ----------
+    chains : list
+        Work-unit chains created by build_units
+    stage_kwargs : dict, default to None
+        Keyword arguments for each stage, keyed by stage name.
+    nprocs : int, default to None
+        Size of the process pool. Default to the number of CPUs.
+        If set to 1 the units are run in serial in the current process.
+    maxtasksperchild : int, default to None
+        Passed to multiprocessing.Pool.
+    poll_interval : float, default to 60.
+        If no unit finishes within poll_interval seconds, the pending
+        units are checked for lost results.
+
+    Returns
+    -------
+    A list of the dicts returned by run_unit, sorted by event, radar, shard
+    and stage so that it does not depend on the order of completion.
+
+    """
+
+    import multiprocessing as mp
+    from multiprocessing.queues import SimpleQueue
+    import Queue
+
+    if stage_kwargs is None:
+        stage_kwargs = {}
+    if nprocs is None:
+        nprocs = mp.cpu_count()
+    nprocs = max(1, min(nprocs, len(chains)))
+
+    reports = []
+
+    # run in serial
+    if nprocs == 1:
+        for chain in chains:
+            for unit in chain:
+                report = run_unit(unit, stage_kwargs)
+                _print_report(report)
+                reports.append(report)
+                if report["error"] is not None:
+                    break
+        return _sort_reports(reports)
+
+    # done_queue receives (chain index, position in chain, report)
+    # from the result handler thread of the pool.
+    # start_queue receives ((chain index, position in chain), pid, start time)
+    # from the workers. It is a SimpleQueue, whose put writes to the pipe
+    # right away, so the message is not lost if the worker dies next.
+    done_queue = Queue.Queue()
+    start_queue = SimpleQueue()
+    pool = mp.Pool(processes=nprocs, maxtasksperchild=maxtasksperchild,
+                   initializer=_init_worker, initargs=(start_queue,))
+
+    # the AsyncResult of each submitted unit, keyed by (chain index,
+    # position in chain), and the (pid, start time) of the started ones
+    pending = {}
+    started = {}
+
+    def submit(ci, ui):
+        callback = lambda report, ci=ci, ui=ui: done_queue.put((ci, ui, report))
+        pending[(ci, ui)] = pool.apply_async(_run_pool_unit,
+                                             ((ci, ui), chains[ci][ui], stage_kwargs),
+                                             callback=callback)
+
+    def finish(ci, ui, report):
+        del pending[(ci, ui)]
+        started.pop((ci, ui), None)
+        _print_report(report)
+        reports.append(report)
+
+        # submit the next unit of the same chain
+        if report["error"] is None and ui+1 < len(chains[ci]):
+            submit(ci, ui+1)
+
+    # submit the first unit of every chain
+    for ci in range(len(chains)):
+        if chains[ci]:
+            submit(ci, 0)
+
+    nlost = 0
+    clean = False
+    try:
+        while pending:
+            try:
+                ci, ui, report = done_queue.get(timeout=poll_interval)
+            except Queue.Empty:
+                lost = _lost_units(pool, chains, pending, started, start_queue)
+                for (ci, ui), report in lost:
+                    finish(ci, ui, report)
+                nlost += len(lost)
+                continue
+            if (ci, ui) in pending:
+                finish(ci, ui, report)
+        clean = (nlost == 0)
+    finally:
+        # NOTE: the pool waits forever for the results of lost units
+        # in join(), so it is terminated if any unit was lost (or if
+        # run_units is interrupted).
+        if clean:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+    return _sort_reports(reports)
+
+def _lost_units(pool, chains, pending, started, start_queue):
+    """ finds the pending units of run_units whose result will never arrive,
+    i.e., those whose result could not be sent back and those whose worker
+    process has died.
+
+    Returns
+    -------
+    A list of ((chain index, position in chain), report) tuples, with
+    the reports of the lost units as failed units.
+
+    """
+
+    # the units that have been started by a worker
+    while not start_queue.empty():
+        key, pid, stime = start_queue.get()
+        started[key] = (pid, stime)
+
+    # NOTE: the pool replaces a dead worker with a new process
+    live_pids = set([p.pid for p in pool._pool if p.is_alive()])
+
+    lost = []
+    for key, result in pending.items():
+        error = None
+        if not result.ready():
+            if (key not in started) or (started[key][0] in live_pids):
+                continue
+            # the worker might have exited (e.g., due to maxtasksperchild)
+            # right after sending the result
+            result.wait(1.)
+            if not result.ready():
+                error = "worker process " + str(started[key][0]) + " died"
+        if error is None:
+            # the result of a successful unit arrives through the callback
+            if result.successful():
+                continue
+            try:
+                result.get()
+            except Exception, e:
+                error = repr(e)
+        if key in started:
+            wall_time = (dt.datetime.now() - started[key][1]).total_seconds()
+        else:
+            wall_time = 0.
+        ci, ui = key
+        lost.append((key, {"unit":chains[ci][ui], "wall_time":wall_time,
+                           "error":error}))
+
+    return lost
+
+def _sort_reports(reports):
+    """ sorts the reports of run_units in the order of the units """
+
+    def key(report):
+        unit = report["unit"]
+        return (unit["event"], unit["rad"], unit.get("shard", 0),
+                STAGES.index(unit["stage"]))
+
+    return sorted(reports, key=key)
+
+def run_sharded(worker, rads, stm, etm, chunk_minutes=None, align_minutes=None,
+                worker_kwargs=None, nprocs=None):
+    """ Runs worker(rad, stm, etm, **worker_kwargs) for every (radar, time
+    shard) pair on a process pool. Used by the main functions of the stage
+    modules, which run a single stage.
+
+    Parameters
+    ----------
+    worker : function
+        The (module-level) worker function of a stage
+    rads : list
+        A list of three-letter radar codes
+    stm, etm : datetime.datetime
+        The period to be processed. If any of them is None, the whole
+        period of each radar is a single unit.
+    chunk_minutes, align_minutes : float, default to None
+        See split_interval
+    worker_kwargs : dict, default to None
+    nprocs : int, default to None
+        Size of the process pool. Default to the number of CPUs.
+        If set to 1 the units are run in serial in the current process.
+
+    Returns
+    -------
+    Nothing. The exception of the first failed unit (in the order of the
+    units) is raised after all the units have finished.
+
+    """
+
+    import multiprocessing as mp
+
+    if worker_kwargs is None:
+        worker_kwargs = {}
+    shards = split_interval(stm, etm, chunk_minutes=chunk_minutes,
+                            align_minutes=align_minutes)
+    units = [(rad, sdtm, edtm) for rad in rads for sdtm, edtm in shards]
+
+    # run in serial
+    if nprocs == 1:
+        for unit in units:
+            worker(*unit, **worker_kwargs)
+        return
+
+    if nprocs is None:
+        nprocs = mp.cpu_count()
+    pool = mp.Pool(processes=max(1, min(nprocs, len(units))))
+    results = [pool.apply_async(worker, unit, worker_kwargs) for unit in units]
+    pool.close()
+    pool.join()
+    for result in results:
+        result.get()
+
+    return
+
+def _print_report(report):
+    unit = report["unit"]
+    txt = unit["stage"] + " for " + unit["rad"] + " for period between " +\
+          str(unit["stm"]) + " and " + str(unit["etm"]) + " took " +\
+          str(round(report["wall_time"], 2)) + " secs"
+    if report["error"] is not None:
+        txt = txt + " and failed with " + report["error"]
+    print(txt)
+
+    return
+
+def summarize_reports(reports):
+    """ Sums up the wall times of work units per stage.
+
+    Returns
+    -------
+    A dict of {stage : (number of units, total wall time in seconds,
+    max wall time in seconds)}
+
+    """
+
+    summary = {}
+    for report in reports:
+        stage = report["unit"]["stage"]
+        n, total, tmax = summary.get(stage, (0, 0., 0.))
+        summary[stage] = (n + 1, total + report["wall_time"],
+                          max(tmax, report["wall_time"]))
+
+    return summary
@@ -1,6 +1,6 @@
 def xxx_min_median(rad, stm, etm, ftype="fitacf", filtered_interval=2., 
-		   coords="mlt", dbdir="../data/sqlite3/",
-                   input_dbname=None, output_dbname=None):
+		   coords="mlt", hemi="north", dbdir="../data/sqlite3/",
+                   input_dbname=None, output_dbname=None, single_scan=False):
     
     """ Bins the gridded data from a single radar into xxx-minute intervals.
     e.g., at each xxx-minute interval, median vector in each azimuth bin within a grid cell is
@@ -21,10 +21,16 @@ def xxx_min_median(rad, stm, etm, ftype="fitacf", filtered_interval=2.,
     coords : str
         Coordinates in which the binning process takes place.
         Default to "mlt. Can be "geo" as well. 
+    hemi : str
+        Hemisphere of the grids in which the data were binned.
     input_dbname : str, default to None
         Name of the sqlite db to which gridded data has been written
     output_dbname : str, default to None
         Name of the sqlite db to which xxx-min median filtered data will be written
+    single_scan : bool, default to False
+        If True, the data between stm and etm are read at once and the medians
+        of all the windows are calculated in one pass (see single_scan_median).
+        Otherwise the data are read window by window.
 
     Returns
     -------
@@ -36,7 +42,8 @@ def xxx_min_median(rad, stm, etm, ftype="fitacf", filtered_interval=2.,
     import datetime as dt
     import logging
     import sqlite3
-    import json
+    from array_codec import decode_list
+    from bin_data import hemi_grids
 
     # create db names
     if input_dbname is None:
@@ -47,7 +54,7 @@ def xxx_min_median(rad, stm, etm, ftype="fitacf", filtered_interval=2.,
 
     # make a connection to gridded los db
     try:
-        conn_in = sqlite3.connect(dbdir + input_dbname,
+        conn_in = sqlite3.connect(dbdir + input_dbname, timeout=600.,
                                   detect_types = sqlite3.PARSE_DECLTYPES)
         cur_in = conn_in.cursor()
     except Exception, e:
@@ -55,7 +62,7 @@ def xxx_min_median(rad, stm, etm, ftype="fitacf", filtered_interval=2.,
  
     # make a connection to xxx-min median filtered data 
     try:
-        conn_out = sqlite3.connect(dbdir + output_dbname,
+        conn_out = sqlite3.connect(dbdir + output_dbname, timeout=600.,
                                   detect_types = sqlite3.PARSE_DECLTYPES)
         cur_out = conn_out.cursor()
     except Exception, e:
@@ -63,6 +70,10 @@ def xxx_min_median(rad, stm, etm, ftype="fitacf", filtered_interval=2.,
 
     input_table = rad
     output_table = rad
+    if coords == "mlt":
+        coords_prefix = "mag"
+    elif coords == "geo":
+        coords_prefix = "geo"
 
     # Check whether the table of interest exists
     command = "SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'"
@@ -71,151 +82,260 @@ def xxx_min_median(rad, stm, etm, ftype="fitacf", filtered_interval=2.,
     if not cur_in.fetchall():
         return
 
-    # create a table
-    if coords == "mlt":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " mag_glatc float(7,2)," +\
-                  " mag_gltc float(8,2)," +\
-                  " mag_gazmc SMALLINT," +\
-                  " datetime DATETIME, " +\
-                  " CONSTRAINT xxx_min PRIMARY KEY (" +\
-		  "mag_glatc, mag_gltc, mag_gazmc, datetime))"
-
-    elif coords == "geo":
-        command = "CREATE TABLE IF NOT EXISTS {tb}" +\
-                  "(vel float(9,2)," +\
-                  " geo_glatc float(7,2)," +\
-                  " geo_gltc float(8,2)," +\
-                  " geo_gazmc SMALLINT," +\
-                  " datetime DATETIME, " +\
-                  " CONSTRAINT xxx_min PRIMARY KEY (" +\
-		  "geo_glatc, geo_gltc, geo_gazmc, datetime))"
-    command = command.format(tb=output_table)
+    # create a table. Rows are keyed by the integer ids of the grid-cells
+    # and azm bins. The float centers are kept for readability.
+    command = "CREATE TABLE IF NOT EXISTS {tb}" +\
+              "(vel float(9,2)," +\
+              " {prefix}_glatc float(7,2)," +\
+              " {prefix}_gltc float(8,2)," +\
+              " {prefix}_gazmc SMALLINT," +\
+              " cell_id INTEGER," +\
+              " azm_id SMALLINT," +\
+              " datetime DATETIME, " +\
+              " CONSTRAINT xxx_min PRIMARY KEY (" +\
+              "cell_id, azm_id, datetime))"
+    command = command.format(tb=output_table, prefix=coords_prefix)
     try:
         cur_out.execute(command)
     except Exception, e:
         logging.error(e, exc_info=True)
 
-    # initial starting and ending time of the time interval given by filtered_interval 
-    sdtm = stm
-    edtm = sdtm + dt.timedelta(minutes=filtered_interval)
-
-    # slide the xxx-minute window from stm to etm
-    while edtm <= etm:
-        # bin_vel stores the velocity data as {glatc-glonc-gazmc: [velocites]}  
-        bin_vel = {}
-        # select column variables for a xxx-minute interval
-        if coords == "mlt":
-            command = "SELECT vel, mag_glatc, mag_gltc, mag_gazmc " +\
-                      "FROM {tb} WHERE datetime BETWEEN '{sdtm}' AND '{edtm}'"
-        elif coords == "geo":
-            command = "SELECT vel, geo_glatc, geo_gltc, geo_gazmc " +\
-                      "FROM {tb} WHERE datetime BETWEEN '{sdtm}' AND '{edtm}'"
-        command = command.format(tb=input_table, sdtm=sdtm, edtm=edtm)
-
-        try:
-            cur_in.execute(command)
-        except Exception, e:
-            logging.error(e, exc_info=True)
-        rows_tmp = cur_in.fetchall()
-
-        if rows_tmp:
-            # loop through each row
-            for row in rows_tmp:
-                vel, lat, lon, az = row
-                if None not in row:
-                    # convert from string to float
-                    vel = json.loads(vel)
-                    lat = json.loads(lat)
-                    lon = json.loads(lon)
-                    az = json.loads(az)
-
-                    for i in range(len(vel)):
-                        # exclude NaN elements
-                        if np.isnan(lat[i]):
-                            continue
-
-                        # build xxx bin_vel dict ({glatc-glonc-gazmc: [velocites]})
-                        try:
-                            bin_vel[(lat[i],lon[i],az[i])].append(vel[i])
-                        except KeyError:
-                            bin_vel[(lat[i],lon[i],az[i])] = [vel[i]]
-                else:
-                    continue
+    # the grids in which the data were binned
+    grds = hemi_grids(hemi)
+
+    # the medians of all the windows are calculated before anything is
+    # written, so that the write lock of the output db is held only for
+    # the single short transaction at the end.
+    if single_scan:
+        # all the windows in a single read and a single sorted group-by
+        rows = single_scan_median(cur_in, input_table, stm, etm, grds,
+                                  filtered_interval=filtered_interval,
+                                  coords_prefix=coords_prefix)
+        print("finished median filtering for " + rad  +\
+              " for time interval between " + str(stm) + " and " + str(etm))
+
+    else:
+        rows = []
+
+        # initial starting and ending time of the time interval given by filtered_interval 
+        sdtm = stm
+        edtm = sdtm + dt.timedelta(minutes=filtered_interval)
+
+        # slide the xxx-minute window from stm to etm
+        while edtm <= etm:
+            # bin_vel stores the velocity data as {glatc-glonc-gazmc: [velocites]}  
+            bin_vel = {}
+            # select column variables for a xxx-minute interval
+            if coords == "mlt":
+                command = "SELECT vel, mag_glatc, mag_gltc, mag_gazmc " +\
+                          "FROM {tb} WHERE datetime BETWEEN '{sdtm}' AND '{edtm}'"
+            elif coords == "geo":
+                command = "SELECT vel, geo_glatc, geo_gltc, geo_gazmc " +\
+                          "FROM {tb} WHERE datetime BETWEEN '{sdtm}' AND '{edtm}'"
+            command = command.format(tb=input_table, sdtm=sdtm, edtm=edtm)
+
+            try:
+                cur_in.execute(command)
+            except Exception, e:
+                logging.error(e, exc_info=True)
+            rows_tmp = cur_in.fetchall()
+
+            if rows_tmp:
+                # decode and flatten the arrays of all the rows
+                vels = []
+                lats = []
+                lons = []
+                azs = []
+                for row in rows_tmp:
+                    if None not in row:
+                        vels.extend(decode_list(row[0], "vel"))
+                        lats.extend(decode_list(row[1], coords_prefix + "_glatc"))
+                        lons.extend(decode_list(row[2], coords_prefix + "_gltc"))
+                        azs.extend(decode_list(row[3], coords_prefix + "_gazmc"))
+
+                # map the grid-cell centers to integer ids. NaN centers get -1.
+                cell_ids, azm_ids = grds.encode_ids(lats, lons, azs)
+                for i in xrange(len(vels)):
+                    # exclude NaN elements
+                    if cell_ids[i] < 0 or azm_ids[i] < 0:
+                        continue
+
+                    # build xxx bin_vel dict ({(cell_id, azm_id): [velocites]})
+                    ky = (int(cell_ids[i]), int(azm_ids[i]))
+                    try:
+                        bin_vel[ky].append(vels[i])
+                    except KeyError:
+                        bin_vel[ky] = [vels[i]]
         
-        else:
+            else:
+                # update starting and ending time of the time interval given by filtered_interval
+                sdtm = edtm
+                edtm = sdtm + dt.timedelta(minutes=filtered_interval)
+                continue
+
+            if bin_vel:
+                # take the mid-point of sdtm and edtm
+                mid_tm = sdtm + dt.timedelta(minutes=filtered_interval/2.)
+
+                # the float centers of the keys
+                kys = bin_vel.keys()
+                glatcs, gltcs = grds.decode_cell_ids([ky[0] for ky in kys])
+                gazmcs = grds.decode_azm_ids([ky[1] for ky in kys])
+
+                # take the median value of each key
+                for j, ky in enumerate(kys):
+                    vel_median = round(np.median(bin_vel[ky]),2)
+                    rows.append((vel_median, round(glatcs[j],2), round(gltcs[j],2),
+                                 int(gazmcs[j]), ky[0], ky[1], mid_tm))
+
+            print("finished median filtering for " + rad  +\
+                  " for time interval between " + str(sdtm) + " and " + str(edtm))
+
             # update starting and ending time of the time interval given by filtered_interval
             sdtm = edtm
             edtm = sdtm + dt.timedelta(minutes=filtered_interval)
-            continue
-
-        if bin_vel:
-            # take the mid-point of sdtm and edtm
-            mid_tm = sdtm + dt.timedelta(minutes=filtered_interval/2.)
-                
-            # populate the rad table 
-            for ky in bin_vel.keys(): 
-                # take the median value
-                bin_vel[ky] = round(np.median(bin_vel[ky]),2)
-                if coords == "mlt":
-                    command = "INSERT OR IGNORE INTO {tb} (vel, mag_glatc, mag_gltc, " +\
-                              "mag_gazmc, datetime) VALUES (?, ?, ?, ?, ?)"
-                elif coords == "geo":
-                    command = "INSERT OR IGNORE INTO {tb} (vel, geo_glatc, geo_gltc, " +\
-                              "geo_gazmc, datetime) VALUES (?, ?, ?, ?, ?)"
-                command = command.format(tb=output_table)
-
-                try:
-                    cur_out.execute(command,
-                                    (bin_vel[ky], ky[0], ky[1], ky[2], mid_tm))
-                except Exception, e:
-                    logging.error(e, exc_info=True)
 
-        print("finished median filtering for " + rad  +\
-              " for time interval between " + str(sdtm) + " and " + str(edtm))
+    # populate the rad table and commit the change. Write errors (e.g.,
+    # "database is locked" after the timeout) are not caught, so that
+    # a unit fails instead of silently losing its rows.
+    command = "INSERT OR IGNORE INTO {tb} (vel, {prefix}_glatc, {prefix}_gltc, " +\
+              "{prefix}_gazmc, cell_id, azm_id, datetime) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    command = command.format(tb=output_table, prefix=coords_prefix)
+    try:
+        cur_out.executemany(command, rows)
+        conn_out.commit()
+    finally:
+        # close db connections
+        conn_in.close()
+        conn_out.close()
 
-        # update starting and ending time of the time interval given by filtered_interval
-        sdtm = edtm
-        edtm = sdtm + dt.timedelta(minutes=filtered_interval)
+    return
+
+def single_scan_median(cur, table_name, stm, etm, grds, filtered_interval=2.,
+                       coords_prefix="mag"):
+    """ reads the gridded data of a radar between stm and etm at once and
+    calculates the median velocity in each (window, grid-cell, azm bin).
+
+    Each gate-level sample is assigned the index of the xxx-minute window it
+    falls in (stm <= datetime < etm, windows are closed on the left) and the
+    integer ids of its grid-cell and azm bin. The samples are sorted by the
+    combined key and then by velocity, so the median of each group is read
+    off the middle of its segment.
 
-    # commit the change
+    Parameters
+    ----------
+    cur : sqlite3 cursor of the gridded los db
+    table_name : str
+    stm, etm : datetime.datetime
+    grds : grids object
+        The grids in which the data were binned
+    filtered_interval : float
+        Window length in minutes
+    coords_prefix : str
+        "mag" or "geo"
+
+    Returns
+    -------
+    list of tuples
+        (vel, glatc, gltc, gazmc, cell_id, azm_id, datetime) rows, ready for
+        executemany.
+    """
+
+    import numpy as np
+    import datetime as dt
+    import logging
+    from array_codec import decode_array
+
+    step = dt.timedelta(minutes=filtered_interval)
+    step_secs = step.total_seconds()
+    nwins = int((etm - stm).total_seconds() // step_secs)
+    if nwins == 0:
+        return []
+
+    command = "SELECT vel, {prefix}_glatc, {prefix}_gltc, {prefix}_gazmc, datetime " +\
+              "FROM {tb} WHERE datetime >= ? AND datetime < ?"
+    command = command.format(tb=table_name, prefix=coords_prefix)
     try:
-        conn_out.commit()
+        cur.execute(command, (stm, stm + step * nwins))
     except Exception, e:
         logging.error(e, exc_info=True)
-
-    # close db connections
-    conn_in.close()
-    conn_out.close()
-
-    return
+    rows = [x for x in cur.fetchall() if None not in x]
+    if not rows:
+        return []
+
+    # flatten the arrays of all the rows
+    vels = [decode_array(x[0], "vel") for x in rows]
+    ncells = [len(x) for x in vels]
+    vels = np.concatenate(vels).astype(float)
+    lats = np.concatenate([decode_array(x[1], coords_prefix + "_glatc") for x in rows])
+    lts = np.concatenate([decode_array(x[2], coords_prefix + "_gltc") for x in rows])
+    azms = np.concatenate([decode_array(x[3], coords_prefix + "_gazmc") for x in rows])
+    row_wins = np.array([int((x[4] - stm).total_seconds() // step_secs) for x in rows])
+    win_ids = np.repeat(row_wins, ncells)
+
+    # exclude the samples outside the grids
+    cell_ids, azm_ids = grds.encode_ids(lats, lts, azms)
+    valid = (cell_ids >= 0) & (azm_ids >= 0)
+    vels = vels[valid]
+    nazms = len(grds.center_azms)
+    ncells_all = grds.band_offsets[-1]
+    keys = (win_ids[valid].astype(np.int64) * ncells_all + cell_ids[valid]) * nazms +\
+           azm_ids[valid]
+    if len(keys) == 0:
+        return []
+
+    # sort by key, then by vel within each key
+    order = np.lexsort((vels, keys))
+    keys = keys[order]
+    vels = vels[order]
+
+    # the segments of equal keys, and their medians
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    medians = (vels[starts + (counts - 1) // 2] + vels[starts + counts // 2]) / 2.
+
+    # split the keys back into their ids
+    keys = keys[starts]
+    azm_ids = keys % nazms
+    cell_ids = (keys // nazms) % ncells_all
+    win_ids = keys // (nazms * ncells_all)
+    glatcs, gltcs = grds.decode_cell_ids(cell_ids)
+    gazmcs = grds.decode_azm_ids(azm_ids)
+
+    # the mid-point of each window
+    mid_tms = dict([(w, stm + step * int(w) + step / 2) for w in np.unique(win_ids)])
+
+    return [(round(medians[i], 2), round(glatcs[i], 2), round(gltcs[i], 2),
+             int(gazmcs[i]), int(cell_ids[i]), int(azm_ids[i]), mid_tms[win_ids[i]])
+            for i in xrange(len(keys))]
 
 def worker(rad, stm, etm, ftype="fitacf", coords="mlt",
            filtered_interval=2., dbdir="../data/sqlite3/",
-           input_dbname=None, output_dbname=None):
+           input_dbname=None, output_dbname=None,
+           hemi="north", single_scan=False):
 
     import datetime as dt
 
     # take xxx-minute median values
     print("start working on table " + rad + " for interval between " +\
           str(stm) + " and " + str(etm))
-    xxx_min_median(rad, stm, etm, ftype=ftype, coords=coords,
+    xxx_min_median(rad, stm, etm, ftype=ftype, coords=coords, hemi=hemi,
                    filtered_interval=filtered_interval,
                    dbdir=dbdir, input_dbname=input_dbname,
-                   output_dbname=output_dbname)
+                   output_dbname=output_dbname, single_scan=single_scan)
     print("finish taking xxx mimute median filtering on " + rad +\
           " for interval between " + str(stm) + " and " + str(etm))
 
     return
 
-def main(run_in_parallel=True):
+def main(run_in_parallel=True, chunk_minutes=None):
     """ Call the functions above. Acts as an example code.
     Multiprocessing has been implemented to do parallel computing.
-    A unit process runs for a radar"""
+    A unit process runs for a radar, or for a time shard of a radar if
+    chunk_minutes is set."""
 
     import datetime as dt
-    import multiprocessing as mp
+    from unit_scheduler import run_sharded
     import logging
     
     # create a log file to which any error occured  will be written.
@@ -235,34 +355,15 @@ def main(run_in_parallel=True):
     # run the code for the following radars in parallel
     rad_list = ["wal", "bks", "fhe", "fhw", "cve", "cvw", "ade", "adw"]
     
-    # store the multiprocess
-    procs = []
-    # loop through radars
-    for rad in rad_list: 
-	if run_in_parallel:
-	    # cteate a process
-	    worker_kwargs = {"ftype":ftype, "coords":coords,
-                             "filtered_interval":filtered_interval,
-			     "dbdir":dbdir, "input_dbname":input_dbname,
-			     "output_dbname":output_dbname}
-	    p = mp.Process(target=worker, args=(rad, stm, etm),
-			   kwargs=worker_kwargs)
-	    procs.append(p)
-	    
-	    # run the process
-	    p.start()
-	    
-	else:
-	    # run in serial
-            worker(rad, stm, etm, ftype=ftype, 
-                   coords=coords, filtered_interval=filtered_interval,
-                   dbdir=dbdir, input_dbname=input_dbname,
-                   output_dbname=output_dbname)
-            
-    if run_in_parallel:
-        # make sure the processes terminate
-        for p in procs:
-            p.join()
+    # run a unit per (radar, time shard). The shards are aligned to
+    # filtered_interval so that no window straddles two shards.
+    worker_kwargs = {"ftype":ftype, "coords":coords,
+                     "filtered_interval":filtered_interval,
+                     "dbdir":dbdir, "input_dbname":input_dbname,
+                     "output_dbname":output_dbname}
+    run_sharded(worker, rad_list, stm, etm, chunk_minutes=chunk_minutes,
+                align_minutes=filtered_interval, worker_kwargs=worker_kwargs,
+                nprocs=None if run_in_parallel else 1)
 
     return
 
@@ -1,3 +1,5 @@
+import sys
+sys.path.append("../data_preprocessing/")
 import matplotlib
 matplotlib.use('Agg')
 import numpy as np
@@ -11,7 +13,8 @@ def plot_cosfit(ax, latc, ltc, master_table, cosfit_table,
                 ftype="fitacf", coords="mlt", 
                 fit_by_bmazm=False, fit_by_losvel_azm=True,
                 db_name=None, dbdir="../data/sqlite3/",
-                weighting=None, add_errbar=False):
+                weighting=None, add_errbar=False, hemi="north",
+                store_path=None):
 
     """ plots a the cosfit results for a give latc-ltc grid for a given relative_time
     Parameters
@@ -45,10 +48,19 @@ def plot_cosfit(ax, latc, ltc, master_table, cosfit_table,
         if set to None, all azimuthal bins are
         considered equal regardless of the nubmer of points
         each of them contains.
+    hemi : str
+        Hemisphere of the grids in which the data were binned.
+    store_path : str, default to None
+        Path of a store of master_table written by
+        superposed_store.build_superposed_store. If None, the rows of
+        the relative times of interest are loaded from master_table.
 
 
     """
 
+    from bin_data import hemi_grids
+    from superposed_store import load_slab, superposed_store
+
     # construct a db name
     if db_name is None:
         db_name = "sd_master_" + coords + "_" +ftype + ".sqlite"
@@ -91,31 +103,23 @@ def plot_cosfit(ax, latc, ltc, master_table, cosfit_table,
     ltc_idx = (np.abs(possible_lts - ltc)).argmin()
     ltc = round(possible_lts[ltc_idx],2)
     
-    # Find the AZM and LOS info
+    # Find the AZM and LOS info in the grid-cells of the MLT window,
+    # which wraps around 0/360.
     sreltm = relative_time
     ereltm = relative_time + (reltime_resolution-1)
-    gltc_left = ltc - mlt_width/2.*15.
-    gltc_right = ltc + mlt_width/2.*15.
-    if gltc_right >=360 or gltc_left < 0:
-        gltc_left =  gltc_left % 360
-        where_clause = "AND (({gltc} BETWEEN {gltc_left} AND 360) or ({gltc} BETWEEN 0 AND {gltc_right})) "
+    grds = hemi_grids(hemi)
+    if store_path is None:
+        slab = load_slab(cur, master_table, sreltm, ereltm, hemi=hemi, coords=coords)
     else:
-        where_clause = "AND ({gltc} BETWEEN {gltc_left} AND {gltc_right}) "
-    command = "SELECT vel, {gazmc}, rad FROM {tb2} " +\
-              "WHERE {glatc}={lat} " + where_clause + \
-              "AND (relative_time BETWEEN {sreltm} AND {ereltm}) " +\
-              "ORDER BY {gazmc}"
-    command = command.format(tb2=master_table, glatc=col_glatc, gltc=col_gltc,
-                             gltc_left=gltc_left, gltc_right=gltc_right,
-                             sreltm=sreltm, ereltm=ereltm,
-                             gazmc=col_gazmc, lat=latc)
-
-    cur.execute(command)
-    rows = cur.fetchall()
-    los_vel = -np.array([x[0] for x in rows])
-    azm = np.array([x[1] for x in rows])
+        slab = superposed_store(store_path)
+    cell_ids, azm_ids = grds.encode_ids([latc], [ltc], [0.])
+    window_ids = grds.window_cell_ids(cell_ids[0], mlt_width*15.)
+    rows = slab.select(range(sreltm, ereltm+1), window_ids)
+    order = np.argsort(rows["azm_id"], kind="mergesort")
+    los_vel = -rows["vel"][order].astype(float)
+    azm = grds.decode_azm_ids(rows["azm_id"][order])
     azm = [x if x <= 180 else x-360 for x in azm]
-    rad = [x[2] for x in rows]
+    rad = [slab.rads[x] for x in rows["rad_code"][order]]
 
     # select the cosine fitting results from db
     command = "SELECT vel_count, vel_mag, vel_mag_err, vel_dir, " + \
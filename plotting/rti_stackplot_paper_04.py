@@ -2,13 +2,15 @@ import pandas as pd
 import numpy as np
 import datetime as dt
 import sqlite3
-import json
 from davitpy import pydarn
 import matplotlib.pyplot as plt
 plt.style.use("ggplot")
 import sys
 sys.path.append("../data/")
+sys.path.append("../data_preprocessing/")
 from build_event_database import build_event_database
+from array_codec import decode_list
+from fov_geometry import fov_lat_edges
 from funcs import find_bmnum, add_cbar
 
 
@@ -128,11 +130,16 @@ def plot_rti(ax, event_dtm, rad,
                 frang = df.frang.unique().tolist()[0]
                 site = pydarn.radar.network().getRadarByCode(rad) \
                        .getSiteByDate(fov_dtm)
-                myFov = pydarn.radar.radFov.fov(site=site, ngates=rmax,
-                                                nbeams=site.maxbeam,
-                                                rsep=rsep, frang=frang, coords="mag",
-                                                coord_alt=300., date_time=fov_dtm)
-                ys = myFov.latFull[bmnum]
+                # load the FOV geometry from the FOV db if it is available
+                ys = fov_lat_edges(rad, site, bmnum, frang, rsep, rmax,
+                                   date_time=fov_dtm, coords="mag",
+                                   altitude=300., dbdir=dbdir)
+                if ys is None:
+                    myFov = pydarn.radar.radFov.fov(site=site, ngates=rmax,
+                                                    nbeams=site.maxbeam,
+                                                    rsep=rsep, frang=frang, coords="mag",
+                                                    coord_alt=300., date_time=fov_dtm)
+                    ys = myFov.latFull[bmnum]
                 cs = np.ones((len(xs), len(ys))) * np.nan
 
 #                fov_dtm = df.datetime.unique().tolist()
@@ -160,9 +167,9 @@ def plot_rti(ax, event_dtm, rad,
 
 	    tcnt = 0
             for i, rw in df.iterrows():
-                vl = json.loads(rw.vel)
-                lat = json.loads(rw.mag_latc)
-                slst = json.loads(rw.slist)
+                vl = decode_list(rw.vel, "vel")
+                lat = decode_list(rw.mag_latc, "mag_latc")
+                slst = decode_list(rw.slist, "slist")
 		dtm_tmp = pd.to_datetime(rw.datetime)
 		relative_time = (dtm_tmp-event_dtm).total_seconds()/60.
 		if scatter_plot:
@@ -1,12 +1,13 @@
 import sys
 sys.path.append("../data/")
+sys.path.append("../data_preprocessing/")
 from create_event_list import create_event_list
+from array_codec import decode_list
 from funcs import find_bmnum
 import pandas as pd
 import numpy as np
 import datetime as dt
 import sqlite3
-import json
 import matplotlib.pyplot as plt
 plt.style.use("ggplot")
 
@@ -178,8 +179,8 @@ def plot_superposed_los(ax, event_dtm,
             df = pd.read_sql(command, conn)
             avgvel_lst = []
             for i, rw in df.iterrows():
-                vl = json.loads(rw.vel)
-                lat = json.loads(rw.mag_latc)
+                vl = decode_list(rw.vel, "vel")
+                lat = decode_list(rw.mag_latc, "mag_latc")
                 vels_tmp = np.array([vl[i] for i in range(len(vl))\
                         if (lat[i] >= mag_latc_range[0] and lat[i] <= mag_latc_range[1])])
 